@@ -0,0 +1,426 @@
+"""Benchmarks for the GTD Task Manager
+
+    python benchmark.py serializers [--items 100,1000,10000,50000]
+    python benchmark.py app [--items 1000] [--mix default] [--json out.json]
+    python benchmark.py compare before.json after.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import wsgi
+
+
+def make_dataset(item_count, project_count=None, seed=0):
+    """Return a dataset shaped like a real user's, with generated records"""
+    rng = random.Random(seed)
+    if project_count is None:
+        project_count = max(1, item_count // 20)
+    words = "call email buy review plan draft fix book send check read write".split()
+    projects = [
+        {
+            "name": f"Project {i}",
+            "description": " ".join(rng.choices(words, k=12)),
+            "outcome": " ".join(rng.choices(words, k=6)),
+            "status": rng.choice(["active", "active", "someday"]),
+            "position": i,
+            "id": i + 1,
+            "createdAt": "2024-01-01T09:00:00.000000",
+            "version": 1,
+        }
+        for i in range(project_count)
+    ]
+    items = []
+    for i in range(item_count):
+        project_id = rng.randint(1, project_count) if rng.random() < 0.4 else None
+        items.append(
+            {
+                "title": " ".join(rng.choices(words, k=rng.randint(2, 8))),
+                "notes": " ".join(rng.choices(words, k=30)) if i % 3 == 0 else None,
+                "status": "projects" if project_id else rng.choice(["inbox", "next"]),
+                "projectId": project_id,
+                "startTime": None,
+                "dueDatetime": "2024-06-01T10:00" if i % 10 == 0 else None,
+                "position": i,
+                "done": rng.random() < 0.3,
+                "id": i + 1,
+                "createdAt": "2024-01-01T09:00:00.000000",
+                "version": 1,
+            }
+        )
+    return {
+        "projects": projects,
+        "items": items,
+        "nextProjectId": project_count + 1,
+        "nextItemId": item_count + 1,
+        "version": 1,
+    }
+
+
+def best_time(func, repeat):
+    """Return the fastest of repeat timed calls of func, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def serializer_formats():
+    """Return (name, dump, parse) for each on-disk encoding to compare"""
+    formats = [
+        (
+            "json indent=2",
+            lambda data: json.dumps(data, indent=2).encode("utf-8"),
+            json.loads,
+        ),
+        (
+            "json compact",
+            lambda data: json.dumps(data, separators=(",", ":")).encode("utf-8"),
+            json.loads,
+        ),
+    ]
+    if wsgi.orjson is not None:
+        formats.append(("orjson", wsgi.orjson.dumps, wsgi.orjson.loads))
+    formats.append(
+        (
+            "binary snapshot",
+            lambda data: wsgi.encode_snapshot(data, "binary"),
+            wsgi.decode_snapshot,
+        )
+    )
+    return formats
+
+
+def bench_serializers(args):
+    results = []
+    for item_count in args.items:
+        data = make_dataset(item_count)
+        for name, dump, parse in serializer_formats():
+            raw = dump(data)
+            assert parse(raw) == data
+            results.append(
+                {
+                    "items": item_count,
+                    "format": name,
+                    "bytes": len(raw),
+                    "dumpMs": best_time(lambda: dump(data), args.repeat) * 1000,
+                    "parseMs": best_time(lambda: parse(raw), args.repeat) * 1000,
+                }
+            )
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    print(f"{'items':>7}  {'format':<16}{'bytes':>12}{'dump ms':>10}{'parse ms':>10}")
+    for r in results:
+        print(
+            f"{r['items']:>7}  {r['format']:<16}{r['bytes']:>12}"
+            f"{r['dumpMs']:>10.2f}{r['parseMs']:>10.2f}"
+        )
+
+
+# Relative weights of the request types in each mix
+MIXES = {
+    "default": {
+        "check-session": 15,
+        "get-data": 5,
+        "capture": 30,
+        "toggle-done": 30,
+        "reorder": 15,
+        "login": 1,
+    },
+    "read-heavy": {
+        "check-session": 30,
+        "get-data": 40,
+        "capture": 10,
+        "toggle-done": 20,
+    },
+    "write-heavy": {"capture": 45, "toggle-done": 35, "reorder": 20},
+}
+
+
+class AppClient:
+    """Calls the WSGI application in-process with synthetic environs"""
+
+    def __init__(self, app, cookie=""):
+        self.app = app
+        self.cookie = cookie
+
+    def call(self, method, path, body=None, query=""):
+        raw = json.dumps(body).encode("utf-8") if body is not None else b""
+        environ = {
+            "REQUEST_METHOD": method,
+            "PATH_INFO": path,
+            "QUERY_STRING": query,
+            "CONTENT_LENGTH": str(len(raw)),
+            "wsgi.input": io.BytesIO(raw),
+            "HTTP_COOKIE": self.cookie,
+            "HTTP_ACCEPT_ENCODING": "",
+            "REMOTE_ADDR": "127.0.0.1",
+        }
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+
+        body = b"".join(self.app(environ, start_response))
+        for name, value in response["headers"]:
+            if name == "Set-Cookie":
+                self.cookie = value.split(";")[0]
+        return response["status"], body
+
+
+class Workload:
+    """Generates the requests of a mix against one benchmark user"""
+
+    def __init__(self, client, item_ids, seed):
+        self.client = client
+        self.item_ids = item_ids
+        self.rng = random.Random(seed)
+
+    def run(self, kind):
+        return getattr(self, kind.replace("-", "_"))()
+
+    def check_session(self):
+        return self.client.call("GET", "/api/check-session")
+
+    def get_data(self):
+        return self.client.call("GET", "/api/data")
+
+    def capture(self):
+        body = {"title": f"Captured {self.rng.randint(0, 10**6)}", "status": "inbox"}
+        status, response = self.client.call("POST", "/api/items", body)
+        self.item_ids.append(json.loads(response)["id"])
+        return status, response
+
+    def toggle_done(self):
+        item_id = self.rng.choice(self.item_ids)
+        body = {"done": self.rng.random() < 0.5}
+        return self.client.call("PUT", f"/api/items/{item_id}", body)
+
+    def reorder(self):
+        ids = self.rng.sample(self.item_ids, min(20, len(self.item_ids)))
+        updates = [{"id": item_id, "position": n} for n, item_id in enumerate(ids)]
+        return self.client.call("PUT", "/api/items/batch", updates)
+
+    def login(self):
+        body = {"username": "bench", "password": "bench"}
+        return AppClient(self.client.app).call("POST", "/api/login", body)
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(fraction * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def setup_app_benchmark(args):
+    """Create a throwaway data directory with one seeded benchmark user"""
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix="gtd-bench-")
+    shutil.copy(os.path.join(source_dir, "index.html"), work_dir)
+    os.chdir(work_dir)
+    # Module state was created relative to the old directory, and logins
+    # must not be throttled
+    wsgi.storage = wsgi.create_storage()
+    wsgi.login_throttle = wsgi.LoginThrottle(user_limit=10**9, ip_limit=10**9)
+    users = {
+        "admin": {"password": wsgi.hash_password("admin"), "isAdmin": True},
+        "bench": {"password": wsgi.hash_password("bench"), "isAdmin": False},
+    }
+    wsgi.save_users(users)
+    data = make_dataset(args.items, args.projects)
+    wsgi.storage.save_data("bench", data)
+    return work_dir, [item["id"] for item in data["items"]]
+
+
+def bench_app(args):
+    mix = MIXES[args.mix]
+    work_dir, item_ids = setup_app_benchmark(args)
+    latencies = {kind: [] for kind in mix}
+    errors = {kind: 0 for kind in mix}
+    lock = threading.Lock()
+
+    def worker(n):
+        client = AppClient(wsgi.application)
+        client.call("POST", "/api/login", {"username": "bench", "password": "bench"})
+        workload = Workload(client, item_ids, seed=n)
+        kinds = workload.rng.choices(list(mix), list(mix.values()), k=per_thread)
+        for kind in kinds:
+            start = time.perf_counter()
+            status, _ = workload.run(kind)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies[kind].append(elapsed)
+                if not status.startswith("2"):
+                    errors[kind] += 1
+
+    per_thread = max(1, args.requests // args.threads)
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - started
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    tracemalloc.stop()
+    if hasattr(wsgi.storage, "flush"):
+        wsgi.storage.flush()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    total = sum(len(v) for v in latencies.values())
+    endpoints = {}
+    for kind, values in latencies.items():
+        values.sort()
+        endpoints[kind] = {
+            "requests": len(values),
+            "errors": errors[kind],
+            "meanMs": sum(values) / len(values) * 1000 if values else 0.0,
+            "p50Ms": percentile(values, 0.50) * 1000,
+            "p95Ms": percentile(values, 0.95) * 1000,
+            "p99Ms": percentile(values, 0.99) * 1000,
+            "maxMs": values[-1] * 1000 if values else 0.0,
+        }
+    result = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "storage": wsgi.STORAGE_BACKEND,
+            "writeMode": wsgi.WRITE_MODE,
+            "items": args.items,
+            "projects": args.projects,
+            "mix": args.mix,
+            "threads": args.threads,
+        },
+        "requests": total,
+        "seconds": wall_seconds,
+        "throughput": total / wall_seconds,
+        "endpoints": endpoints,
+        "peakRssKb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "tracedPeakBytes": traced_peak,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    print_app_result(result)
+
+
+def print_app_result(result):
+    meta = result["meta"]
+    print(
+        f"{meta['items']} items, {meta['mix']} mix, {meta['threads']} thread(s),"
+        f" {meta['storage']}/{meta['writeMode']}: {result['requests']} requests"
+        f" in {result['seconds']:.2f}s = {result['throughput']:.0f} req/s"
+    )
+    print(f"{'endpoint':<15}{'n':>7}{'err':>5}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for kind, e in result["endpoints"].items():
+        print(
+            f"{kind:<15}{e['requests']:>7}{e['errors']:>5}"
+            f"{e['p50Ms']:>9.2f}{e['p95Ms']:>9.2f}{e['p99Ms']:>9.2f}"
+        )
+    print(f"peak RSS {result['peakRssKb'] / 1024:.1f} MiB", end="")
+    if result["tracedPeakBytes"] is not None:
+        print(f", traced peak {result['tracedPeakBytes'] / 2**20:.1f} MiB", end="")
+    print()
+
+
+def bench_compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    def change(old, new):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    print(f"{before['meta']['commit']} -> {after['meta']['commit']}")
+    print(
+        f"throughput {before['throughput']:.0f} -> {after['throughput']:.0f} req/s"
+        f" ({change(before['throughput'], after['throughput'])})"
+    )
+    for kind, new in after["endpoints"].items():
+        old = before["endpoints"].get(kind)
+        if old is None:
+            continue
+        print(
+            f"{kind:<15} p50 {old['p50Ms']:.2f} -> {new['p50Ms']:.2f} ms"
+            f" ({change(old['p50Ms'], new['p50Ms'])}),"
+            f" p99 {old['p99Ms']:.2f} -> {new['p99Ms']:.2f} ms"
+            f" ({change(old['p99Ms'], new['p99Ms'])})"
+        )
+
+
+def int_list(text):
+    return [int(n) for n in text.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    serializers = subparsers.add_parser(
+        "serializers", help="compare dataset encodings for size and speed"
+    )
+    serializers.add_argument("--items", type=int_list, default="100,1000,10000,50000")
+    serializers.add_argument("--repeat", type=int, default=5)
+    serializers.add_argument("--json", action="store_true", help="print JSON")
+    serializers.set_defaults(run=bench_serializers)
+
+    app = subparsers.add_parser(
+        "app", help="drive wsgi.application with a mix of API requests"
+    )
+    app.add_argument("--items", type=int, default=1000)
+    app.add_argument("--projects", type=int, default=None)
+    app.add_argument("--requests", type=int, default=2000)
+    app.add_argument("--threads", type=int, default=1)
+    app.add_argument("--mix", choices=sorted(MIXES), default="default")
+    app.add_argument("--trace-memory", action="store_true", help="use tracemalloc")
+    app.add_argument("--json", metavar="PATH", help="also write results as JSON")
+    app.set_defaults(run=bench_app)
+
+    compare = subparsers.add_parser(
+        "compare", help="compare two JSON results of the app benchmark"
+    )
+    compare.add_argument("before")
+    compare.add_argument("after")
+    compare.set_defaults(run=bench_compare)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,509 @@
+"""Requests through wsgi.application, as a browser would send them"""
+
+import asyncio
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wsgi  # noqa: E402
+
+
+class Client:
+    """Calls wsgi.application with one user's session cookie"""
+
+    def __init__(self):
+        self.cookie = ""
+
+    def call(self, method, path, body=None, query="", headers=None):
+        """Return (status code, headers, body) of one request.
+
+        body is sent as JSON unless it is bytes. A JSON response body is
+        returned parsed.
+        """
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        body = body or b""
+        environ = {
+            "REQUEST_METHOD": method,
+            "PATH_INFO": path,
+            "QUERY_STRING": query,
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": io.BytesIO(body),
+            "REMOTE_ADDR": "127.0.0.1",
+            "HTTP_COOKIE": self.cookie,
+        }
+        environ.update(headers or {})
+        started = []
+        chunks = wsgi.application(environ, lambda *args: started.extend(args))
+        content = b"".join(chunks)
+        status, response_headers = int(started[0].split()[0]), started[1]
+        for name, value in response_headers:
+            if name.lower() == "set-cookie":
+                self.cookie = value.split(";")[0]
+        fields = {}
+        for name, value in response_headers:
+            name = name.lower()
+            fields[name] = f"{fields[name]}, {value}" if name in fields else value
+        if fields.get("content-type", "").startswith("application/json") and content:
+            content = json.loads(content)
+        return status, fields, content
+
+    def login(self, username="admin", password="admin"):
+        status, _, result = self.call(
+            "POST", "/api/login", {"username": username, "password": password}
+        )
+        assert status == 200 and result["success"], result
+        return self
+
+
+class AppTestCase(unittest.TestCase):
+    """Runs each test in a fresh data directory, logged in as admin"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        # Cached files are keyed by their relative paths
+        for value in vars(wsgi).values():
+            if isinstance(value, wsgi.FileCache):
+                with value.lock:
+                    value.entries.clear()
+                    value.total_bytes = 0
+        wsgi.search_indexes.clear()
+        for username in list(wsgi.events.newest):
+            wsgi.events.forget(username)
+        wsgi.storage = wsgi.create_storage()
+        # No background archive passes, which would outlive the directory
+        wsgi.ARCHIVE_AFTER_DAYS = 0
+        wsgi.login_throttle = wsgi.LoginThrottle()
+        self.admin = Client().login()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def create_user(self, username, password="secret"):
+        """Create a user and return a Client logged in as them"""
+        status, _, result = self.admin.call(
+            "POST", "/api/admin/create-user", {"username": username}
+        )
+        self.assertTrue(result["success"], result)
+        client = Client()
+        status, _, result = client.call(
+            "POST", "/api/set-password", {"username": username, "password": password}
+        )
+        self.assertTrue(result["success"], result)
+        return client
+
+
+class RoutingTest(AppTestCase):
+    def test_unknown_routes_are_404s(self):
+        for method, path in [
+            ("GET", "/api/nothing"),
+            ("DELETE", "/api/data"),
+            ("PUT", "/api/items/abc"),
+            ("PUT", "/api/items/1/2"),
+        ]:
+            with self.subTest(method=method, path=path):
+                self.assertEqual(self.admin.call(method, path)[0], 404)
+
+    def test_id_parameters(self):
+        self.admin.call("POST", "/api/items", {"title": "One"})
+        status, _, item = self.admin.call("PUT", "/api/items/1", {"done": True})
+        self.assertEqual((status, item["id"], item["done"]), (200, 1, True))
+        self.assertEqual(self.admin.call("PUT", "/api/items/2", {})[0], 404)
+        # A static route wins over a parameterised one
+        status, _, result = self.admin.call("DELETE", "/api/items/done")
+        self.assertEqual((status, result["deleted"]), (200, 1))
+
+    def test_authentication_is_required(self):
+        for method, path in [("GET", "/api/data"), ("POST", "/api/items")]:
+            with self.subTest(method=method, path=path):
+                self.assertEqual(Client().call(method, path)[0], 401)
+        alice = self.create_user("alice")
+        self.assertEqual(alice.call("GET", "/api/admin/export")[0], 403)
+
+    def test_bad_requests(self):
+        for method, path, body, query in [
+            ("POST", "/api/items", b"{not json", ""),
+            ("POST", "/api/items/batch", [1, 2], ""),
+            ("POST", "/api/items/batch", {"title": "Not a list"}, ""),
+            ("DELETE", "/api/items/batch", [{"id": 1}], ""),
+            ("PUT", "/api/items/1/move", {"after": "1"}, ""),
+            ("GET", "/api/items", None, "limit=many"),
+            ("GET", "/api/items", None, "cursor=bogus"),
+            ("GET", "/api/items", None, "sort=title"),
+            ("GET", "/api/changes", None, ""),
+            ("GET", "/api/admin/export", None, "format=zip"),
+        ]:
+            with self.subTest(method=method, path=path, body=body, query=query):
+                status, _, result = self.admin.call(method, path, body, query)
+                self.assertEqual(status, 400)
+                self.assertIn("error", result)
+
+
+class SessionTest(AppTestCase):
+    def test_logout_ends_the_session(self):
+        self.assertEqual(self.admin.call("GET", "/api/data")[0], 200)
+        cookie = self.admin.cookie
+        self.admin.call("POST", "/api/logout")
+        self.admin.cookie = cookie
+        self.assertEqual(self.admin.call("GET", "/api/data")[0], 401)
+
+    def test_signed_sessions(self):
+        original, wsgi.SESSION_MODE = wsgi.SESSION_MODE, "signed"
+        # The key file is made in this test's directory
+        wsgi.load_secret_key.cache_clear()
+        self.addCleanup(wsgi.load_secret_key.cache_clear)
+        try:
+            client = Client().login()
+            self.assertEqual(client.call("GET", "/api/data")[0], 200)
+            cookie = client.cookie
+            name, _, token = cookie.partition("=")
+            self.assertNotIn(token, wsgi.load_sessions())
+            user_part, expires, nonce, signature = token.split(".")
+            for tampered in [
+                f"{wsgi.b64encode(b'alice')}.{expires}.{nonce}.{signature}",
+                f"{user_part}.{int(expires) + 1}.{nonce}.{signature}",
+                f"{user_part}.{expires}.{nonce}",
+            ]:
+                with self.subTest(token=tampered):
+                    client.cookie = f"{name}={tampered}"
+                    self.assertEqual(client.call("GET", "/api/data")[0], 401)
+            client.cookie = cookie
+            client.call("POST", "/api/logout")
+            client.cookie = cookie
+            self.assertEqual(client.call("GET", "/api/data")[0], 401)
+        finally:
+            wsgi.SESSION_MODE = original
+
+
+class DataETagTest(AppTestCase):
+    def test_not_modified_until_a_change(self):
+        self.admin.call("POST", "/api/items", {"title": "One"})
+        status, headers, _ = self.admin.call("GET", "/api/data")
+        etag = headers["etag"]
+        self.assertIn("Cookie", headers["vary"])
+        match = {"HTTP_IF_NONE_MATCH": etag}
+        status, headers, _ = self.admin.call("GET", "/api/data", headers=match)
+        self.assertEqual(status, 304)
+        self.assertIn("Cookie", headers["vary"])
+        self.admin.call("POST", "/api/items", {"title": "Two"})
+        self.assertEqual(self.admin.call("GET", "/api/data", headers=match)[0], 200)
+
+    def test_tags_differ_between_users(self):
+        alice, bob = self.create_user("alice"), self.create_user("bob")
+        alice.call("POST", "/api/items", {"title": "Alice's"})
+        bob.call("POST", "/api/items", {"title": "Bob's"})
+        etag = alice.call("GET", "/api/data")[1]["etag"]
+        match = {"HTTP_IF_NONE_MATCH": etag}
+        status, _, data = bob.call("GET", "/api/data", headers=match)
+        self.assertEqual(status, 200)
+        self.assertEqual([i["title"] for i in data["items"]], ["Bob's"])
+
+    def test_tags_differ_for_a_recreated_user(self):
+        alice = self.create_user("alice")
+        alice.call("POST", "/api/items", {"title": "Before"})
+        etag = alice.call("GET", "/api/data")[1]["etag"]
+        self.admin.call("POST", "/api/admin/delete-user", {"username": "alice"})
+        alice = self.create_user("alice")
+        alice.call("POST", "/api/items", {"title": "After"})
+        match = {"HTTP_IF_NONE_MATCH": etag}
+        self.assertEqual(alice.call("GET", "/api/data", headers=match)[0], 200)
+
+    def test_replace_keeps_the_tag_identity(self):
+        self.admin.call("POST", "/api/items", {"title": "One"})
+        status, headers, data = self.admin.call("GET", "/api/data")
+        data.pop("datasetId")
+        self.admin.call("POST", "/api/data", data)
+        new_etag = self.admin.call("GET", "/api/data")[1]["etag"]
+        self.assertEqual(new_etag.split("-")[0], headers["etag"].split("-")[0])
+        self.assertNotEqual(new_etag, headers["etag"])
+
+
+class ItemQueryTest(AppTestCase):
+    def test_positions_of_any_type_sort(self):
+        items = [{"title": str(n), "position": n} for n in (2, 1, 3)]
+        self.admin.call("POST", "/api/items/batch", items)
+        self.admin.call("PUT", "/api/items/1", {"position": "abc"})
+        self.admin.call("PUT", "/api/items/2", {"position": None})
+        self.admin.call("PUT", "/api/items/3", {"position": 0.5, "startTime": 7})
+        status, _, page = self.admin.call("GET", "/api/items", query="limit=2")
+        self.assertEqual(status, 200)
+        self.assertEqual([i["id"] for i in page["items"]], [1, 2])
+        query = "limit=2&cursor=" + page["nextCursor"]
+        page = self.admin.call("GET", "/api/items", query=query)[2]
+        self.assertEqual([i["id"] for i in page["items"]], [3])
+        self.admin.call("PUT", "/api/items/3", {"dueDatetime": "2026-01-01T09:00"})
+        self.admin.call("PUT", "/api/items/1", {"dueDatetime": "2026-01-01T09:00"})
+        query = "sort=dueDatetime"
+        page = self.admin.call("GET", "/api/items", query=query)[2]
+        self.assertEqual([i["id"] for i in page["items"]], [1, 3])
+
+
+    def test_cursor_pages_through_every_item(self):
+        items = [{"title": str(n), "position": n % 7} for n in range(25)]
+        self.admin.call("POST", "/api/items/batch", items)
+        seen, query = [], "limit=10"
+        while True:
+            status, _, page = self.admin.call("GET", "/api/items", query=query)
+            self.assertEqual(status, 200)
+            self.assertLessEqual(len(page["items"]), 10)
+            seen += [(i["position"], i["id"]) for i in page["items"]]
+            if page["nextCursor"] is None:
+                break
+            query = "limit=10&cursor=" + page["nextCursor"]
+        self.assertEqual(seen, sorted((n % 7, n + 1) for n in range(25)))
+
+    def test_cursor_is_tied_to_its_sort(self):
+        self.admin.call("POST", "/api/items/batch", [{"title": "a"}, {"title": "b"}])
+        cursor = self.admin.call("GET", "/api/items", query="limit=1")[2]["nextCursor"]
+        query = "sort=dueDatetime&cursor=" + cursor
+        self.assertEqual(self.admin.call("GET", "/api/items", query=query)[0], 400)
+
+
+class MoveTest(AppTestCase):
+    def item_ids(self):
+        return [i["id"] for i in self.admin.call("GET", "/api/items")[2]["items"]]
+
+    def test_move_between_neighbours(self):
+        items = [{"title": str(n), "position": n} for n in range(4)]
+        self.admin.call("POST", "/api/items/batch", items)
+        move = {"after": 1, "before": 2}
+        status, _, item = self.admin.call("PUT", "/api/items/4/move", move)
+        self.assertEqual(status, 200)
+        self.assertTrue(0 < item["position"] < 1)
+        self.assertEqual(self.item_ids(), [1, 4, 2, 3])
+        self.admin.call("PUT", "/api/items/1/move", {"after": 3, "before": None})
+        self.assertEqual(self.item_ids(), [4, 2, 3, 1])
+        self.admin.call("PUT", "/api/items/3/move", {"after": None, "before": 4})
+        self.assertEqual(self.item_ids(), [3, 4, 2, 1])
+
+    def test_no_room_renumbers_the_list(self):
+        items = [{"title": str(n), "position": 5} for n in range(3)]
+        self.admin.call("POST", "/api/items/batch", items)
+        move = {"after": 1, "before": 2}
+        status, _, item = self.admin.call("PUT", "/api/items/3/move", move)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.item_ids(), [1, 3, 2])
+        items = self.admin.call("GET", "/api/items")[2]["items"]
+        positions = [i["position"] for i in items]
+        self.assertEqual(positions, sorted(set(positions)))
+
+    def test_bad_moves(self):
+        items = [{"title": str(n), "position": n} for n in range(3)]
+        self.admin.call("POST", "/api/items/batch", items)
+        move = {"after": 3, "before": 1}
+        self.assertEqual(self.admin.call("PUT", "/api/items/2/move", move)[0], 400)
+        move = {"after": 9, "before": None}
+        self.assertEqual(self.admin.call("PUT", "/api/items/2/move", move)[0], 404)
+        self.assertEqual(self.admin.call("PUT", "/api/items/9/move", {})[0], 404)
+
+
+class ChangesTest(AppTestCase):
+    def test_changes_since_a_version(self):
+        self.admin.call("POST", "/api/items/batch", [{"title": "a"}, {"title": "b"}])
+        version = self.admin.call("GET", "/api/data")[2]["version"]
+        self.admin.call("PUT", "/api/items/1", {"done": True})
+        self.admin.call("DELETE", "/api/items/2")
+        self.admin.call("POST", "/api/projects", {"name": "P"})
+        status, _, changes = self.admin.call(
+            "GET", "/api/changes", query=f"since={version}"
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(changes["version"], version + 3)
+        self.assertEqual([i["id"] for i in changes["items"]], [1])
+        self.assertEqual([p["name"] for p in changes["projects"]], ["P"])
+        self.assertEqual(changes["deleted"], {"items": [2], "projects": []})
+        query = f"since={changes['version']}"
+        changes = self.admin.call("GET", "/api/changes", query=query)[2]
+        self.assertEqual((changes["items"], changes["projects"]), ([], []))
+
+    def test_reset_when_the_changes_are_gone(self):
+        original, wsgi.TOMBSTONE_LIMIT = wsgi.TOMBSTONE_LIMIT, 1
+        try:
+            items = [{"title": "a"}, {"title": "b"}]
+            self.admin.call("POST", "/api/items/batch", items)
+            version = self.admin.call("GET", "/api/data")[2]["version"]
+            self.admin.call("DELETE", "/api/items/1")
+            self.admin.call("DELETE", "/api/items/2")
+            for since in (version, version + 10):
+                with self.subTest(since=since):
+                    query = f"since={since}"
+                    changes = self.admin.call("GET", "/api/changes", query=query)[2]
+                    self.assertEqual(changes, {"version": version + 2, "reset": True})
+        finally:
+            wsgi.TOMBSTONE_LIMIT = original
+
+
+class EventsTest(AppTestCase):
+    def test_stream_is_off_under_wsgi_by_default(self):
+        self.assertEqual(self.admin.call("GET", "/api/events")[0], 204)
+        status, _, session = self.admin.call("GET", "/api/check-session")
+        self.assertFalse(session["liveUpdates"])
+
+    def test_events_are_small_and_only_kept_for_listeners(self):
+        items = [{"title": "x" * 1000} for _ in range(50)]
+        self.admin.call("POST", "/api/items/batch", items)
+        self.assertNotIn("admin", wsgi.events.buffers)
+        subscription = wsgi.events.subscribe("admin")
+        try:
+            self.admin.call("POST", "/api/items/batch", items)
+            (message,) = subscription.take()
+            lines = message.decode("utf-8").splitlines()
+            self.assertEqual(lines[:2], ["id: 2", "event: change"])
+            payload = json.loads(lines[2].removeprefix("data: "))
+            self.assertEqual(payload["op"], "add_items")
+            self.assertEqual(payload["ids"], list(range(51, 101)))
+            self.assertLess(len(message), 1000)
+        finally:
+            subscription.close()
+        self.assertNotIn("admin", wsgi.events.buffers)
+
+    def test_reconnect_after_missed_events_resets(self):
+        self.admin.call("POST", "/api/items", {"title": "Seen"})
+        self.admin.call("POST", "/api/items", {"title": "Missed"})
+        subscription = wsgi.events.subscribe("admin", last_event_id="1")
+        try:
+            (message,) = subscription.take()
+            self.assertIn(b"event: reset", message)
+        finally:
+            subscription.close()
+
+
+def ndjson(*records):
+    header = {"type": "header", "format": "gtd-export", "version": 1}
+    return b"".join(json.dumps(r).encode("utf-8") + b"\n" for r in (header,) + records)
+
+
+class ImportTest(AppTestCase):
+    def import_lines(self, body, query=""):
+        status, _, content = self.admin.call(
+            "POST", "/api/admin/import", body, query=query
+        )
+        self.assertEqual(status, 200)
+        return [json.loads(line) for line in content.splitlines()]
+
+    def test_invalid_account_is_rejected(self):
+        for account in ("oops", {"isAdmin": True}, {"password": 5}):
+            with self.subTest(account=account):
+                user = {"type": "user", "username": "mallory", "record": account}
+                lines = self.import_lines(ndjson(user))
+                self.assertEqual(lines[-1]["type"], "error")
+                self.assertNotIn("mallory", wsgi.load_users())
+        # Logins still work
+        Client().login()
+
+    def test_invalid_dataset_record_is_rejected(self):
+        user = {"type": "user", "username": "bob", "record": None}
+        for dataset in ({}, {"nextItemId": "5", "nextProjectId": 1}):
+            with self.subTest(dataset=dataset):
+                dataset = dict(dataset, type="dataset", username="bob")
+                lines = self.import_lines(ndjson(user, dataset))
+                self.assertEqual(lines[-1]["type"], "error")
+                self.assertIn("positive integer", lines[-1]["message"])
+
+    def test_not_an_export_is_a_400(self):
+        status = self.admin.call("POST", "/api/admin/import", b"[]\n")[0]
+        self.assertEqual(status, 400)
+
+    def test_round_trip(self):
+        alice = self.create_user("alice")
+        alice.call("POST", "/api/projects", {"name": "Home"})
+        items = [{"title": "Sweep", "projectId": 1}, {"title": "Call mum"}]
+        alice.call("POST", "/api/items/batch", items)
+        alice.call("PUT", "/api/items/2", {"done": True})
+        expected = alice.call("GET", "/api/data")[2]
+        for export_format in ("ndjson", "tar"):
+            with self.subTest(format=export_format):
+                query = f"format={export_format}"
+                status, headers, export = self.admin.call(
+                    "GET", "/api/admin/export", query=query
+                )
+                self.assertEqual(status, 200)
+                self.assertIn("attachment", headers["content-disposition"])
+                self.admin.call(
+                    "POST", "/api/admin/delete-user", {"username": "alice"}
+                )
+                lines = self.import_lines(export, query)
+                self.assertEqual(lines[-1]["type"], "done", lines)
+                self.assertEqual(lines[-1]["createdUsers"], 1)
+                # alice logs in with the password she had
+                data = Client().login("alice", "secret").call("GET", "/api/data")[2]
+                for kind in ("items", "projects"):
+                    self.assertEqual(
+                        [(r["id"], r.get("title"), r.get("done")) for r in data[kind]],
+                        [
+                            (r["id"], r.get("title"), r.get("done"))
+                            for r in expected[kind]
+                        ],
+                    )
+                self.assertEqual(data["nextItemId"], expected["nextItemId"])
+
+    def test_asgi_import_is_read_as_it_arrives(self):
+        user = {"type": "user", "username": "bob", "record": None}
+        dataset = {"type": "dataset", "username": "bob"}
+        dataset.update(nextItemId=1, nextProjectId=1)
+        body = ndjson(user, dataset)
+        messages = [
+            {"type": "http.request", "body": line, "more_body": True}
+            for line in body.splitlines(keepends=True)
+        ]
+        messages.append({"type": "http.request", "body": b"", "more_body": False})
+        unread_at_start = []
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                unread_at_start.append(len(messages))
+            sent.append(message.get("body", b""))
+
+        scope = {
+            "type": "http",
+            "method": "POST",
+            "path": "/api/admin/import",
+            "headers": [
+                (b"cookie", self.admin.cookie.encode("latin-1")),
+                (b"content-length", str(len(body)).encode("latin-1")),
+            ],
+        }
+        asyncio.run(wsgi.asgi_application(scope, receive, send))
+        self.assertGreater(unread_at_start[0], 0)
+        self.assertEqual(json.loads(b"".join(sent).splitlines()[-1])["type"], "done")
+        self.assertIn("bob", wsgi.load_users())
+
+
+class BodyLimitTest(AppTestCase):
+    def test_large_bodies_are_refused(self):
+        original, wsgi.MAX_BODY_BYTES = wsgi.MAX_BODY_BYTES, 100
+        try:
+            item = {"title": "x" * 200}
+            status, _, result = self.admin.call("POST", "/api/items", item)
+            self.assertEqual(status, 413)
+
+            async def receive():
+                body = json.dumps(item).encode("utf-8")
+                return {"type": "http.request", "body": body, "more_body": False}
+
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {"type": "http", "method": "POST", "path": "/api/items"}
+            asyncio.run(wsgi.asgi_application(scope, receive, send))
+            self.assertEqual(sent[0]["status"], 413)
+        finally:
+            wsgi.MAX_BODY_BYTES = original
+
+
+if __name__ == "__main__":
+    unittest.main()
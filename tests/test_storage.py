@@ -0,0 +1,207 @@
+"""The same change records applied through each storage backend"""
+
+import copy
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wsgi  # noqa: E402
+
+USER = "alice"
+
+DONE_AT = "2020-01-02T03:04:05"
+
+CHANGES = [
+    {"op": "add_project", "project": {"id": None, "name": "Garden", "position": 0}},
+    {
+        "op": "add_projects",
+        "projects": [
+            {"id": None, "name": "House", "position": 1},
+            {"id": None, "name": "Car", "position": 2},
+        ],
+    },
+    {"op": "add_item", "item": {"id": None, "title": "Buy milk", "status": "inbox"}},
+    {
+        "op": "add_items",
+        "items": [
+            {"id": None, "title": f"Task {n}", "status": "next", "projectId": n % 3}
+            for n in range(1, 7)
+        ],
+    },
+    {"op": "update_item", "id": 1, "updates": {"title": "Buy oat milk"}},
+    {"op": "update_item", "id": 2, "updates": {"done": True, "doneAt": DONE_AT}},
+    {
+        "op": "update_items",
+        "updates": [
+            {"id": 3, "done": True, "doneAt": DONE_AT},
+            {"id": 4, "done": True, "doneAt": DONE_AT},
+            {"id": 5, "position": 1.5},
+            {"id": 99, "title": "Missing"},
+        ],
+    },
+    {"op": "update_project", "id": 1, "updates": {"outcome": "Weeded"}},
+    {"op": "update_projects", "updates": [{"id": 2, "status": "someday"}]},
+    {"op": "delete_item", "id": 6},
+    {"op": "delete_project", "id": 2},
+    {"op": "archive_items", "ids": [2, 5]},
+    {"op": "update_item", "id": 4, "updates": {"done": False}},
+    {"op": "delete_done_items"},
+    {"op": "delete_items", "ids": [7, 99]},
+    {"op": "delete_projects", "ids": [3]},
+    {"op": "reserve_ids", "nextItemId": 20, "nextProjectId": 2},
+    {"op": "add_item", "item": {"id": None, "title": "After reserve"}},
+]
+
+
+def normalize(storage):
+    """The parts of a user's dataset every backend must agree on"""
+    data = storage.load_data(USER)
+    deleted = storage.changes(USER, 0)["deleted"]
+
+    def by_id(records):
+        return sorted(records, key=lambda r: r["id"])
+
+    return {
+        "items": by_id(data["items"]),
+        "projects": by_id(data["projects"]),
+        "nextItemId": data["nextItemId"],
+        "nextProjectId": data["nextProjectId"],
+        "version": data["version"],
+        "deleted": deleted,
+    }
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        wsgi.data_cache.invalidate(wsgi.get_data_file(USER))
+
+    def tearDown(self):
+        wsgi.data_cache.invalidate(wsgi.get_data_file(USER))
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def run_changes(self, storage, changes=CHANGES):
+        results = [storage.apply(USER, copy.deepcopy(c)) for c in changes]
+        return results, normalize(storage)
+
+    def backends(self):
+        yield "json", wsgi.JsonStorage(journal=False)
+        yield "journal", wsgi.JsonStorage(journal=True)
+        yield "sqlite", wsgi.SqliteStorage(os.path.join(self.tmp.name, "gtd.sqlite3"))
+
+
+class BackendEquivalenceTest(StorageTestCase):
+    def test_backends_agree(self):
+        outcomes = {}
+        for name, storage in self.backends():
+            wsgi.data_cache.invalidate(wsgi.get_data_file(USER))
+            for path in (wsgi.get_data_file(USER), wsgi.get_journal_file(USER)):
+                if os.path.exists(path):
+                    os.remove(path)
+            results, data = self.run_changes(storage)
+            counts = [r for r in results if isinstance(r, (bool, int))]
+            outcomes[name] = (counts, data)
+        for name in ("journal", "sqlite"):
+            with self.subTest(backend=name):
+                self.assertEqual(outcomes[name][0], outcomes["json"][0])
+                self.assertEqual(outcomes[name][1], outcomes["json"][1])
+
+    def test_expected_dataset(self):
+        _, data = self.run_changes(wsgi.JsonStorage(journal=False))
+        self.assertEqual([i["id"] for i in data["items"]], [1, 4, 5, 20])
+        self.assertEqual([p["id"] for p in data["projects"]], [1])
+        self.assertEqual(data["nextItemId"], 21)
+        self.assertEqual(data["nextProjectId"], 4)
+        self.assertIsNone(data["items"][1]["doneAt"])
+
+    def test_each_op_is_covered(self):
+        self.assertEqual({c["op"] for c in CHANGES}, set(wsgi.CHANGE_HANDLERS))
+
+
+class FailedWriteTest(StorageTestCase):
+    def test_failed_write_leaves_no_change_cached(self):
+        for name, storage in self.backends():
+            if name == "sqlite":
+                continue
+            with self.subTest(backend=name):
+                storage.add_item(USER, {"id": None, "title": "Saved"})
+                write = wsgi.write_json_file_atomic
+                append = wsgi.append_journal
+
+                def fail(*args):
+                    raise OSError("disk full")
+
+                wsgi.write_json_file_atomic = wsgi.append_journal = fail
+                try:
+                    with self.assertRaises(OSError):
+                        storage.add_item(USER, {"id": None, "title": "Lost"})
+                finally:
+                    wsgi.write_json_file_atomic = write
+                    wsgi.append_journal = append
+                titles = [i["title"] for i in storage.load_data(USER)["items"]]
+                self.assertEqual(titles, ["Saved"])
+                storage.delete_data(USER)
+
+
+class JournalReplayTest(StorageTestCase):
+    def test_reload_replays_journal(self):
+        storage = wsgi.JsonStorage(journal=True)
+        _, data = self.run_changes(storage)
+        wsgi.data_cache.invalidate(wsgi.get_data_file(USER))
+        self.assertEqual(normalize(storage), data)
+
+    def test_stale_journal_after_snapshot(self):
+        # A crash between writing the snapshot and removing the journal
+        # leaves both; replaying the journal on the snapshot changes nothing
+        storage = wsgi.JsonStorage(journal=True)
+        _, data = self.run_changes(storage)
+        wsgi.write_json_file_atomic(wsgi.get_data_file(USER), storage.load_data(USER))
+        wsgi.data_cache.invalidate(wsgi.get_data_file(USER))
+        self.assertTrue(os.path.exists(wsgi.get_journal_file(USER)))
+        self.assertEqual(normalize(storage), data)
+
+    def test_stale_journal_from_midway(self):
+        # Snapshot taken partway through, journal still holding every record
+        storage = wsgi.JsonStorage(journal=True)
+        half = len(CHANGES) // 2
+        self.run_changes(storage, CHANGES[:half])
+        snapshot = copy.deepcopy(dict(storage.load_data(USER)))
+        _, data = self.run_changes(storage, CHANGES[half:])
+        wsgi.write_json_file_atomic(wsgi.get_data_file(USER), snapshot)
+        wsgi.data_cache.invalidate(wsgi.get_data_file(USER))
+        self.assertEqual(normalize(storage), data)
+
+    def test_replayed_selections_stay_pinned(self):
+        # delete_done_items and archive_items replayed after another item was
+        # done must not remove it
+        storage = wsgi.JsonStorage(journal=True)
+        storage.add_items(USER, [{"id": None, "title": "A"}, {"id": None}])
+        storage.update_item(USER, 1, {"done": True, "doneAt": DONE_AT})
+        storage.delete_done_items(USER)
+        storage.update_item(USER, 2, {"done": True, "doneAt": DONE_AT})
+        storage.apply(USER, {"op": "archive_items", "ids": [2]})
+        storage.add_item(USER, {"id": None, "title": "C"})
+        storage.update_item(USER, 3, {"done": True, "doneAt": DONE_AT})
+        data = storage.load_data(USER)
+        for record in wsgi.read_journal(wsgi.get_journal_file(USER)):
+            if record["op"] in ("delete_done_items", "archive_items"):
+                self.assertEqual(wsgi.apply_change(data, record), 0)
+        self.assertEqual([i["id"] for i in data["items"]], [3])
+
+    def test_compaction_keeps_dataset(self):
+        storage = wsgi.JsonStorage(journal=True)
+        _, data = self.run_changes(storage)
+        storage.compact(USER)
+        self.assertFalse(os.path.exists(wsgi.get_journal_file(USER)))
+        wsgi.data_cache.invalidate(wsgi.get_data_file(USER))
+        self.assertEqual(normalize(storage), data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,16 +1,126 @@
 #!/usr/bin/env python3
 """WSGI adapter for PythonAnywhere deployment"""
 
+import asyncio
+import io
 import json
+import math
 import os
+import re
 import hashlib
-from datetime import datetime
-from urllib.parse import urlparse, parse_qs
+import hmac
+import base64
+import bisect
+import functools
+import heapq
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs, unquote
+from http import HTTPStatus
 from http.cookies import SimpleCookie
 import secrets
+import sqlite3
+import tarfile
+import tempfile
+import atexit
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks only cover threads in one process
+    fcntl = None
+try:
+    import orjson
+except ImportError:  # Encode and decode with the json module
+    orjson = None
+try:
+    import brotli
+except ImportError:  # Responses are only gzip-compressed
+    brotli = None
 
 USERS_FILE = "users.json"
 SESSIONS_FILE = "sessions.json"
+# "file": random session ids stored in sessions.json; "signed": stateless
+# HMAC-signed tokens carrying the username and expiry
+SESSION_MODE = os.environ.get("GTD_SESSION_MODE", "file")
+SESSION_MAX_AGE = 86400  # 24 hours
+SECRET_KEY_FILE = "secret_key"
+REVOKED_SESSIONS_FILE = "revoked_sessions.json"
+STORAGE_BACKEND = os.environ.get("GTD_STORAGE", "json")
+SQLITE_FILE = os.environ.get("GTD_SQLITE_FILE", "gtd.sqlite3")
+JSON_JOURNAL = os.environ.get("GTD_JSON_JOURNAL", "1") != "0"
+JOURNAL_COMPACT_BYTES = int(os.environ.get("GTD_JOURNAL_COMPACT_BYTES", "262144"))
+TOMBSTONE_LIMIT = int(os.environ.get("GTD_TOMBSTONE_LIMIT", "1000"))
+# "immediate": write every change before responding; "strict": also fsync it;
+# "write-behind": keep changes in memory and flush them in the background
+WRITE_MODE = os.environ.get("GTD_WRITE_MODE", "immediate")
+WRITE_BEHIND_DELAY = float(os.environ.get("GTD_WRITE_BEHIND_DELAY", "2.0"))
+WRITE_BEHIND_MAX_CHANGES = int(os.environ.get("GTD_WRITE_BEHIND_MAX_CHANGES", "100"))
+FSYNC = WRITE_MODE == "strict"
+# "json": compact JSON files; "binary": zlib-compressed JSON behind a magic
+# header. Files in either format, or pretty-printed, are read back
+SNAPSHOT_FORMAT = os.environ.get("GTD_SNAPSHOT_FORMAT", "json")
+SNAPSHOT_MAGIC = b"\x00GTDZ1\n"  # can never start a JSON text
+
+# Content codings offered to clients, most preferred first
+COMPRESSIONS = ("br", "gzip") if brotli else ("gzip",)
+COMPRESS_MIN_BYTES = int(os.environ.get("GTD_COMPRESS_MIN_BYTES", "1024"))
+# Responses with more records than this are streamed in batches of this size
+STREAM_BATCH_RECORDS = int(os.environ.get("GTD_STREAM_BATCH_RECORDS", "1000"))
+
+# Password hashing runs on this many threads, with at most HASH_QUEUE_LIMIT
+# more hashes waiting; further logins are refused with 503
+HASH_WORKERS = int(os.environ.get("GTD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_QUEUE_LIMIT = int(os.environ.get("GTD_HASH_QUEUE_LIMIT", "16"))
+# Login attempts allowed per username and per client IP in the window; 0
+# turns a limit off. The IP limit is off by default: behind a reverse proxy
+# every client has the proxy's address unless CLIENT_IP_HEADER is set
+LOGIN_WINDOW_SECONDS = int(os.environ.get("GTD_LOGIN_WINDOW_SECONDS", "60"))
+LOGIN_USER_LIMIT = int(os.environ.get("GTD_LOGIN_USER_LIMIT", "10"))
+LOGIN_IP_LIMIT = int(os.environ.get("GTD_LOGIN_IP_LIMIT", "0"))
+# Request header a trusted reverse proxy puts the client IP in, e.g.
+# X-Real-IP or X-Forwarded-For (its last address is used); empty to use the
+# connection's address
+CLIENT_IP_HEADER = os.environ.get("GTD_CLIENT_IP_HEADER", "")
+# Default and largest page size of GET /api/items
+ITEM_PAGE_SIZE = int(os.environ.get("GTD_ITEM_PAGE_SIZE", "100"))
+ITEM_PAGE_MAX = int(os.environ.get("GTD_ITEM_PAGE_MAX", "1000"))
+# Items done longer than this many days move to the user's archive; 0 keeps
+# them in the working dataset. Each process checks a user at most once an
+# ARCHIVE_INTERVAL_SECONDS
+ARCHIVE_AFTER_DAYS = float(os.environ.get("GTD_ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get("GTD_ARCHIVE_INTERVAL_SECONDS", "3600"))
+# Moves put a record halfway between its neighbours; once a gap is narrower
+# than this, the list is renumbered in the background
+POSITION_MIN_GAP = float(os.environ.get("GTD_POSITION_MIN_GAP", "1e-6"))
+# Change events kept per user for clients reconnecting to GET /api/events,
+# and seconds between heartbeats on an idle stream. Each stream served by the
+# WSGI application holds a worker thread, so the WSGI application refuses
+# them unless EVENTS_STREAM_SECONDS is set; they then end after that long to
+# free their thread, and clients reconnect. asgi_application always serves
+# them, without a thread each
+EVENTS_BUFFER = int(os.environ.get("GTD_EVENTS_BUFFER", "100"))
+EVENTS_HEARTBEAT_SECONDS = float(os.environ.get("GTD_EVENTS_HEARTBEAT_SECONDS", "15"))
+EVENTS_STREAM_SECONDS = float(os.environ.get("GTD_EVENTS_STREAM_SECONDS", "0"))
+# Imports write this many projects or items per change
+IMPORT_BATCH_RECORDS = int(os.environ.get("GTD_IMPORT_BATCH_RECORDS", "1000"))
+# Larger request bodies are refused with a 413. Imports are streamed rather
+# than read whole, so they may be any size
+MAX_BODY_BYTES = int(os.environ.get("GTD_MAX_BODY_BYTES", str(16 * 1024 * 1024)))
+# Search indexes are saved after this many reindexed records
+SEARCH_SAVE_CHANGES = int(os.environ.get("GTD_SEARCH_SAVE_CHANGES", "100"))
+
+# Requests taking at least this long are logged to stderr; 0 turns the log off
+SLOW_REQUEST_MS = float(os.environ.get("GTD_SLOW_REQUEST_MS", "0"))
+
+CACHE_MAX_ENTRIES = int(os.environ.get("GTD_CACHE_MAX_ENTRIES", "128"))
+CACHE_MAX_BYTES = int(os.environ.get("GTD_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
 
 
 def hash_password(password):
@@ -38,548 +148,4792 @@ def verify_password(password, hashed):
         return False
 
 
-def load_sessions():
-    if os.path.exists(SESSIONS_FILE):
-        with open(SESSIONS_FILE, "r") as f:
-            return json.load(f)
-    return {}
+def file_signature(path):
+    """Return (mtime_ns, size) for path, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
 
 
-def save_sessions(sessions):
-    with open(SESSIONS_FILE, "w") as f:
-        json.dump(sessions, f, indent=2)
+class Metrics:
+    """Counters and histograms, rendered in the Prometheus text format.
 
+    Series are keyed by metric name and a tuple of (label, value) pairs.
+    Phase timings are also added up per request in a thread-local, for the
+    slow request log.
+    """
 
-sessions = load_sessions()  # session_id -> username
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
 
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        # (name, labels) -> [count per bucket..., count above them, sum, count]
+        self.histograms = {}
+        self.local = threading.local()
 
-def load_users():
-    if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, "r") as f:
-            users = json.load(f)
-        if "admin" not in users:
-            users["admin"] = {"password": hash_password("admin"), "isAdmin": True}
-            save_users(users)
-        return users
-    default_users = {"admin": {"password": hash_password("admin"), "isAdmin": True}}
-    save_users(default_users)
-    return default_users
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
 
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        n = len(self.BUCKETS)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (n + 3)
+            histogram[bisect.bisect_left(self.BUCKETS, value)] += 1
+            histogram[n + 1] += value
+            histogram[n + 2] += 1
 
-def save_users(users):
-    with open(USERS_FILE, "w") as f:
-        json.dump(users, f, indent=2)
+    def observe_phase(self, phase, seconds):
+        self.observe("gtd_phase_duration_seconds", (("phase", phase),), seconds)
+        phases = getattr(self.local, "phases", None)
+        if phases is not None:
+            phases[phase] = phases.get(phase, 0.0) + seconds
 
+    @contextmanager
+    def phase(self, phase):
+        """Time the block as one occurrence of phase"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_phase(phase, time.perf_counter() - started)
 
-def get_data_file(username):
-    return f"data_{username}.json"
+    def timed(self, phase):
+        """Decorator timing every call of a function as phase"""
 
+        def decorate(func):
+            @functools.wraps(func)
+            def timed_func(*args, **kwargs):
+                with self.phase(phase):
+                    return func(*args, **kwargs)
 
-def load_data(username):
-    data_file = get_data_file(username)
-    if os.path.exists(data_file):
-        with open(data_file, "r") as f:
-            return json.load(f)
-    return {"projects": [], "items": [], "nextProjectId": 1, "nextItemId": 1}
+            return timed_func
 
+        return decorate
 
-def save_data(username, data):
-    data_file = get_data_file(username)
-    with open(data_file, "w") as f:
-        json.dump(data, f, indent=2)
+    def begin_request(self):
+        """Start adding up this thread's phase timings; returns their dict"""
+        self.local.phases = {}
+        return self.local.phases
 
+    def end_request(self):
+        self.local.phases = None
 
-def get_session_username(environ):
-    """Extract username from session cookie"""
-    cookie_header = environ.get("HTTP_COOKIE", "")
-    if cookie_header:
-        cookie = SimpleCookie(cookie_header)
-        if "session_id" in cookie:
-            session_id = cookie["session_id"].value
-            return sessions.get(session_id)
-    return None
+    def render(self, extra=()):
+        """Return every series as exposition text.
 
+        extra holds (name, type, value) for unlabelled values kept elsewhere.
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, list(v)) for k, v in self.histograms.items())
+        lines, typed = [], set()
 
-def get_html():
-    with open("index.html", "r", encoding="utf-8") as f:
-        return f.read()
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
 
+        for name, kind, value in extra:
+            declare(name, kind)
+            lines.append(f"{name} {value}")
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        n = len(self.BUCKETS)
+        for (name, labels), histogram in histograms:
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), histogram[: n + 1]):
+                cumulative += count
+                le = format_labels(labels + (("le", str(bound)),))
+                lines.append(f"{name}_bucket{le} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram[n + 1]}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram[n + 2]}")
+        return "\n".join(lines) + "\n"
 
-def respond_json(start_response, status, payload, extra_headers=None):
-    headers = [("Content-type", "application/json")]
-    if extra_headers:
-        headers.extend(extra_headers)
-    start_response(status, headers)
-    return [json.dumps(payload).encode("utf-8")]
 
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"'.replace("\n", "\\n"))
+    return "{" + ",".join(pairs) + "}"
 
-def respond_text(start_response, status, text):
-    headers = [("Content-type", "text/plain")]
-    start_response(status, headers)
-    return [text.encode("utf-8")]
 
+metrics = Metrics()
 
-def read_json_body(environ):
-    content_length = int(environ.get("CONTENT_LENGTH", 0))
-    body = environ["wsgi.input"].read(content_length)
-    return json.loads(body) if body else {}
 
+class FileLock:
+    """Re-entrant exclusive lock shared by threads and processes.
 
-def require_auth(environ, start_response):
-    username = get_session_username(environ)
-    if not username:
-        return "", respond_json(
-            start_response, "401 Unauthorized", {"error": "Not authenticated"}
-        )
-    return username, None
+    A threading.RLock serializes threads in this process and an advisory
+    fcntl.flock() on the lock file serializes worker processes. Waits are
+    recorded in lock_stats.
+    """
 
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.fd = None
 
-def require_admin(username, start_response):
-    users = load_users()
-    if not users.get(username, {}).get("isAdmin", False):
-        return {}, respond_json(
-            start_response, "403 Forbidden", {"error": "Admin access required"}
+    def __enter__(self):
+        start = time.perf_counter()
+        contended = not self.thread_lock.acquire(blocking=False)
+        if contended:
+            self.thread_lock.acquire()
+        if self.depth == 0 and fcntl is not None:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                contended = True
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            self.fd = fd
+        self.depth += 1
+        record_lock_wait(contended, time.perf_counter() - start)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0 and self.fd is not None:
+            os.close(self.fd)  # releases the flock
+            self.fd = None
+        self.thread_lock.release()
+
+
+lock_stats = {"acquisitions": 0, "contended": 0, "waitSeconds": 0.0}
+file_locks = {}  # lock file path -> FileLock
+file_locks_lock = threading.Lock()
+
+
+def record_lock_wait(contended, seconds):
+    with file_locks_lock:
+        lock_stats["acquisitions"] += 1
+        lock_stats["waitSeconds"] += seconds
+        if contended:
+            lock_stats["contended"] += 1
+
+
+def file_lock(path):
+    """Return the FileLock guarding read-modify-write of path"""
+    with file_locks_lock:
+        lock = file_locks.get(path)
+        if lock is None:
+            lock = file_locks[path] = FileLock(f"{path}.lock")
+        return lock
+
+
+class FileCache:
+    """LRU cache of values read from files, keyed by path.
+
+    An entry is only served while the mtime and size of every file it was
+    read from are unchanged, so writes made by another process are seen on
+    the next read. The files' total size is used as the entry's weight for
+    the byte limit. Callers that mutate a cached value must save it straight
+    away.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (signature, weight, value)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def load(self, key, read, paths=None):
+        """Return the cached value for key, calling read() on a miss.
+
+        paths lists the files the value is read from (default: just key).
+        read() may return None if there is nothing to cache.
+        """
+        paths = paths or (key,)
+        signature = tuple(file_signature(p) for p in paths)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+        value = read()
+        if value is not None:
+            self._put(key, signature, value)
+        return value
+
+    def store(self, key, value, paths=None):
+        """Record value as the current contents of key's files after a write"""
+        paths = paths or (key,)
+        self._put(key, tuple(file_signature(p) for p in paths), value)
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _put(self, key, signature, value):
+        weight = sum(s[1] for s in signature if s is not None)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if weight > self.max_bytes:
+                return
+            self.entries[key] = (signature, weight, value)
+            self.total_bytes += weight
+            while (
+                len(self.entries) > self.max_entries
+                or self.total_bytes > self.max_bytes
+            ):
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, weight, _ = self.entries.pop(key)
+        self.total_bytes -= weight
+
+
+data_cache = FileCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES)
+users_cache = FileCache(1, CACHE_MAX_BYTES)
+
+
+def cache_stats():
+    return {
+        "data": data_cache.stats(),
+        "users": users_cache.stats(),
+        "archive": archive_cache.stats(),
+    }
+
+
+class Dataset(dict):
+    """A user's dataset, carrying a DataIndex while it stays in memory"""
+
+    index = None
+
+
+def empty_data():
+    return Dataset(projects=[], items=[], nextProjectId=1, nextItemId=1, version=0)
+
+
+class DataIndex:
+    """Lookup tables over one dataset's items and projects.
+
+    Maps id -> item, id -> project, projectId -> ids of its items and
+    status -> ids of its items, and keeps the items that have a dueDatetime
+    sorted by it. The change handlers keep it up to date, so finding a
+    record is O(1) and a due date range is a bisection instead of a scan of
+    the whole list.
+    """
+
+    def __init__(self, data):
+        self.items = data["items"]
+        self.projects = data["projects"]
+        self.items_by_id = {item["id"]: item for item in self.items}
+        self.projects_by_id = {project["id"]: project for project in self.projects}
+        self.items_by_project = {}
+        self.items_by_status = {}
+        self.items_by_due = []  # sorted (dueDatetime, id)
+        for item in self.items:
+            self._link(item)
+
+    def is_current(self, data):
+        return (
+            data["items"] is self.items
+            and data["projects"] is self.projects
+            and len(self.items) == len(self.items_by_id)
+            and len(self.projects) == len(self.projects_by_id)
         )
-    return users, None
 
+    def add_item(self, item):
+        self.items_by_id[item["id"]] = item
+        self._link(item)
 
-def require_admin_user(environ, start_response):
-    username, error_response = require_auth(environ, start_response)
-    if error_response:
-        return "", {}, error_response
-    users, error_response = require_admin(username, start_response)
-    if error_response:
-        return "", {}, error_response
-    return username, users, None
+    def remove_item(self, item):
+        del self.items_by_id[item["id"]]
+        self._unlink(item)
 
+    def update_item(self, item, updates):
+        self._unlink(item)
+        item.update(updates)
+        self._link(item)
 
-def application(environ, start_response):
-    """WSGI application entry point"""
-    method = environ["REQUEST_METHOD"]
-    path = environ["PATH_INFO"]
-
-    # Handle GET requests
-    if method == "GET":
-        if path == "/":
-            status = "200 OK"
-            headers = [("Content-type", "text/html")]
-            start_response(status, headers)
-            return [get_html().encode("utf-8")]
-
-        elif path == "/api/check-session":
-            username = get_session_username(environ)
-            if username:
-                users = load_users()
-                is_admin = users.get(username, {}).get("isAdmin", False)
-                response = {
-                    "authenticated": True,
-                    "username": username,
-                    "isAdmin": is_admin,
-                }
-            else:
-                response = {"authenticated": False}
+    def project_items(self, project_id):
+        item_ids = self.items_by_project.get(project_id, ())
+        return [self.items_by_id[item_id] for item_id in item_ids]
 
-            return respond_json(start_response, "200 OK", response)
+    def status_items(self, status):
+        item_ids = self.items_by_status.get(status, ())
+        return [self.items_by_id[item_id] for item_id in item_ids]
 
-        elif path == "/api/data":
-            username, error_response = require_auth(environ, start_response)
-            if error_response:
-                return error_response
+    def due_items(self, start=None, end=None):
+        """Return the items due in [start, end), ordered by dueDatetime"""
+        due = self.items_by_due
+        lo = bisect.bisect_left(due, (start,)) if start is not None else 0
+        hi = bisect.bisect_left(due, (end,)) if end is not None else len(due)
+        return [self.items_by_id[item_id] for _, item_id in due[lo:hi]]
 
-            data = load_data(username)
-            return respond_json(start_response, "200 OK", data)
+    def _link(self, item):
+        item_id = item["id"]
+        project_id = item.get("projectId")
+        if project_id is not None:
+            self.items_by_project.setdefault(project_id, set()).add(item_id)
+        self.items_by_status.setdefault(item.get("status"), set()).add(item_id)
+        if isinstance(item.get("dueDatetime"), str):
+            bisect.insort(self.items_by_due, (item["dueDatetime"], item_id))
 
-    # Handle POST requests
-    elif method == "POST":
-        req_data = read_json_body(environ)
+    def _unlink(self, item):
+        item_id = item["id"]
+        for index, key in (
+            (self.items_by_project, item.get("projectId")),
+            (self.items_by_status, item.get("status")),
+        ):
+            item_ids = index.get(key)
+            if item_ids is not None:
+                item_ids.discard(item_id)
+                if not item_ids:
+                    del index[key]
+        if isinstance(item.get("dueDatetime"), str):
+            entry = (item["dueDatetime"], item_id)
+            position = bisect.bisect_left(self.items_by_due, entry)
+            if self.items_by_due[position : position + 1] == [entry]:
+                del self.items_by_due[position]
 
-        if path == "/api/login":
-            username = req_data.get("username", "").strip()
-            password = req_data.get("password", "")
 
-            if not username:
-                response = {"success": False, "message": "Username required"}
-            else:
-                users = load_users()
-                if username in users:
-                    # Check if user needs password reset
-                    if users[username].get("needsPasswordReset", False):
-                        # User needs to set password - allow login with empty password
-                        if password == "":
-                            response = {
-                                "success": True,
-                                "needsPasswordSetup": True,
-                                "username": username,
-                            }
-                        else:
-                            response = {
-                                "success": False,
-                                "message": "Please login with empty password to set your password",
-                            }
-                    else:
-                        # Normal login flow - password required
-                        if not password:
-                            response = {
-                                "success": False,
-                                "message": "Password required",
-                            }
-                        elif verify_password(password, users[username]["password"]):
-                            session_id = secrets.token_hex(16)
-                            sessions[session_id] = username
-                            save_sessions(sessions)
-
-                            is_admin = users[username].get("isAdmin", False)
-
-                            status = "200 OK"
-                            cookie = SimpleCookie()
-                            cookie["session_id"] = session_id
-                            cookie["session_id"]["path"] = "/"
-                            cookie["session_id"]["max-age"] = 86400  # 24 hours
-
-                            headers = [
-                                ("Content-type", "application/json"),
-                                ("Set-Cookie", cookie["session_id"].OutputString()),
-                            ]
-                            start_response(status, headers)
-                            return [
-                                json.dumps(
-                                    {
-                                        "success": True,
-                                        "username": username,
-                                        "isAdmin": is_admin,
-                                    }
-                                ).encode("utf-8")
-                            ]
-                        else:
-                            response = {"success": False, "message": "Invalid password"}
-                else:
-                    response = {"success": False, "message": "Account does not exist"}
+def as_dataset(data):
+    return data if isinstance(data, Dataset) else Dataset(data)
 
-            return respond_json(start_response, "200 OK", response)
 
-        elif path == "/api/logout":
-            cookie_header = environ.get("HTTP_COOKIE", "")
-            if cookie_header:
-                cookie = SimpleCookie(cookie_header)
-                if "session_id" in cookie:
-                    session_id = cookie["session_id"].value
-                    sessions.pop(session_id, None)
-                    save_sessions(sessions)
+def dataset_index(data):
+    """Return an up-to-date DataIndex for data, building it if needed"""
+    index = getattr(data, "index", None)
+    if index is None or not index.is_current(data):
+        index = DataIndex(data)
+        if isinstance(data, Dataset):
+            data.index = index
+    return index
 
-            return respond_json(start_response, "200 OK", {"success": True})
 
-        elif path == "/api/data":
-            username, error_response = require_auth(environ, start_response)
-            if error_response:
-                return error_response
+def _add_record(records, by_id, record, next_id):
+    if record.get("id") is None:
+        record["id"] = next_id
+    elif record["id"] in by_id:
+        # A record that already has an id is being replayed; replace it
+        records[records.index(by_id[record["id"]])] = record
+        return False
+    records.append(record)
+    return True
 
-            save_data(username, req_data)
-            return respond_json(start_response, "200 OK", {"success": True})
 
-        elif path == "/api/admin/create-user":
-            _, users, error_response = require_admin_user(environ, start_response)
-            if error_response:
-                return error_response
+def _apply_add_item(data, change):
+    index = dataset_index(data)
+    item = change["item"]
+    item["version"] = change["version"]
+    old_item = index.items_by_id.get(item.get("id"))
+    if not _add_record(data["items"], index.items_by_id, item, data["nextItemId"]):
+        index.remove_item(old_item)
+    index.add_item(item)
+    data["nextItemId"] = max(data["nextItemId"], item["id"] + 1)
+    return item
 
-            new_username = req_data.get("username", "").strip()
 
-            if not new_username:
-                response = {"success": False, "message": "Username required"}
-            elif new_username in users:
-                response = {"success": False, "message": "Username already exists"}
-            else:
-                users[new_username] = {
-                    "password": None,
-                    "isAdmin": False,
-                    "needsPasswordReset": True,
-                }
-                save_users(users)
-                response = {
-                    "success": True,
-                    "message": f"User '{new_username}' created successfully",
-                }
+def _apply_add_project(data, change):
+    index = dataset_index(data)
+    project = change["project"]
+    project["version"] = change["version"]
+    projects_by_id = index.projects_by_id
+    _add_record(data["projects"], projects_by_id, project, data["nextProjectId"])
+    projects_by_id[project["id"]] = project
+    data["nextProjectId"] = max(data["nextProjectId"], project["id"] + 1)
+    return project
 
-            return respond_json(start_response, "200 OK", response)
 
-        elif path == "/api/admin/list-users":
-            _, users, error_response = require_admin_user(environ, start_response)
-            if error_response:
-                return error_response
+def _apply_add_items(data, change):
+    return [
+        _apply_add_item(data, {"item": item, "version": change["version"]})
+        for item in change["items"]
+    ]
 
-            user_list = [
-                {"username": u, "isAdmin": data.get("isAdmin", False)}
-                for u, data in users.items()
-            ]
-            return respond_json(start_response, "200 OK", {"users": user_list})
 
-        elif path == "/api/admin/delete-user":
-            _, users, error_response = require_admin_user(environ, start_response)
-            if error_response:
-                return error_response
+def _apply_add_projects(data, change):
+    return [
+        _apply_add_project(data, {"project": project, "version": change["version"]})
+        for project in change["projects"]
+    ]
 
-            delete_username = req_data.get("username", "").strip()
 
-            if delete_username == "admin":
-                response = {"success": False, "message": "Cannot delete admin account"}
-            elif delete_username not in users:
-                response = {"success": False, "message": "User not found"}
-            else:
-                users.pop(delete_username)
-                save_users(users)
+def _record_updates(update, version):
+    # Never let an update overwrite the record's id or version
+    updates = {k: v for k, v in update.items() if k not in ("id", "version")}
+    updates["version"] = version
+    return updates
 
-                # Delete user's data file
-                data_file = get_data_file(delete_username)
-                if os.path.exists(data_file):
-                    os.remove(data_file)
 
-                response = {
-                    "success": True,
-                    "message": f"User '{delete_username}' deleted",
-                }
+def _pin_done_at(item, update):
+    # Record in the change when the item was done, so replays agree on it
+    if "done" in update and "doneAt" not in update:
+        if not update["done"]:
+            update["doneAt"] = None
+        elif item.get("done"):
+            update["doneAt"] = item.get("doneAt")
+        else:
+            update["doneAt"] = datetime.now().isoformat()
 
-            return respond_json(start_response, "200 OK", response)
 
-        elif path == "/api/admin/reset-password":
-            _, users, error_response = require_admin_user(environ, start_response)
-            if error_response:
-                return error_response
+def _apply_update_items(data, change):
+    index = dataset_index(data)
+    updated = []
+    for update in change["updates"]:
+        item = index.items_by_id.get(update.get("id"))
+        if item is not None:
+            _pin_done_at(item, update)
+            index.update_item(item, _record_updates(update, change["version"]))
+            updated.append(item)
+    return updated
 
-            reset_username = req_data.get("username", "").strip()
 
-            if reset_username not in users:
-                response = {"success": False, "message": "User not found"}
-            else:
-                users[reset_username]["password"] = None
-                users[reset_username]["needsPasswordReset"] = True
-                save_users(users)
-                response = {
-                    "success": True,
-                    "message": f"Password reset for '{reset_username}'",
-                }
+def _apply_update_projects(data, change):
+    projects_by_id = dataset_index(data).projects_by_id
+    updated = []
+    for update in change["updates"]:
+        project = projects_by_id.get(update.get("id"))
+        if project is not None:
+            project.update(_record_updates(update, change["version"]))
+            updated.append(project)
+    return updated
 
-            return respond_json(start_response, "200 OK", response)
 
-        elif path == "/api/set-password":
-            set_username = req_data.get("username", "").strip()
-            new_password = req_data.get("password", "")
+def _apply_update_item(data, change):
+    item = dataset_index(data).items_by_id.get(change["id"])
+    if item is not None:
+        _pin_done_at(item, change["updates"])
+    update = dict(change["updates"], id=change["id"])
+    updated = _apply_update_items(data, {**change, "updates": [update]})
+    return updated[0] if updated else None
 
-            if not set_username or not new_password:
-                response = {
-                    "success": False,
-                    "message": "Username and password required",
-                }
-            else:
-                users = load_users()
 
-                if set_username not in users:
-                    response = {"success": False, "message": "User not found"}
-                elif not users[set_username].get("needsPasswordReset", False):
-                    response = {
-                        "success": False,
-                        "message": "User does not need password reset",
-                    }
-                else:
-                    users[set_username]["password"] = hash_password(new_password)
-                    users[set_username]["needsPasswordReset"] = False
-                    save_users(users)
-
-                    # Create session for the user
-                    session_id = secrets.token_hex(16)
-                    sessions[session_id] = set_username
-                    save_sessions(sessions)
-
-                    is_admin = users[set_username].get("isAdmin", False)
-
-                    status = "200 OK"
-                    cookie = SimpleCookie()
-                    cookie["session_id"] = session_id
-                    cookie["session_id"]["path"] = "/"
-                    cookie["session_id"]["max-age"] = 86400
-
-                    headers = [
-                        ("Content-type", "application/json"),
-                        ("Set-Cookie", cookie["session_id"].OutputString()),
-                    ]
-                    start_response(status, headers)
-                    return [
-                        json.dumps(
-                            {
-                                "success": True,
-                                "username": set_username,
-                                "isAdmin": is_admin,
-                            }
-                        ).encode("utf-8")
-                    ]
-
-            return respond_json(start_response, "200 OK", response)
-
-        elif path == "/api/items":
-            username, error_response = require_auth(environ, start_response)
-            if error_response:
-                return error_response
+def _apply_update_project(data, change):
+    update = dict(change["updates"], id=change["id"])
+    updated = _apply_update_projects(data, {**change, "updates": [update]})
+    return updated[0] if updated else None
+
+
+def _add_tombstone(data, kind, record_id, version):
+    data.setdefault("tombstones", []).append(
+        {"type": kind, "id": record_id, "version": version}
+    )
+
+
+def _apply_delete_items(data, change):
+    index = dataset_index(data)
+    removed = 0
+    for item_id in change["ids"]:
+        item = index.items_by_id.get(item_id)
+        if item is not None:
+            index.remove_item(item)
+            _add_tombstone(data, "item", item_id, change["version"])
+            removed += 1
+    if removed:
+        data["items"][:] = [i for i in data["items"] if i["id"] in index.items_by_id]
+    return removed
+
+
+def _apply_delete_done_items(data, change):
+    if "ids" not in change:
+        # Pin the selection so a replay never deletes items done later
+        change["ids"] = [i["id"] for i in data["items"] if i.get("done")]
+    return _apply_delete_items(data, change)
+
+
+def _apply_archive_items(data, change):
+    # Archived items leave like deleted ones, but only if still done: one
+    # reopened while being archived stays, and archive listings skip it
+    items_by_id = dataset_index(data).items_by_id
+    ids = [i for i in change["ids"] if items_by_id.get(i, {}).get("done")]
+    return _apply_delete_items(data, {**change, "ids": ids})
+
+
+def _apply_delete_projects(data, change):
+    index = dataset_index(data)
+    removed = 0
+    for project_id in change["ids"]:
+        if index.projects_by_id.pop(project_id, None) is not None:
+            _add_tombstone(data, "project", project_id, change["version"])
+            removed += 1
+        # Remove project reference from items
+        for item in index.project_items(project_id):
+            updates = {"projectId": None, "status": "inbox"}
+            index.update_item(item, _record_updates(updates, change["version"]))
+    if removed:
+        data["projects"][:] = [
+            p for p in data["projects"] if p["id"] in index.projects_by_id
+        ]
+    return removed
+
+
+def _apply_reserve_ids(data, change):
+    # Raise the next ids, never lower them
+    for key in ("nextItemId", "nextProjectId"):
+        data[key] = max(data[key], change.get(key, 1))
+    return True
+
+
+def change_ids(change):
+    """Return the ids of the records a change record touched"""
+    if "ids" in change:
+        return change["ids"]
+    if "id" in change:
+        return [change["id"]]
+    for key in ("item", "project"):
+        if key in change:
+            return [change[key]["id"]]
+    for key in ("items", "projects", "updates"):
+        if key in change:
+            return [record.get("id") for record in change[key]]
+    return []
+
+
+def _by_id(change):
+    return {"ids": [change["id"]], "version": change["version"]}
+
+
+CHANGE_HANDLERS = {
+    "add_item": _apply_add_item,
+    "update_item": _apply_update_item,
+    "update_items": lambda data, c: len(_apply_update_items(data, c)),
+    "delete_item": lambda data, c: _apply_delete_items(data, _by_id(c)) > 0,
+    "add_items": _apply_add_items,
+    "delete_items": _apply_delete_items,
+    "delete_done_items": _apply_delete_done_items,
+    "archive_items": _apply_archive_items,
+    "add_project": _apply_add_project,
+    "update_project": _apply_update_project,
+    "update_projects": lambda data, c: len(_apply_update_projects(data, c)),
+    "delete_project": lambda data, c: _apply_delete_projects(data, _by_id(c)) > 0,
+    "add_projects": _apply_add_projects,
+    "delete_projects": _apply_delete_projects,
+    "reserve_ids": _apply_reserve_ids,
+}
+
+
+def apply_change(data, change):
+    """Apply one change record to a loaded dataset and return its result.
+
+    Every change gets the dataset's next version number, which is stamped on
+    the records it touches and on tombstones for the records it deletes.
+    Records that create or select something are completed in place with the
+    assigned version and ids, so replaying a record against the same dataset
+    is idempotent.
+    """
+    if change.get("version") is None:
+        change["version"] = data.get("version", 0) + 1
+    data["version"] = max(data.get("version", 0), change["version"])
+    if "datasetId" not in data:
+        # Recorded in the change, so replaying the journal gives the same id
+        data["datasetId"] = change.setdefault("datasetId", secrets.token_hex(8))
+    result = CHANGE_HANDLERS[change["op"]](data, change)
+    tombstones = data.get("tombstones")
+    if tombstones and len(tombstones) > TOMBSTONE_LIMIT:
+        dropped = tombstones[:-TOMBSTONE_LIMIT]
+        del tombstones[:-TOMBSTONE_LIMIT]
+        # Clients that synced before this version may have missed a delete
+        data["tombstonesFrom"] = dropped[-1]["version"]
+    return result
+
+
+def dataset_changes(data, since):
+    """Return what changed in a dataset after version since.
+
+    Clients whose version is older than the oldest tombstone kept, or newer
+    than the dataset (it was recreated), get {"reset": True} and must fetch
+    the whole dataset again.
+    """
+    version = data.get("version", 0)
+    if since > version or since < data.get("tombstonesFrom", 0):
+        return {"version": version, "reset": True}
+    deleted = {"items": [], "projects": []}
+    for tombstone in data.get("tombstones", ()):
+        if tombstone["version"] > since:
+            deleted[tombstone["type"] + "s"].append(tombstone["id"])
+    return {
+        "version": version,
+        "items": [i for i in data["items"] if i.get("version", 0) > since],
+        "projects": [p for p in data["projects"] if p.get("version", 0) > since],
+        "deleted": deleted,
+        "nextItemId": data["nextItemId"],
+        "nextProjectId": data["nextProjectId"],
+    }
+
+
+def sort_position(record):
+    """A record's position, for sorting; clients may store anything there"""
+    position = record.get("position")
+    if isinstance(position, (int, float)) and not isinstance(position, bool):
+        return position
+    return 0
+
+
+def sort_text(value):
+    return value if isinstance(value, str) else ""
+
+
+# Sort orders of item queries: key(item), and the types of the key's parts
+ITEM_SORT_KEYS = {
+    "position": (lambda i: [sort_position(i), i["id"]], ((int, float), int)),
+    "dueDatetime": (
+        lambda i: [i["dueDatetime"], sort_text(i.get("startTime")), i["id"]],
+        (str, str, int),
+    ),
+}
+
+
+def item_matches(item, query):
+    """Whether item passes every filter of an item query"""
+    if "status" in query and item.get("status") not in query["status"]:
+        return False
+    if "projectId" in query and item.get("projectId") != query["projectId"]:
+        return False
+    if "done" in query and bool(item.get("done")) != query["done"]:
+        return False
+    for field, prefix in (("dueDatetime", "due"), ("startTime", "start")):
+        value = item.get(field)
+        start, end = query.get(prefix + "From"), query.get(prefix + "To")
+        if start is None and end is None:
+            continue
+        if not isinstance(value, str):
+            return False
+        if (start is not None and value < start) or (end is not None and value >= end):
+            return False
+    if query["sort"] == "dueDatetime" and not isinstance(item.get("dueDatetime"), str):
+        return False
+    return True
+
+
+def query_items(data, query):
+    """Return (page, next_key) for an item query over a loaded dataset.
+
+    Candidates come from the smallest index that covers a filter: the
+    project's items, the statuses' items or the due date range. They are
+    then filtered, and the page is the limit smallest by the sort key that
+    come after the query's "after" key. next_key is the last one's key if
+    more items follow. A limit of None returns every match.
+    """
+    index = dataset_index(data)
+    sources = []
+    if query.get("projectId") is not None:
+        sources.append(index.project_items(query["projectId"]))
+    if "status" in query:
+        sources.append([i for s in query["status"] for i in index.status_items(s)])
+    if query["sort"] == "dueDatetime" or "dueFrom" in query or "dueTo" in query:
+        sources.append(index.due_items(query.get("dueFrom"), query.get("dueTo")))
+    candidates = min(sources, key=len) if sources else data["items"]
+    key = ITEM_SORT_KEYS[query["sort"]][0]
+    after = query.get("after")
+    matches = (
+        i
+        for i in candidates
+        if item_matches(i, query) and (after is None or key(i) > after)
+    )
+    if query["limit"] is None:
+        return sorted(matches, key=key), None
+    page = heapq.nsmallest(query["limit"] + 1, matches, key=key)
+    if len(page) > query["limit"]:
+        return page[: query["limit"]], key(page[query["limit"] - 1])
+    return page, None
+
+
+def position_between(after, before):
+    """Return a position between two neighbours' (None: the list's end)"""
+    if after is None and before is None:
+        return 0
+    if after is None:
+        return before - 1
+    if before is None:
+        return after + 1
+    return after + (before - after) / 2
+
+
+rebalancing = set()  # (username, kind, list) renumberings under way
+rebalancing_lock = threading.Lock()
+
+
+class EventBroker:
+    """Fans out each user's change events to their GET /api/events streams.
+
+    An event's id is the dataset version it produced. While a user has
+    streams open, their last buffer_size events are kept, so a client
+    reconnecting with Last-Event-ID is sent those it missed, or a reset
+    event if they are gone. Users nobody listens to only have their newest
+    event id kept. Events only reach streams served by the process that
+    made the change.
+    """
+
+    def __init__(self, buffer_size=EVENTS_BUFFER):
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.buffers = {}  # username -> deque of (id, encoded event)
+        self.newest = {}  # username -> id of their newest event
+        self.subscriptions = {}  # username -> set of EventSubscription
+
+    def publish(self, username, event_id, event_type, payload):
+        with self.lock:
+            self.newest[username] = max(event_id, self.newest.get(username, 0))
+            subscriptions = list(self.subscriptions.get(username, ()))
+            if not subscriptions:
+                return
+            buffer = self.buffers.get(username)
+            if buffer is None:
+                buffer = self.buffers[username] = deque(maxlen=self.buffer_size)
+            message = b"id: %d\nevent: %s\ndata: %s\n\n" % (
+                event_id,
+                event_type.encode("ascii"),
+                encode_json(payload),
+            )
+            buffer.append((event_id, message))
+        for subscription in subscriptions:
+            subscription.notify()
+
+    def publishing(self, apply):
+        """Decorator for a backend's apply() publishing every change.
+
+        Events name the op and the ids it touched, not the whole change:
+        clients fetch the records from /api/changes.
+        """
 
-            data = load_data(username)
-            item = {
-                "title": req_data.get("title", ""),
-                "notes": req_data.get("notes"),
-                "status": req_data.get("status", "inbox"),
-                "projectId": req_data.get("projectId"),
-                "startTime": req_data.get("startTime"),
-                "dueDatetime": req_data.get("dueDatetime"),
-                "position": req_data.get("position", 0),
-                "id": data["nextItemId"],
-                "createdAt": datetime.now().isoformat(),
+        @functools.wraps(apply)
+        def publishing_apply(storage, username, change):
+            result = apply(storage, username, change)
+            payload = {
+                "op": change["op"],
+                "version": change["version"],
+                "ids": change_ids(change),
             }
-            data["items"].append(item)
-            data["nextItemId"] += 1
-            save_data(username, data)
+            self.publish(username, change["version"], "change", payload)
+            return result
 
-            return respond_json(start_response, "200 OK", item)
+        return publishing_apply
 
-        elif path == "/api/projects":
-            username, error_response = require_auth(environ, start_response)
-            if error_response:
-                return error_response
+    def subscribe(self, username, last_event_id=None, loop=None):
+        """Return a subscription to username's events after last_event_id.
+
+        Pass the event loop to wait for events with wait_async() in it.
+        """
+        subscription = EventSubscription(self, username, loop)
+        with self.lock:
+            try:
+                subscription.last_id = int(last_event_id)
+            except (TypeError, ValueError):
+                # Only events from now on
+                subscription.last_id = self.newest.get(username)
+            self.subscriptions.setdefault(username, set()).add(subscription)
+        return subscription
+
+    def forget(self, username):
+        """Drop a deleted user's events; a new dataset starts at version 1"""
+        with self.lock:
+            self.buffers.pop(username, None)
+            self.newest.pop(username, None)
 
-            data = load_data(username)
-            project = {
-                "name": req_data.get("name", ""),
-                "outcome": req_data.get("outcome"),
-                "status": req_data.get("status", "active"),
-                "id": data["nextProjectId"],
-                "createdAt": datetime.now().isoformat(),
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.username, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.username, None)
+                self.buffers.pop(subscription.username, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "users": len(self.buffers),
+                "streams": sum(map(len, self.subscriptions.values())),
             }
-            data["projects"].append(project)
-            data["nextProjectId"] += 1
-            save_data(username, data)
 
-            return respond_json(start_response, "200 OK", project)
 
-    # Handle PUT requests
-    elif method == "PUT":
-        username, error_response = require_auth(environ, start_response)
-        if error_response:
-            return error_response
+class EventSubscription:
+    """One stream's position in a user's events, and a way to wait for more"""
 
-        updates = read_json_body(environ)
+    def __init__(self, broker, username, loop=None):
+        self.broker = broker
+        self.username = username
+        self.last_id = None
+        self.condition = threading.Condition()
+        self.notified = False
+        self.loop = loop
+        self.async_notified = asyncio.Event() if loop is not None else None
 
-        data = load_data(username)
+    def take(self):
+        """Return the encoded events published since the last take()"""
+        with self.broker.lock:
+            buffer = self.broker.buffers.get(self.username) or ()
+            newest = self.broker.newest.get(self.username)
+            if newest is None:
+                return []
+            # Concurrent changes may be published out of order
+            last_id = self.last_id
+            self.last_id = max(newest, last_id if last_id is not None else newest)
+            if last_id is None:
+                return [message for _, message in buffer]
+            if last_id == newest:
+                return []
+            if last_id > newest or not buffer or buffer[0][0] > last_id + 1:
+                # Events were dropped, or published while nobody listened,
+                # before this stream saw them, or the dataset was recreated
+                return [b"id: %d\nevent: reset\ndata: {}\n\n" % newest]
+            return [message for i, message in buffer if i > last_id]
 
-        # Batch update endpoint for multiple items
-        if path == "/api/items/batch":
-            if not isinstance(updates, list):
-                return respond_json(
-                    start_response,
-                    "400 Bad Request",
-                    {"error": "Expected array of updates"},
-                )
+    def notify(self):
+        with self.condition:
+            self.notified = True
+            self.condition.notify_all()
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.async_notified.set)
+            except RuntimeError:  # the loop has been closed
+                pass
 
-            updated_count = 0
-            for update in updates:
-                item_id = update.get("id")
-                if not item_id:
-                    continue
-                for i, item in enumerate(data["items"]):
-                    if item["id"] == item_id:
-                        # Remove 'id' from updates to avoid overwriting
-                        item_updates = {k: v for k, v in update.items() if k != "id"}
-                        data["items"][i].update(item_updates)
-                        updated_count += 1
-                        break
+    def wait(self, timeout):
+        """Wait up to timeout seconds for an event; False if none came"""
+        with self.condition:
+            notified = self.condition.wait_for(lambda: self.notified, timeout)
+            self.notified = False
+        return notified
 
-            save_data(username, data)
-            return respond_json(start_response, "200 OK", {"updated": updated_count})
+    async def wait_async(self, timeout, *also):
+        """wait() for the event loop, also ending once a future in also is done"""
+        waiter = asyncio.ensure_future(self.async_notified.wait())
+        try:
+            await asyncio.wait(
+                [waiter, *also], timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            waiter.cancel()
+        notified = self.async_notified.is_set()
+        self.async_notified.clear()
+        return notified
 
-        # Batch update endpoint for multiple projects
-        if path == "/api/projects/batch":
-            if not isinstance(updates, list):
-                return respond_json(
-                    start_response,
-                    "400 Bad Request",
-                    {"error": "Expected array of updates"},
-                )
+    def close(self):
+        self.broker.unsubscribe(self)
 
-            updated_count = 0
-            for update in updates:
-                project_id = update.get("id")
-                if not project_id:
-                    continue
-                for i, project in enumerate(data["projects"]):
-                    if project["id"] == project_id:
-                        # Remove 'id' from updates to avoid overwriting
-                        project_updates = {k: v for k, v in update.items() if k != "id"}
-                        data["projects"][i].update(project_updates)
-                        updated_count += 1
-                        break
 
-            save_data(username, data)
-            return respond_json(start_response, "200 OK", {"updated": updated_count})
+events = EventBroker()
 
-        path_parts = path.split("/")
-        if len(path_parts) < 4:
-            return respond_text(start_response, "400 Bad Request", "Bad Request")
 
-        item_id = int(path_parts[3])
+class Storage:
+    """Base class for storage backends.
 
-        if path_parts[2] == "items":
-            for i, item in enumerate(data["items"]):
-                if item["id"] == item_id:
-                    data["items"][i].update(updates)
-                    save_data(username, data)
-                    return respond_json(start_response, "200 OK", data["items"][i])
-        elif path_parts[2] == "projects":
-            for i, project in enumerate(data["projects"]):
-                if project["id"] == item_id:
-                    data["projects"][i].update(updates)
-                    save_data(username, data)
-                    return respond_json(start_response, "200 OK", data["projects"][i])
+    A backend loads and saves the user registry and whole per-user datasets.
+    The mutation helpers express every change as a record for apply(), whose
+    default is load-modify-save; backends override apply() when they can
+    persist a single change more cheaply, decorated with events.publishing.
+    """
 
-        return respond_text(start_response, "404 Not Found", "Not Found")
+    def load_users(self):
+        """Return the user registry, or None if there is none yet"""
+        raise NotImplementedError
 
-    # Handle DELETE requests
-    elif method == "DELETE":
-        path_parts = path.split("/")
-        if len(path_parts) < 4:
-            return respond_text(start_response, "400 Bad Request", "Bad Request")
+    def save_users(self, users):
+        raise NotImplementedError
 
-        username, error_response = require_auth(environ, start_response)
-        if error_response:
-            return error_response
+    def load_data(self, username):
+        raise NotImplementedError
 
-        data = load_data(username)
-        item_id = int(path_parts[3])
+    def save_data(self, username, data):
+        raise NotImplementedError
 
-        if path_parts[2] == "items":
-            data["items"] = [i for i in data["items"] if i["id"] != item_id]
-            save_data(username, data)
-            status = "204 No Content"
-            headers = []
-            start_response(status, headers)
-            return [b""]
-        elif path_parts[2] == "projects":
-            data["projects"] = [p for p in data["projects"] if p["id"] != item_id]
-            # Remove project reference from items
-            for item in data["items"]:
-                if item.get("projectId") == item_id:
-                    item["projectId"] = None
-                    item["status"] = "inbox"
-            save_data(username, data)
-            status = "204 No Content"
-            headers = []
-            start_response(status, headers)
-            return [b""]
+    def delete_data(self, username):
+        raise NotImplementedError
 
-        return respond_text(start_response, "404 Not Found", "Not Found")
+    def lock(self, username):
+        """Lock to hold around a read-modify-write of a user's dataset"""
+        return nullcontext()
 
-    # 404 for unknown routes
-    return respond_text(start_response, "404 Not Found", "Not Found")
+    def read_lock(self, username):
+        """Lock to hold while reading a user's dataset or its DataIndex.
 
+        Backends that keep datasets in memory change them in place under
+        lock(), so readers in other threads must not look at them meanwhile.
+        """
+        return self.lock(username)
 
-if __name__ == "__main__":
-    from wsgiref.simple_server import make_server
+    def apply(self, username, change):
+        data = self.load_data(username)
+        result = apply_change(data, change)
+        self.save_data(username, data)
+        return result
 
-    port = 8000
-    httpd = make_server("localhost", port, application)
+    def replace_data(self, username, data):
+        """Replace a user's whole dataset as one new version.
+
+        Tombstones cannot describe a wholesale replacement, so every client
+        that synced an earlier version is told to reset.
+        """
+        with self.lock(username):
+            old_data = self.load_data(username)
+            version = old_data.get("version", 0) + 1
+            data = dict(data, version=version, tombstones=[], tombstonesFrom=version)
+            data["datasetId"] = old_data.get("datasetId") or secrets.token_hex(8)
+            # Never hand out an id again, archived items still use theirs
+            for key in ("nextItemId", "nextProjectId"):
+                data[key] = max(data.get(key, 1), old_data.get(key, 1))
+            self.save_data(username, data)
+        events.publish(username, version, "reset", {})
+
+    def changes(self, username, since):
+        with self.read_lock(username):
+            return dataset_changes(self.load_data(username), since)
+
+    def query_items(self, username, query):
+        with self.read_lock(username):
+            return query_items(self.load_data(username), query)
+
+    def get_records(self, username, kind, ids):
+        """Return the items or projects (kind "item"/"project") with ids"""
+        with self.read_lock(username):
+            index = dataset_index(self.load_data(username))
+            by_id = index.items_by_id if kind == "item" else index.projects_by_id
+            return [by_id[i] for i in ids if i in by_id]
+
+    def done_items(self, username):
+        with self.read_lock(username):
+            return [i for i in self.load_data(username)["items"] if i.get("done")]
+
+    def archive_done_items(self, username, cutoff):
+        """Move items done before cutoff, an ISO datetime, to the archive.
+
+        Returns how many items were moved. Done items without a doneAt, from
+        before it was recorded, are given the current time, so they are
+        archived once they reach the age.
+        """
+        with self.lock(username):
+            now = datetime.now().isoformat()
+            done = self.done_items(username)
+            items = [i for i in done if i.get("doneAt") and archive_time(i) < cutoff]
+            unstamped = [
+                {"id": i["id"], "doneAt": now} for i in done if not i.get("doneAt")
+            ]
+            if unstamped:
+                self.update_items(username, unstamped)
+            if not items:
+                return 0
+            # The archive is written first: after a crash in between, an
+            # item is in both tiers rather than in neither
+            append_archive(username, {"archived": items, "at": now})
+            ids = [i["id"] for i in items]
+            return self.apply(username, {"op": "archive_items", "ids": ids})
+
+    def archived_items(self, username, query):
+        """Return (page, next key) of archived items, latest done first"""
+        page, next_key = load_archive(username).query(query)
+        # Drop items that are also in the working dataset, see above
+        ids = [i["id"] for i in page]
+        present = {i["id"] for i in self.get_records(username, "item", ids)}
+        return [i for i in page if i["id"] not in present], next_key
+
+    def restore_items(self, username, ids):
+        """Move archived items back into the working dataset"""
+        with self.lock(username):
+            archive = load_archive(username)
+            ids = [i for i in ids if i in archive.items_by_id]
+            present = {i["id"] for i in self.get_records(username, "item", ids)}
+            now = datetime.now().isoformat()
+            items = [
+                dict(archive.items_by_id[i], restoredAt=now)
+                for i in ids
+                if i not in present
+            ]
+            restored = self.add_items(username, items) if items else []
+            if ids:
+                append_archive(username, {"restored": ids, "at": now})
+            return restored
+
+    def move_item(self, username, item_id, after_id=None, before_id=None):
+        """Place an item between two others in its list, see move()"""
+        return self.move(username, "item", item_id, after_id, before_id)
+
+    def move_project(self, username, project_id, after_id=None, before_id=None):
+        return self.move(username, "project", project_id, after_id, before_id)
+
+    def move(self, username, kind, record_id, after_id, before_id, renumbered=False):
+        """Give a record a position between its new neighbours'.
+
+        Only the moved record changes, unless the neighbours leave no room
+        between them; then their list is renumbered first. Returns the
+        updated record, or None if it or a given neighbour does not exist.
+        Raises ValueError if the neighbours are out of order.
+        """
+        ids = [i for i in (record_id, after_id, before_id) if i is not None]
+        with self.lock(username):
+            by_id = {r["id"]: r for r in self.get_records(username, kind, ids)}
+            if any(i not in by_id for i in ids):
+                return None
+            # A move can only run out of room between two neighbours, and it
+            # is their list that is renumbered then
+            neighbour = by_id.get(after_id)
+            after, before = (
+                None if i is None else sort_position(by_id[i])
+                for i in (after_id, before_id)
+            )
+            position = position_between(after, before)
+            if (after is not None and position <= after) or (
+                before is not None and position >= before
+            ):
+                if renumbered:
+                    raise ValueError("after must come before before in one list")
+                self.rebalance(username, kind, neighbour)
+                return self.move(username, kind, record_id, after_id, before_id, True)
+            if after is not None and before is not None:
+                if before - after < POSITION_MIN_GAP:
+                    self.schedule_rebalance(username, kind, neighbour)
+            updates = {"position": position}
+            if kind == "item":
+                return self.update_item(username, record_id, updates)
+            return self.update_project(username, record_id, updates)
+
+    def siblings(self, username, kind, record):
+        """Return the records in record's list, in order"""
+        if kind == "project":
+            with self.read_lock(username):
+                projects = list(self.load_data(username)["projects"])
+            return sorted(projects, key=lambda p: (sort_position(p), p["id"]))
+        query = {
+            "status": [record.get("status")],
+            "projectId": record.get("projectId"),
+            "sort": "position",
+            "limit": None,
+        }
+        return self.query_items(username, query)[0]
+
+    def rebalance(self, username, kind, record):
+        """Renumber the positions of record's list 0, 1, 2... in order"""
+        with self.lock(username):
+            updates = [
+                {"id": r["id"], "position": n}
+                for n, r in enumerate(self.siblings(username, kind, record))
+                if r.get("position") != n
+            ]
+            if kind == "item":
+                self.update_items(username, updates)
+            else:
+                self.update_projects(username, updates)
+
+    def schedule_rebalance(self, username, kind, record):
+        key = (username, kind, record.get("status"), record.get("projectId"))
+        with rebalancing_lock:
+            if key in rebalancing:
+                return
+            rebalancing.add(key)
+
+        def run():
+            try:
+                self.rebalance(username, kind, record)
+            except Exception as e:
+                print(f"Renumbering positions failed: {e!r}", file=sys.stderr)
+            finally:
+                with rebalancing_lock:
+                    rebalancing.discard(key)
+
+        threading.Thread(target=run, name="rebalance", daemon=True).start()
+
+    def stats(self):
+        return {"backend": type(self).__name__, "writeMode": WRITE_MODE}
+
+    def add_item(self, username, item):
+        return self.apply(username, {"op": "add_item", "item": item})
+
+    def update_item(self, username, item_id, updates):
+        change = {"op": "update_item", "id": item_id, "updates": updates}
+        return self.apply(username, change)
+
+    def update_items(self, username, updates):
+        return self.apply(username, {"op": "update_items", "updates": updates})
+
+    def delete_item(self, username, item_id):
+        return self.apply(username, {"op": "delete_item", "id": item_id})
+
+    def add_items(self, username, items):
+        return self.apply(username, {"op": "add_items", "items": items})
+
+    def delete_items(self, username, item_ids):
+        return self.apply(username, {"op": "delete_items", "ids": item_ids})
+
+    def delete_done_items(self, username):
+        return self.apply(username, {"op": "delete_done_items"})
+
+    def add_project(self, username, project):
+        return self.apply(username, {"op": "add_project", "project": project})
+
+    def update_project(self, username, project_id, updates):
+        change = {"op": "update_project", "id": project_id, "updates": updates}
+        return self.apply(username, change)
+
+    def update_projects(self, username, updates):
+        return self.apply(username, {"op": "update_projects", "updates": updates})
+
+    def delete_project(self, username, project_id):
+        return self.apply(username, {"op": "delete_project", "id": project_id})
+
+    def add_projects(self, username, projects):
+        return self.apply(username, {"op": "add_projects", "projects": projects})
+
+    def delete_projects(self, username, project_ids):
+        return self.apply(username, {"op": "delete_projects", "ids": project_ids})
+
+    def reserve_ids(self, username, next_item_id, next_project_id):
+        """Make sure ids below these are never handed out"""
+        change = {
+            "op": "reserve_ids",
+            "nextItemId": next_item_id,
+            "nextProjectId": next_project_id,
+        }
+        return self.apply(username, change)
+
+
+def encode_json(obj):
+    """Return obj as compact UTF-8 JSON, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def encode_text(obj):
+    return encode_json(obj).decode("utf-8")
+
+
+def decode_json(raw):
+    """Parse JSON from bytes or str"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+@metrics.timed("encode_snapshot")
+def encode_snapshot(obj, snapshot_format=None):
+    if (snapshot_format or SNAPSHOT_FORMAT) == "binary":
+        # Level 1 already shrinks datasets ~7x at a fraction of level 6's cost
+        return SNAPSHOT_MAGIC + zlib.compress(encode_json(obj), 1)
+    return encode_json(obj)
+
+
+@metrics.timed("decode_snapshot")
+def decode_snapshot(raw):
+    """Parse a file written by encode_snapshot() in any format"""
+    if raw.startswith(SNAPSHOT_MAGIC):
+        return decode_json(zlib.decompress(raw[len(SNAPSHOT_MAGIC) :]))
+    return decode_json(raw)
+
+
+def get_data_file(username):
+    return f"data_{username}.json"
+
+
+def get_journal_file(username):
+    return f"data_{username}.journal"
+
+
+def read_json_file(path):
+    try:
+        with open(path, "rb") as f:
+            return decode_snapshot(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def read_journal(path):
+    """Return the change records in a journal file, oldest first"""
+    records = []
+    try:
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    records.append(decode_json(line))
+                except ValueError:
+                    # A line torn by a crash mid-append; that change was
+                    # never acknowledged, so skip it
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def append_journal(path, record):
+    line = encode_json(record) + b"\n"
+    fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        size = os.fstat(fd).st_size
+        if size and os.pread(fd, 1, size - 1) != b"\n":
+            # Terminate a torn line so this record starts on its own line
+            line = b"\n" + line
+        os.write(fd, line)
+        if FSYNC:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def get_archive_file(username):
+    return f"archive_{username}.ndjson"
+
+
+def archive_time(item):
+    """When an item became eligible for the archive, as an ISO datetime"""
+    return max(item.get("doneAt") or "", item.get("restoredAt") or "")
+
+
+class Archive:
+    """A user's archived items, read from archive_<username>.ndjson.
+
+    The file is append-only: each line records either items moved out of
+    the working dataset or the ids of items restored from it. Items are
+    kept ordered by (doneAt, id) for paging by date.
+    """
+
+    def __init__(self, records):
+        self.items_by_id = {}
+        for record in records:
+            for item in record.get("archived", ()):
+                self.items_by_id[item["id"]] = item
+            for item_id in record.get("restored", ()):
+                self.items_by_id.pop(item_id, None)
+        self.keys = sorted(archive_key(i) for i in self.items_by_id.values())
+
+    def query(self, query):
+        """Return (page, next key) for a query from parse_archive_query()"""
+        keys = self.keys
+        start = bisect.bisect_left(keys, (query.get("doneFrom") or "",))
+        end = len(keys)
+        if query.get("doneTo") is not None:
+            end = bisect.bisect_left(keys, (query["doneTo"],))
+        if query.get("before") is not None:
+            end = min(end, bisect.bisect_left(keys, tuple(query["before"])))
+        tokens = search_tokens(query.get("q") or "")
+        page = []
+        for position in range(end - 1, start - 1, -1):
+            item = self.items_by_id[keys[position][1]]
+            if tokens and not archive_item_matches(item, tokens):
+                continue
+            if len(page) == query["limit"]:
+                return page, list(archive_key(page[-1]))
+            page.append(item)
+        return page, None
+
+
+def archive_key(item):
+    return (item.get("doneAt") or "", item["id"])
+
+
+def archive_item_matches(item, tokens):
+    """Whether every token starts a word of the item's title or notes"""
+    words = search_tokens(f"{item.get('title') or ''} {item.get('notes') or ''}")
+    return all(any(w.startswith(t) for w in words) for t in tokens)
+
+
+archive_cache = FileCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES)
+
+
+def load_archive(username):
+    path = get_archive_file(username)
+    return archive_cache.load(path, lambda: Archive(read_journal(path)))
+
+
+def append_archive(username, record):
+    path = get_archive_file(username)
+    with file_lock(path):
+        append_journal(path, record)
+
+
+def delete_archive(username):
+    path = get_archive_file(username)
+    with file_lock(path):
+        if os.path.exists(path):
+            os.remove(path)
+        archive_cache.invalidate(path)
+
+
+def fsync_directory(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_json_file_atomic(path, data):
+    """Write data to a temporary file and rename it over path.
+
+    Readers in other processes see either the old or the new contents,
+    never a partly written file.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(encode_snapshot(data))
+            if FSYNC:
+                f.flush()
+                os.fsync(f.fileno())
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if FSYNC:
+        fsync_directory(path)
+
+
+class JsonStorage(Storage):
+    """users.json plus one data_<username>.json file per user.
+
+    With journaling enabled, apply() appends the change record to
+    data_<username>.journal instead of rewriting the snapshot, and
+    load_data() replays the journal on top of it. Once the journal passes
+    JOURNAL_COMPACT_BYTES a background thread folds it into a new snapshot.
+    A crash between writing the snapshot and removing the journal is
+    harmless: records up to the snapshot's version are skipped on replay.
+    """
+
+    def __init__(self, journal=JSON_JOURNAL, compact_bytes=JOURNAL_COMPACT_BYTES):
+        self.journal = journal
+        self.compact_bytes = compact_bytes
+        self.compacting = set()
+        self.compacting_lock = threading.Lock()
+
+    def lock(self, username):
+        return file_lock(get_data_file(username))
+
+    def read_lock(self, username):
+        # Other processes never see this process's datasets, so only its
+        # threads need keeping out
+        return file_lock(get_data_file(username)).thread_lock
+
+    def load_users(self):
+        users = users_cache.load(USERS_FILE, lambda: read_json_file(USERS_FILE))
+        # Callers change what they get, so they never see the cached copy
+        return copy_users(users)
+
+    def save_users(self, users):
+        with users_lock():
+            write_json_file_atomic(USERS_FILE, users)
+            users_cache.store(USERS_FILE, copy_users(users))
+
+    def load_data(self, username):
+        paths = (get_data_file(username), get_journal_file(username))
+        data = data_cache.load(paths[0], lambda: self._read_data(*paths), paths)
+        if data is not None:
+            return data
+        return empty_data()
+
+    @metrics.timed("storage_save")
+    def save_data(self, username, data):
+        paths = (get_data_file(username), get_journal_file(username))
+        with self.lock(username):
+            write_json_file_atomic(paths[0], data)
+            if os.path.exists(paths[1]):
+                os.remove(paths[1])
+            data_cache.store(paths[0], as_dataset(data), paths)
+
+    def delete_data(self, username):
+        data_file = get_data_file(username)
+        with self.lock(username):
+            for path in (data_file, get_journal_file(username)):
+                if os.path.exists(path):
+                    os.remove(path)
+            data_cache.invalidate(data_file)
+
+    @events.publishing
+    @metrics.timed("storage_apply")
+    def apply(self, username, change):
+        if not self.journal:
+            with self.lock(username):
+                try:
+                    return super().apply(username, change)
+                except BaseException:
+                    # The cached dataset holds the change; the file does not
+                    data_cache.invalidate(get_data_file(username))
+                    raise
+        paths = (get_data_file(username), get_journal_file(username))
+        with self.lock(username):
+            data = self.load_data(username)
+            try:
+                result = apply_change(data, change)
+                append_journal(paths[1], change)
+            except BaseException:
+                data_cache.invalidate(paths[0])
+                raise
+            data_cache.store(paths[0], data, paths)
+            journal_size = os.path.getsize(paths[1])
+        if journal_size > self.compact_bytes:
+            self.schedule_compaction(username)
+        return result
+
+    def schedule_compaction(self, username):
+        with self.compacting_lock:
+            if username in self.compacting:
+                return
+            self.compacting.add(username)
+        threading.Thread(
+            target=self.compact, args=(username,), name=f"compact-{username}"
+        ).start()
+
+    def compact(self, username):
+        """Fold the journal into a new snapshot"""
+        try:
+            with self.lock(username):
+                if os.path.exists(get_journal_file(username)):
+                    self.save_data(username, self.load_data(username))
+        finally:
+            with self.compacting_lock:
+                self.compacting.discard(username)
+
+    @metrics.timed("storage_load")
+    def _read_data(self, data_file, journal_file):
+        data = read_json_file(data_file)
+        records = read_journal(journal_file)
+        if data is None and not records:
+            return None
+        data = Dataset(data) if data is not None else empty_data()
+        for record in records:
+            # Records the snapshot already holds, left by a crash between
+            # writing it and removing the journal, would re-add tombstones
+            if record.get("version", math.inf) > data.get("version", 0):
+                apply_change(data, record)
+        return data
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    record TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS datasets (
+    username TEXT PRIMARY KEY,
+    next_item_id INTEGER NOT NULL DEFAULT 1,
+    next_project_id INTEGER NOT NULL DEFAULT 1,
+    extra TEXT NOT NULL DEFAULT '{}',
+    version INTEGER NOT NULL DEFAULT 0,
+    tombstones_from INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS items (
+    username TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    status TEXT,
+    project_id INTEGER,
+    record TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (username, id)
+);
+CREATE TABLE IF NOT EXISTS projects (
+    username TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    status TEXT,
+    record TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (username, id)
+);
+CREATE TABLE IF NOT EXISTS tombstones (
+    username TEXT NOT NULL,
+    type TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    version INTEGER NOT NULL
+);
+"""
+
+# Columns added after the first release of the schema: (table, column, type)
+SQLITE_UPGRADES = [
+    ("datasets", "version", "INTEGER NOT NULL DEFAULT 0"),
+    ("datasets", "tombstones_from", "INTEGER NOT NULL DEFAULT 0"),
+    ("items", "version", "INTEGER NOT NULL DEFAULT 0"),
+    ("projects", "version", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+SQLITE_INDEXES = """
+CREATE INDEX IF NOT EXISTS items_status ON items (username, status);
+CREATE INDEX IF NOT EXISTS items_project ON items (username, project_id);
+CREATE INDEX IF NOT EXISTS items_version ON items (username, version);
+CREATE INDEX IF NOT EXISTS items_due
+    ON items (username, json_extract(record, '$.dueDatetime'));
+CREATE INDEX IF NOT EXISTS projects_status ON projects (username, status);
+CREATE INDEX IF NOT EXISTS projects_version ON projects (username, version);
+CREATE INDEX IF NOT EXISTS tombstones_version ON tombstones (username, version);
+"""
+
+
+class SqliteStorage(Storage):
+    """All users' data in one SQLite database.
+
+    Items and projects are stored one row each, as their JSON record next to
+    indexed id/status/projectId/version columns, so single-record changes
+    are single-row statements instead of a rewrite of the whole dataset.
+    """
+
+    def __init__(self, path):
+        # The database is opened on first use, so importing the module
+        # creates no file in whatever directory it happens to run in
+        self.path = path
+        self.local = threading.local()
+        self.schema_ready = False
+        self.schema_lock = threading.Lock()
+
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={'FULL' if FSYNC else 'NORMAL'}")
+            self.local.conn = conn
+            if not self.schema_ready:
+                self._create_schema(conn)
+        return conn
+
+    def _create_schema(self, conn):
+        with self.schema_lock:
+            if self.schema_ready:
+                return
+            conn.executescript(SQLITE_SCHEMA)
+            for table, column, column_type in SQLITE_UPGRADES:
+                columns = [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+                if column not in columns:
+                    conn.execute(
+                        f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"
+                    )
+            conn.executescript(SQLITE_INDEXES)
+            self.schema_ready = True
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def load_users(self):
+        rows = self.connect().execute("SELECT username, record FROM users").fetchall()
+        if not rows:
+            return None
+        return {username: decode_json(record) for username, record in rows}
+
+    def save_users(self, users):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM users")
+            conn.executemany(
+                "INSERT INTO users (username, record) VALUES (?, ?)",
+                [(u, encode_text(record)) for u, record in users.items()],
+            )
+
+    @metrics.timed("storage_load")
+    def load_data(self, username):
+        conn = self.connect()
+        row = conn.execute(
+            "SELECT next_item_id, next_project_id, extra, version, tombstones_from"
+            " FROM datasets WHERE username = ?",
+            (username,),
+        ).fetchone()
+        if row is None:
+            return empty_data()
+        data = empty_data()
+        data.update(decode_json(row[2]))
+        data["nextItemId"], data["nextProjectId"] = row[0], row[1]
+        data["version"] = row[3]
+        if row[4]:
+            data["tombstonesFrom"] = row[4]
+        for table in ("projects", "items"):
+            data[table] = [
+                decode_json(record)
+                for (record,) in conn.execute(
+                    f"SELECT record FROM {table} WHERE username = ? ORDER BY rowid",
+                    (username,),
+                )
+            ]
+        return data
+
+    @metrics.timed("storage_save")
+    def save_data(self, username, data):
+        extra = {k: v for k, v in data.items() if k not in self.DATASET_KEYS}
+        with self.transaction() as conn:
+            self._delete_rows(conn, username)
+            conn.execute(
+                "INSERT INTO datasets (username, next_item_id, next_project_id,"
+                " extra, version, tombstones_from) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    username,
+                    data.get("nextItemId", 1),
+                    data.get("nextProjectId", 1),
+                    encode_text(extra),
+                    data.get("version", 0),
+                    data.get("tombstonesFrom", 0),
+                ),
+            )
+            conn.executemany(
+                "INSERT INTO projects (username, id, status, record, version)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [self._project_row(username, p) for p in data.get("projects", [])],
+            )
+            conn.executemany(
+                "INSERT INTO items (username, id, status, project_id, record, version)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [self._item_row(username, i) for i in data.get("items", [])],
+            )
+            conn.executemany(
+                "INSERT INTO tombstones (username, type, id, version)"
+                " VALUES (?, ?, ?, ?)",
+                [
+                    (username, t["type"], t["id"], t["version"])
+                    for t in data.get("tombstones", [])
+                ],
+            )
+
+    DATASET_KEYS = (
+        "projects",
+        "items",
+        "nextItemId",
+        "nextProjectId",
+        "version",
+        "tombstones",
+        "tombstonesFrom",
+    )
+
+    def delete_data(self, username):
+        with self.transaction() as conn:
+            self._delete_rows(conn, username)
+
+    @events.publishing
+    @metrics.timed("storage_apply")
+    def apply(self, username, change):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO datasets (username) VALUES (?)", (username,)
+            )
+            if change.get("version") is None:
+                (version,) = conn.execute(
+                    "SELECT version FROM datasets WHERE username = ?", (username,)
+                ).fetchone()
+                change["version"] = version + 1
+            conn.execute(
+                "UPDATE datasets SET version = MAX(version, ?) WHERE username = ?",
+                (change["version"], username),
+            )
+            conn.execute(
+                "UPDATE datasets SET extra = json_set(extra, '$.datasetId', ?)"
+                " WHERE username = ? AND json_extract(extra, '$.datasetId') IS NULL",
+                (secrets.token_hex(8), username),
+            )
+            return getattr(self, "_apply_" + change["op"])(conn, username, change)
+
+    def changes(self, username, since):
+        conn = self.connect()
+        row = conn.execute(
+            "SELECT version, tombstones_from, next_item_id, next_project_id"
+            " FROM datasets WHERE username = ?",
+            (username,),
+        ).fetchone()
+        if row is None:
+            return dataset_changes(empty_data(), since)
+        version, tombstones_from, next_item_id, next_project_id = row
+        if since > version or since < tombstones_from:
+            return {"version": version, "reset": True}
+        changes = {"version": version}
+        for table in ("items", "projects"):
+            changes[table] = [
+                decode_json(record)
+                for (record,) in conn.execute(
+                    f"SELECT record FROM {table}"
+                    " WHERE username = ? AND version > ? ORDER BY rowid",
+                    (username, since),
+                )
+            ]
+        changes["deleted"] = {"items": [], "projects": []}
+        for kind, record_id in conn.execute(
+            "SELECT type, id FROM tombstones WHERE username = ? AND version > ?"
+            " ORDER BY version",
+            (username, since),
+        ):
+            changes["deleted"][kind + "s"].append(record_id)
+        changes["nextItemId"] = next_item_id
+        changes["nextProjectId"] = next_project_id
+        return changes
+
+    # SQL for the parts of each ITEM_SORT_KEYS key; values of other types
+    # sort as sort_position() and sort_text() have them
+    SQL_SORT_KEYS = {
+        "position": (
+            "CASE WHEN json_type(record, '$.position') IN ('integer', 'real')"
+            " THEN json_extract(record, '$.position') ELSE 0 END",
+            "id",
+        ),
+        "dueDatetime": (
+            "json_extract(record, '$.dueDatetime')",
+            "CASE WHEN json_type(record, '$.startTime') = 'text'"
+            " THEN json_extract(record, '$.startTime') ELSE '' END",
+            "id",
+        ),
+    }
+
+    def query_items(self, username, query):
+        where, params = ["username = ?"], [username]
+        if "status" in query:
+            where.append(f"status IN ({', '.join('?' * len(query['status']))})")
+            params += query["status"]
+        if "projectId" in query:
+            if query["projectId"] is None:
+                where.append("project_id IS NULL")
+            else:
+                where.append("project_id = ?")
+                params.append(query["projectId"])
+        if "done" in query:
+            operator = "!=" if query["done"] else "="
+            where.append(f"IFNULL(json_extract(record, '$.done'), 0) {operator} 0")
+        for field, prefix in (("dueDatetime", "due"), ("startTime", "start")):
+            value = f"json_extract(record, '$.{field}')"
+            start, end = query.get(prefix + "From"), query.get(prefix + "To")
+            if start is not None or end is not None:
+                where.append(f"json_type(record, '$.{field}') = 'text'")
+            if start is not None:
+                where.append(f"{value} >= ?")
+                params.append(start)
+            if end is not None:
+                where.append(f"{value} < ?")
+                params.append(end)
+        if query["sort"] == "dueDatetime":
+            where.append("json_type(record, '$.dueDatetime') = 'text'")
+        key = ", ".join(self.SQL_SORT_KEYS[query["sort"]])
+        if query.get("after") is not None:
+            where.append(f"({key}) > ({', '.join('?' * len(query['after']))})")
+            params += query["after"]
+        rows = self.connect().execute(
+            f"SELECT record FROM items WHERE {' AND '.join(where)}"
+            f" ORDER BY {key} LIMIT ?",
+            params + [-1 if query["limit"] is None else query["limit"] + 1],
+        )
+        page = [decode_json(record) for (record,) in rows]
+        if query["limit"] is not None and len(page) > query["limit"]:
+            del page[query["limit"] :]
+            return page, ITEM_SORT_KEYS[query["sort"]][0](page[-1])
+        return page, None
+
+    def done_items(self, username):
+        rows = self.connect().execute(
+            "SELECT record FROM items"
+            " WHERE username = ? AND json_extract(record, '$.done') ORDER BY rowid",
+            (username,),
+        )
+        return [decode_json(record) for (record,) in rows]
+
+    def get_records(self, username, kind, ids):
+        if not ids:
+            return []
+        table = "items" if kind == "item" else "projects"
+        placeholders = ", ".join("?" * len(ids))
+        rows = self.connect().execute(
+            f"SELECT id, record FROM {table}"
+            f" WHERE username = ? AND id IN ({placeholders})",
+            [username, *ids],
+        )
+        records = {record_id: decode_json(record) for record_id, record in rows}
+        return [records[i] for i in ids if i in records]
+
+    def _delete_rows(self, conn, username):
+        for table in ("datasets", "projects", "items", "tombstones"):
+            conn.execute(f"DELETE FROM {table} WHERE username = ?", (username,))
+
+    def _item_row(self, username, item):
+        return (
+            username,
+            item["id"],
+            item.get("status"),
+            item.get("projectId"),
+            encode_text(item),
+            item.get("version", 0),
+        )
+
+    def _project_row(self, username, project):
+        return (
+            username,
+            project["id"],
+            project.get("status"),
+            encode_text(project),
+            project.get("version", 0),
+        )
+
+    def _next_id(self, conn, username, column, record):
+        if record.get("id") is None:
+            (record["id"],) = conn.execute(
+                f"SELECT {column} FROM datasets WHERE username = ?", (username,)
+            ).fetchone()
+        conn.execute(
+            f"UPDATE datasets SET {column} = MAX({column}, ?) WHERE username = ?",
+            (record["id"] + 1, username),
+        )
+
+    def _add_tombstone(self, conn, username, kind, record_id, version):
+        conn.execute(
+            "INSERT INTO tombstones (username, type, id, version) VALUES (?, ?, ?, ?)",
+            (username, kind, record_id, version),
+        )
+        row = conn.execute(
+            "SELECT version FROM tombstones WHERE username = ?"
+            " ORDER BY version DESC LIMIT 1 OFFSET ?",
+            (username, TOMBSTONE_LIMIT),
+        ).fetchone()
+        if row is not None:
+            # Clients that synced before this version may have missed a delete
+            conn.execute(
+                "DELETE FROM tombstones WHERE username = ? AND version <= ?",
+                (username, row[0]),
+            )
+            conn.execute(
+                "UPDATE datasets SET tombstones_from = MAX(tombstones_from, ?)"
+                " WHERE username = ?",
+                (row[0], username),
+            )
+
+    def _update_item(self, conn, username, item_id, updates, version):
+        row = conn.execute(
+            "SELECT record FROM items WHERE username = ? AND id = ?",
+            (username, item_id),
+        ).fetchone()
+        if row is None:
+            return None
+        item = decode_json(row[0])
+        _pin_done_at(item, updates)
+        item.update(_record_updates(updates, version))
+        conn.execute(
+            "UPDATE items SET status = ?, project_id = ?, record = ?, version = ?"
+            " WHERE username = ? AND id = ?",
+            self._item_row(username, item)[2:] + (username, item_id),
+        )
+        return item
+
+    def _update_project(self, conn, username, project_id, updates, version):
+        row = conn.execute(
+            "SELECT record FROM projects WHERE username = ? AND id = ?",
+            (username, project_id),
+        ).fetchone()
+        if row is None:
+            return None
+        project = decode_json(row[0])
+        project.update(_record_updates(updates, version))
+        conn.execute(
+            "UPDATE projects SET status = ?, record = ?, version = ?"
+            " WHERE username = ? AND id = ?",
+            self._project_row(username, project)[2:] + (username, project_id),
+        )
+        return project
+
+    def _apply_add_item(self, conn, username, change):
+        item = change["item"]
+        item["version"] = change["version"]
+        self._next_id(conn, username, "next_item_id", item)
+        conn.execute(
+            "INSERT OR REPLACE INTO items"
+            " (username, id, status, project_id, record, version)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            self._item_row(username, item),
+        )
+        return item
+
+    def _apply_update_item(self, conn, username, change):
+        return self._update_item(
+            conn, username, change["id"], change["updates"], change["version"]
+        )
+
+    def _apply_update_items(self, conn, username, change):
+        updated_count = 0
+        for update in change["updates"]:
+            item_id = update.get("id")
+            if item_id and self._update_item(
+                conn, username, item_id, update, change["version"]
+            ):
+                updated_count += 1
+        return updated_count
+
+    def _apply_delete_item(self, conn, username, change):
+        change = {"ids": [change["id"]], "version": change["version"]}
+        return self._apply_delete_items(conn, username, change) > 0
+
+    def _apply_add_items(self, conn, username, change):
+        return [
+            self._apply_add_item(
+                conn, username, {"item": item, "version": change["version"]}
+            )
+            for item in change["items"]
+        ]
+
+    def _apply_delete_items(self, conn, username, change):
+        deleted_count = 0
+        for item_id in change["ids"]:
+            cursor = conn.execute(
+                "DELETE FROM items WHERE username = ? AND id = ?", (username, item_id)
+            )
+            if cursor.rowcount:
+                self._add_tombstone(conn, username, "item", item_id, change["version"])
+                deleted_count += 1
+        return deleted_count
+
+    def _apply_delete_done_items(self, conn, username, change):
+        if "ids" not in change:
+            change["ids"] = [
+                item_id
+                for (item_id,) in conn.execute(
+                    "SELECT id FROM items"
+                    " WHERE username = ? AND json_extract(record, '$.done')",
+                    (username,),
+                )
+            ]
+        return self._apply_delete_items(conn, username, change)
+
+    def _apply_archive_items(self, conn, username, change):
+        archived_count = 0
+        for item_id in change["ids"]:
+            cursor = conn.execute(
+                "DELETE FROM items WHERE username = ? AND id = ?"
+                " AND json_extract(record, '$.done')",
+                (username, item_id),
+            )
+            if cursor.rowcount:
+                self._add_tombstone(conn, username, "item", item_id, change["version"])
+                archived_count += 1
+        return archived_count
+
+    def _apply_add_project(self, conn, username, change):
+        project = change["project"]
+        project["version"] = change["version"]
+        self._next_id(conn, username, "next_project_id", project)
+        conn.execute(
+            "INSERT OR REPLACE INTO projects (username, id, status, record, version)"
+            " VALUES (?, ?, ?, ?, ?)",
+            self._project_row(username, project),
+        )
+        return project
+
+    def _apply_update_project(self, conn, username, change):
+        return self._update_project(
+            conn, username, change["id"], change["updates"], change["version"]
+        )
+
+    def _apply_update_projects(self, conn, username, change):
+        updated_count = 0
+        for update in change["updates"]:
+            project_id = update.get("id")
+            if project_id and self._update_project(
+                conn, username, project_id, update, change["version"]
+            ):
+                updated_count += 1
+        return updated_count
+
+    def _apply_delete_project(self, conn, username, change):
+        change = {"ids": [change["id"]], "version": change["version"]}
+        return self._apply_delete_projects(conn, username, change) > 0
+
+    def _apply_add_projects(self, conn, username, change):
+        return [
+            self._apply_add_project(
+                conn, username, {"project": project, "version": change["version"]}
+            )
+            for project in change["projects"]
+        ]
+
+    def _apply_delete_projects(self, conn, username, change):
+        version = change["version"]
+        deleted_count = 0
+        for project_id in change["ids"]:
+            cursor = conn.execute(
+                "DELETE FROM projects WHERE username = ? AND id = ?",
+                (username, project_id),
+            )
+            if cursor.rowcount:
+                self._add_tombstone(conn, username, "project", project_id, version)
+                deleted_count += 1
+            item_ids = conn.execute(
+                "SELECT id FROM items WHERE username = ? AND project_id = ?",
+                (username, project_id),
+            ).fetchall()
+            # Remove project reference from items
+            for (item_id,) in item_ids:
+                updates = {"projectId": None, "status": "inbox"}
+                self._update_item(conn, username, item_id, updates, version)
+        return deleted_count
+
+    def _apply_reserve_ids(self, conn, username, change):
+        conn.execute(
+            "UPDATE datasets SET next_item_id = MAX(next_item_id, ?),"
+            " next_project_id = MAX(next_project_id, ?) WHERE username = ?",
+            (change.get("nextItemId", 1), change.get("nextProjectId", 1), username),
+        )
+        return True
+
+
+class WriteBehindStorage(Storage):
+    """Serves changed datasets from memory and writes them out later.
+
+    apply() and save_data() only update the in-memory dataset and mark the
+    user dirty. A background thread writes dirty users through the wrapped
+    backend WRITE_BEHIND_DELAY seconds after the first pending change, or as
+    soon as WRITE_BEHIND_MAX_CHANGES changes are pending, so a burst of
+    changes to one user costs a single write. Pending changes are flushed at
+    interpreter exit. Unflushed changes are invisible to other processes, so
+    this mode is only for single-process deployments.
+    """
+
+    def __init__(
+        self,
+        backend,
+        delay=WRITE_BEHIND_DELAY,
+        max_changes=WRITE_BEHIND_MAX_CHANGES,
+    ):
+        self.backend = backend
+        self.delay = delay
+        self.max_changes = max_changes
+        self.pending = {}  # username -> [dataset, number of changes]
+        self.pending_changes = 0
+        self.change_count = 0
+        self.flushed_changes = 0
+        self.writes = 0
+        self.condition = threading.Condition()
+        self.flusher = threading.Thread(
+            target=self._run, name="write-behind", daemon=True
+        )
+        self.flusher.start()
+        atexit.register(self.flush)
+
+    def load_users(self):
+        return self.backend.load_users()
+
+    def save_users(self, users):
+        self.backend.save_users(users)
+
+    def load_data(self, username):
+        with self.condition:
+            entry = self.pending.get(username)
+        if entry is not None:
+            return entry[0]
+        return self.backend.load_data(username)
+
+    def save_data(self, username, data):
+        with self.condition:
+            self._mark_dirty(username, as_dataset(data))
+
+    def lock(self, username):
+        return self.condition
+
+    def delete_data(self, username):
+        with self.condition:
+            entry = self.pending.pop(username, None)
+            if entry is not None:
+                self.pending_changes -= entry[1]
+            self.backend.delete_data(username)
+
+    @events.publishing
+    def apply(self, username, change):
+        with self.condition:
+            data = self.load_data(username)
+            result = apply_change(data, change)
+            self._mark_dirty(username, data)
+        return result
+
+    def flush(self):
+        """Write every dirty user through the backend"""
+        with self.condition:
+            usernames = list(self.pending)
+        for username in usernames:
+            # Hold the lock while writing so no request mutates the dataset
+            # mid-serialization; other requests wait for one write at most
+            with self.condition:
+                entry = self.pending.pop(username, None)
+                if entry is None:
+                    continue
+                try:
+                    self.backend.save_data(username, entry[0])
+                except BaseException:
+                    self.pending.setdefault(username, entry)
+                    raise
+                self.pending_changes -= entry[1]
+                self.flushed_changes += entry[1]
+                self.writes += 1
+
+    def stats(self):
+        with self.condition:
+            return {
+                "backend": type(self.backend).__name__,
+                "writeMode": "write-behind",
+                "dirtyUsers": len(self.pending),
+                "pendingChanges": self.pending_changes,
+                "changes": self.change_count,
+                "writes": self.writes,
+                "coalescedWrites": self.flushed_changes - self.writes,
+            }
+
+    def _mark_dirty(self, username, data):
+        entry = self.pending.setdefault(username, [data, 0])
+        entry[0] = data
+        entry[1] += 1
+        self.pending_changes += 1
+        self.change_count += 1
+        self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                deadline = time.monotonic() + self.delay
+                while self.pending_changes < self.max_changes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Write-behind flush failed: {e}")
+                time.sleep(self.delay)
+
+
+def create_storage(backend=STORAGE_BACKEND, write_mode=WRITE_MODE):
+    if backend == "json":
+        store = JsonStorage()
+    elif backend == "sqlite":
+        store = SqliteStorage(SQLITE_FILE)
+    else:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    if write_mode == "write-behind":
+        return WriteBehindStorage(store)
+    if write_mode not in ("immediate", "strict"):
+        raise ValueError(f"Unknown write mode: {write_mode}")
+    return store
+
+
+storage = create_storage()
+
+
+def migrate_json_to_sqlite(db_path=SQLITE_FILE):
+    """Copy users.json and every data_<username>.json into a SQLite database"""
+    source = JsonStorage()
+    target = SqliteStorage(db_path)
+    users = source.load_users()
+    if users is not None:
+        target.save_users(users)
+    usernames = set(users or {})
+    for name in os.listdir("."):
+        stem, ext = os.path.splitext(name)
+        if stem.startswith("data_") and ext in (".json", ".journal"):
+            usernames.add(stem[len("data_") :])
+    migrated = []
+    for username in sorted(usernames):
+        data_file = get_data_file(username)
+        if os.path.exists(data_file) or os.path.exists(get_journal_file(username)):
+            target.save_data(username, source.load_data(username))
+            migrated.append(username)
+    return migrated
+
+
+def users_lock():
+    """Lock to hold around read-modify-write of the user registry"""
+    return file_lock(USERS_FILE)
+
+
+def copy_users(users):
+    if users is None:
+        return None
+    return {username: dict(record) for username, record in users.items()}
+
+
+def load_users():
+    users = storage.load_users()
+    if users is not None and "admin" in users:
+        return users
+    with users_lock():
+        users = storage.load_users()
+        if users is not None:
+            if "admin" not in users:
+                users["admin"] = {"password": hash_password("admin"), "isAdmin": True}
+                save_users(users)
+            return users
+        default_users = {
+            "admin": {"password": hash_password("admin"), "isAdmin": True}
+        }
+        save_users(default_users)
+        return default_users
+
+
+def save_users(users):
+    storage.save_users(users)
+
+
+def load_data(username):
+    return storage.load_data(username)
+
+
+def save_data(username, data):
+    storage.replace_data(username, data)
+
+
+EXPORT_FORMAT = "gtd-export"
+EXPORT_VERSION = 1
+
+
+def iter_export_records(batch_size=STREAM_BATCH_RECORDS):
+    """Yield every user's account, projects, items and archived items.
+
+    Records come in lists of at most batch_size, and only one user's
+    dataset is loaded at a time.
+    """
+    users = load_users()
+    yield [
+        {
+            "type": "header",
+            "format": EXPORT_FORMAT,
+            "version": EXPORT_VERSION,
+            "exportedAt": datetime.now().isoformat(),
+        }
+    ]
+    for username in sorted(users):
+        data = storage.load_data(username)
+        yield [
+            {"type": "user", "username": username, "record": users[username]},
+            {
+                "type": "dataset",
+                "username": username,
+                "nextItemId": data.get("nextItemId", 1),
+                "nextProjectId": data.get("nextProjectId", 1),
+            },
+        ]
+        archived = list(load_archive(username).items_by_id.values())
+        # Copy the lists, which other requests may be changing meanwhile
+        for kind, records in (
+            ("project", list(data["projects"])),
+            ("item", list(data["items"])),
+            ("archived", archived),
+        ):
+            for start in range(0, len(records), batch_size):
+                yield [
+                    {"type": kind, "username": username, "record": record}
+                    for record in records[start : start + batch_size]
+                ]
+    yield [{"type": "end", "users": len(users)}]
+
+
+def iter_export_ndjson():
+    """Yield the export as newline-delimited JSON, one record a line"""
+    for records in iter_export_records():
+        yield b"".join(encode_json(record) + b"\n" for record in records)
+
+
+def iter_export_tar():
+    """Yield the export as a tar file.
+
+    It holds users.json, then data/<username>.json and, if the user has
+    one, archive/<username>.ndjson for each user, in the same formats as
+    the JsonStorage files.
+    """
+    out = io.BytesIO()
+
+    def take():
+        chunk = out.getvalue()
+        out.seek(0)
+        out.truncate()
+        return chunk
+
+    with tarfile.open(fileobj=out, mode="w|") as tar:
+
+        def add(name, body):
+            info = tarfile.TarInfo(name)
+            info.size = len(body)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(body))
+
+        users = load_users()
+        add("users.json", encode_json(users))
+        yield take()
+        for username in sorted(users):
+            data = storage.load_data(username)
+            dataset = {
+                k: v
+                for k, v in data.items()
+                if k not in ("tombstones", "tombstonesFrom")
+            }
+            add(f"data/{username}.json", encode_json(dataset))
+            try:
+                with open(get_archive_file(username), "rb") as f:
+                    add(f"archive/{username}.ndjson", f.read())
+            except FileNotFoundError:
+                pass
+            yield take()
+    yield take()
+
+
+def iter_ndjson_records(stream):
+    """Yield the records of an NDJSON export read from a binary stream"""
+    for line in stream:
+        if line.strip():
+            yield decode_json(line)
+
+
+def iter_tar_records(stream):
+    """Yield the records of a tar export, as iter_export_records() would"""
+    yield {"type": "header", "format": EXPORT_FORMAT, "version": EXPORT_VERSION}
+    users = {}
+    with tarfile.open(fileobj=stream, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            body = tar.extractfile(member).read()
+            kind, _, name = member.name.partition("/")
+            if member.name == "users.json":
+                users = decode_json(body)
+                if not isinstance(users, dict):
+                    raise ValueError("users.json is not an object")
+            elif kind == "data" and name.endswith(".json"):
+                username = name[: -len(".json")]
+                data = decode_snapshot(body)
+                if not isinstance(data, dict):
+                    raise ValueError(f"{member.name} is not an object")
+                yield {
+                    "type": "user",
+                    "username": username,
+                    "record": users.get(username),
+                }
+                yield {
+                    "type": "dataset",
+                    "username": username,
+                    "nextItemId": data.get("nextItemId", 1),
+                    "nextProjectId": data.get("nextProjectId", 1),
+                }
+                for kind in ("project", "item"):
+                    for record in data.get(kind + "s", ()):
+                        yield {"type": kind, "username": username, "record": record}
+            elif kind == "archive" and name.endswith(".ndjson"):
+                username = name[: -len(".ndjson")]
+                archive = Archive(iter_ndjson_records(io.BytesIO(body)))
+                for record in archive.items_by_id.values():
+                    yield {"type": "archived", "username": username, "record": record}
+    yield {"type": "end"}
+
+
+def iter_import_records(stream, import_format=None):
+    """Yield the records of an export in import_format ("ndjson" or "tar")"""
+    if import_format == "tar":
+        return iter_tar_records(stream)
+    return iter_ndjson_records(stream)
+
+
+IMPORT_COUNTS = {"project": "projects", "item": "items", "archived": "archived"}
+
+
+def expect_import_id(value, what):
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise ValueError(f"{what} must be a positive integer")
+    return value
+
+
+def check_import_account(username, account):
+    """Return an exported account if it looks like a users.json entry.
+
+    Anything else written to users.json would break every later login.
+    """
+    if account is None:
+        return None
+    if not isinstance(account, dict):
+        raise ValueError(f"Account of {username!r} is not an object")
+    password = account.get("password")
+    if "password" not in account or not isinstance(password, (str, type(None))):
+        raise ValueError(f"Account of {username!r} has no valid password")
+    for key in ("isAdmin", "needsPasswordReset"):
+        if not isinstance(account.get(key, False), bool):
+            raise ValueError(f"Account of {username!r} has a non-boolean {key}")
+    return account
+
+
+class ExportImporter:
+    """Adds the records of an export to storage, in batches.
+
+    Users missing here are created with their exported account. When a
+    user's dataset here has never had a record, projects and items keep
+    their ids and the exported next ids are reserved. Otherwise they get new
+    ids, items follow their project to its new id, and archived items
+    rejoin the working dataset until the next archive pass.
+    """
+
+    def __init__(self, storage, batch_size=IMPORT_BATCH_RECORDS):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.counts = dict.fromkeys(
+            ("users", "createdUsers", *IMPORT_COUNTS.values()), 0
+        )
+        self.records = 0
+        self.started = False
+        self.username = None
+
+    def add(self, record):
+        """Add one record; returns True if that wrote a batch"""
+        self.records += 1
+        if not isinstance(record, dict):
+            raise ValueError("Export records must be objects")
+        kind = record.get("type")
+        if not self.started:
+            if kind != "header" or record.get("format") != EXPORT_FORMAT:
+                raise ValueError("Not a GTD export")
+            if record.get("version") != EXPORT_VERSION:
+                raise ValueError(f"Unsupported export version {record.get('version')}")
+            self.started = True
+            return False
+        if kind == "user":
+            self.finish()
+            self._start_user(record["username"], record.get("record"))
+            return False
+        if kind in ("dataset", "project", "item", "archived"):
+            if record.get("username") != self.username:
+                raise ValueError(f"{kind} record outside its user's records")
+            if kind == "dataset":
+                self.next_ids = tuple(
+                    expect_import_id(record.get(key), key)
+                    for key in ("nextItemId", "nextProjectId")
+                )
+                return False
+            exported = record.get("record")
+            if not isinstance(exported, dict):
+                raise ValueError(f"{kind} record without an object")
+            if exported.get("id") is not None:
+                expect_import_id(exported["id"], f"{kind} id")
+            self.pending[kind].append(dict(exported))
+            if kind != "project" and self.pending["project"]:
+                # Items need their projects' ids
+                self._write("project")
+            if len(self.pending[kind]) >= self.batch_size:
+                self._write(kind)
+                return True
+            return False
+        if kind == "end":
+            return self.finish()
+        raise ValueError(f"Unknown export record type {kind!r}")
+
+    def finish(self):
+        """Write what is pending for the current user"""
+        if self.username is None:
+            return False
+        for kind in ("project", "item", "archived"):
+            if self.pending[kind]:
+                self._write(kind)
+        if self.keep_ids and self.next_ids:
+            self.storage.reserve_ids(self.username, *self.next_ids)
+        self.username = None
+        return True
+
+    def _start_user(self, username, account):
+        if not isinstance(username, str) or not username or (
+            set(username) & set("/\\\0")
+        ):
+            raise ValueError(f"Invalid username {username!r}")
+        with users_lock():
+            users = load_users()
+            if username not in users:
+                users[username] = check_import_account(username, account) or {
+                    "password": None,
+                    "isAdmin": False,
+                    "needsPasswordReset": True,
+                }
+                save_users(users)
+                self.counts["createdUsers"] += 1
+        self.counts["users"] += 1
+        data = self.storage.load_data(username)
+        self.keep_ids = data.get("nextItemId", 1) == data.get("nextProjectId", 1) == 1
+        self.username = username
+        self.next_ids = None
+        self.project_ids = {}  # exported id -> id here
+        self.pending = {"project": [], "item": [], "archived": []}
+
+    def _write(self, kind):
+        records, self.pending[kind] = self.pending[kind], []
+        self.counts[IMPORT_COUNTS[kind]] += len(records)
+        if kind == "archived" and self.keep_ids:
+            append_archive(self.username, {"archived": records})
+            return
+        if kind == "project":
+            old_ids = [p.get("id") for p in records]
+            if not self.keep_ids:
+                for project in records:
+                    project["id"] = None
+            added = self.storage.add_projects(self.username, records)
+            self.project_ids.update(zip(old_ids, (p["id"] for p in added)))
+            return
+        if not self.keep_ids:
+            for item in records:
+                item["id"] = None
+                project_id = item.get("projectId")
+                if project_id is not None:
+                    item["projectId"] = self.project_ids.get(project_id)
+                    if item["projectId"] is None:
+                        item["status"] = "inbox"
+        self.storage.add_items(self.username, records)
+
+
+def iter_import_progress(importer, records):
+    """Import records, yielding NDJSON progress lines as batches are written"""
+    try:
+        for record in records:
+            if importer.add(record):
+                yield encode_json(dict(importer.counts, type="progress")) + b"\n"
+        importer.finish()
+        yield encode_json(dict(importer.counts, type="done")) + b"\n"
+    except (ValueError, KeyError, TypeError, tarfile.TarError) as e:
+        # Whole batches written so far stay imported
+        message = f"Import stopped at record {importer.records}: {e}"
+        yield encode_json(dict(importer.counts, type="error", message=message)) + b"\n"
+
+
+def export_to_file(path):
+    """Write an export to path, a tar file if it ends in .tar, or stdout for -"""
+    chunks = iter_export_tar() if path.endswith(".tar") else iter_export_ndjson()
+    if path == "-":
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+        return
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def import_from_file(path):
+    """Import an export file, printing progress; returns False on an error"""
+    tar = path.endswith((".tar", ".tar.gz", ".tgz"))
+    with open(path, "rb") as f:
+        records = iter_import_records(f, "tar" if tar else "ndjson")
+        for line in iter_import_progress(ExportImporter(storage), records):
+            print(line.decode("utf-8"), end="")
+            if decode_json(line)["type"] == "error":
+                return False
+    return True
+
+
+def get_search_file(username):
+    return f"search_{username}.json"
+
+
+# Fields indexed for search, with the weight of a token found in each
+SEARCH_FIELDS = {"item": {"title": 2, "notes": 1}, "project": {"name": 2, "outcome": 1}}
+
+
+def search_tokens(text):
+    return re.findall(r"\w+", text.casefold())
+
+
+class SearchIndex:
+    """Inverted index over one user's item and project texts.
+
+    Documents are kept as token -> weight maps, keyed "item:<id>" or
+    "project:<id>", with the dataset version they are current for. Before
+    each search the index catches up through storage.changes(), so only
+    records changed since its version are reindexed; it is rebuilt only
+    when changes() asks for a reset. The documents are saved to
+    search_<username>.json every SEARCH_SAVE_CHANGES reindexed records and
+    at exit, so a new process does not start from scratch.
+    """
+
+    def __init__(self, username):
+        self.username = username
+        self.version = 0
+        self.docs = {}  # "kind:id" -> {token: weight}
+        self.postings = {}  # token -> {"kind:id": weight}
+        self.vocabulary = []  # sorted tokens, for prefix matching
+        self.unsaved = 0
+        self.lock = threading.Lock()
+        saved = read_json_file(get_search_file(username))
+        if saved is not None:
+            self.version = saved["version"]
+            for key, tokens in saved["docs"].items():
+                self._add(key, tokens)
+
+    def refresh(self, storage):
+        """Bring the index up to date with the user's dataset"""
+        changes = storage.changes(self.username, self.version)
+        if changes.get("reset"):
+            data = storage.load_data(self.username)
+            self.docs, self.postings, self.vocabulary = {}, {}, []
+            changes = dict(
+                data, deleted={"items": [], "projects": []}, version=data["version"]
+            )
+            self.unsaved = SEARCH_SAVE_CHANGES
+        for kind in ("item", "project"):
+            for record_id in changes["deleted"][kind + "s"]:
+                self._remove(f"{kind}:{record_id}")
+            for record in changes[kind + "s"]:
+                key = f"{kind}:{record['id']}"
+                self._remove(key)
+                self._add(key, self._document(kind, record))
+                self.unsaved += 1
+        self.version = changes["version"]
+        if self.unsaved >= SEARCH_SAVE_CHANGES:
+            self.save()
+
+    def save(self):
+        state = {"version": self.version, "docs": self.docs}
+        write_json_file_atomic(get_search_file(self.username), state)
+        self.unsaved = 0
+
+    def search(self, query, limit):
+        """Return [(score, kind, id)] of the best documents matching query.
+
+        Every query term must match a token of the document, exactly or as
+        its prefix. Scores add up BM25-style term weights, with prefix
+        matches counting half.
+        """
+        scores = None
+        for term in set(search_tokens(query)):
+            term_scores = {}
+            position = bisect.bisect_left(self.vocabulary, term)
+            for token in self.vocabulary[position:]:
+                if not token.startswith(term):
+                    break
+                postings = self.postings[token]
+                idf = math.log(1 + len(self.docs) / len(postings))
+                boost = 1.0 if token == term else 0.5
+                for key, weight in postings.items():
+                    score = boost * idf * weight / (weight + 1.2)
+                    term_scores[key] = term_scores.get(key, 0) + score
+            if scores is not None:
+                # Keep only documents that matched every term so far
+                term_scores = {
+                    k: v + scores[k] for k, v in term_scores.items() if k in scores
+                }
+            scores = term_scores
+            if not scores:
+                return []
+        if scores is None:
+            return []
+        ranked = heapq.nsmallest(
+            limit, scores.items(), key=lambda entry: (-entry[1], entry[0])
+        )
+        results = []
+        for key, score in ranked:
+            kind, record_id = key.split(":")
+            results.append((score, kind, int(record_id)))
+        return results
+
+    def _document(self, kind, record):
+        tokens = {}
+        for field, weight in SEARCH_FIELDS[kind].items():
+            if isinstance(record.get(field), str):
+                for token in search_tokens(record[field]):
+                    tokens[token] = tokens.get(token, 0) + weight
+        return tokens
+
+    def _add(self, key, tokens):
+        self.docs[key] = tokens
+        for token, weight in tokens.items():
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = {}
+                bisect.insort(self.vocabulary, token)
+            postings[key] = weight
+
+    def _remove(self, key):
+        for token in self.docs.pop(key, ()):
+            postings = self.postings[token]
+            del postings[key]
+            if not postings:
+                del self.postings[token]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, token)]
+
+
+search_indexes = OrderedDict()  # username -> SearchIndex, least recent first
+search_indexes_lock = threading.Lock()
+
+
+def search_index(username):
+    """Return the user's SearchIndex, loading it if it is not in memory"""
+    with search_indexes_lock:
+        index = search_indexes.get(username)
+        if index is not None:
+            search_indexes.move_to_end(username)
+            return index
+        index = search_indexes[username] = SearchIndex(username)
+        while len(search_indexes) > CACHE_MAX_ENTRIES:
+            _, evicted = search_indexes.popitem(last=False)
+            with evicted.lock:
+                if evicted.unsaved:
+                    evicted.save()
+        return index
+
+
+def delete_search_index(username):
+    with search_indexes_lock:
+        search_indexes.pop(username, None)
+        if os.path.exists(get_search_file(username)):
+            os.remove(get_search_file(username))
+
+
+@atexit.register
+def save_search_indexes():
+    with search_indexes_lock:
+        indexes = list(search_indexes.values())
+    for index in indexes:
+        with index.lock:
+            if index.unsaved:
+                index.save()
+
+
+SECRET_KEY_MIN_BYTES = 32
+
+
+@functools.lru_cache(maxsize=None)
+def load_secret_key():
+    """Return the session signing key, creating secret_key on first use.
+
+    The key is written to a temporary file and linked into place, so other
+    processes only ever see a complete key file. A key that is too short is
+    never used: the file is re-read for a while, in case another process
+    is still writing it the old way, and then it is an error.
+    """
+    key = os.environ.get("GTD_SECRET_KEY")
+    if key:
+        key = key.encode("utf-8")
+        if len(key) < SECRET_KEY_MIN_BYTES:
+            raise RuntimeError(
+                f"GTD_SECRET_KEY must be at least {SECRET_KEY_MIN_BYTES} bytes"
+            )
+        return key
+    key = secrets.token_hex(32).encode("utf-8")
+    directory = os.path.dirname(os.path.abspath(SECRET_KEY_FILE))
+    fd, tmp_path = tempfile.mkstemp(prefix=".secret_key.", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+            f.flush()
+            os.fsync(f.fileno())
+        os.link(tmp_path, SECRET_KEY_FILE)
+        return key
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+    for _ in range(50):
+        with open(SECRET_KEY_FILE, "rb") as f:
+            key = f.read().strip()
+        if len(key) >= SECRET_KEY_MIN_BYTES:
+            return key
+        time.sleep(0.1)
+    raise RuntimeError(f"{SECRET_KEY_FILE} holds no usable key; delete it to make one")
+
+
+sessions_cache = FileCache(1, CACHE_MAX_BYTES)
+revocations_cache = FileCache(1, CACHE_MAX_BYTES)
+
+
+def load_sessions():
+    """Return session_id -> username, re-read whenever sessions.json changes"""
+    sessions = sessions_cache.load(
+        SESSIONS_FILE, lambda: read_json_file(SESSIONS_FILE)
+    )
+    return sessions if sessions is not None else {}
+
+
+def save_sessions(sessions):
+    write_json_file_atomic(SESSIONS_FILE, sessions)
+    sessions_cache.store(SESSIONS_FILE, sessions)
+
+
+def b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def sign_session(payload):
+    key = load_secret_key()
+    return b64encode(hmac.new(key, payload.encode("ascii"), "sha256").digest())
+
+
+def create_signed_session(username, max_age=SESSION_MAX_AGE):
+    """Return a token "<username>.<expires>.<nonce>.<signature>" """
+    expires = int(time.time()) + max_age
+    payload = f"{b64encode(username.encode('utf-8'))}.{expires}.{secrets.token_hex(8)}"
+    return f"{payload}.{sign_session(payload)}"
+
+
+def parse_signed_session(token):
+    """Return (username, expires, nonce) for a valid token, else None"""
+    try:
+        user_part, expires, nonce, signature = token.split(".")
+        payload = f"{user_part}.{expires}.{nonce}"
+        if not hmac.compare_digest(signature, sign_session(payload)):
+            return None
+        if int(expires) < time.time():
+            return None
+        return b64decode(user_part).decode("utf-8"), int(expires), nonce
+    except ValueError:
+        return None
+
+
+def load_revoked_sessions():
+    """Return nonce -> expiry for signed sessions ended by logout"""
+    return revocations_cache.load(
+        REVOKED_SESSIONS_FILE, lambda: read_json_file(REVOKED_SESSIONS_FILE)
+    ) or {}
+
+
+def revoke_signed_session(token):
+    session = parse_signed_session(token)
+    if session is None:
+        return
+    _, expires, nonce = session
+    now = time.time()
+    with file_lock(REVOKED_SESSIONS_FILE):
+        # Tokens expire by themselves, so only unexpired revocations are kept
+        revoked = {n: e for n, e in load_revoked_sessions().items() if e >= now}
+        revoked[nonce] = expires
+        write_json_file_atomic(REVOKED_SESSIONS_FILE, revoked)
+        revocations_cache.store(REVOKED_SESSIONS_FILE, revoked)
+
+
+def create_session(username):
+    """Start a session for username and return its cookie value"""
+    if SESSION_MODE == "signed":
+        return create_signed_session(username)
+    session_id = secrets.token_hex(16)
+    with file_lock(SESSIONS_FILE):
+        sessions = load_sessions()
+        sessions[session_id] = username
+        save_sessions(sessions)
+    return session_id
+
+
+def end_session(session_id):
+    if SESSION_MODE == "signed":
+        revoke_signed_session(session_id)
+        return
+    with file_lock(SESSIONS_FILE):
+        sessions = load_sessions()
+        if sessions.pop(session_id, None) is not None:
+            save_sessions(sessions)
+
+
+def session_username(session_id):
+    if SESSION_MODE == "signed":
+        session = parse_signed_session(session_id)
+        if session is None or session[2] in load_revoked_sessions():
+            return None
+        return session[0]
+    return load_sessions().get(session_id)
+
+
+def session_cookie_header(session_id):
+    cookie = SimpleCookie()
+    cookie["session_id"] = session_id
+    cookie["session_id"]["path"] = "/"
+    cookie["session_id"]["max-age"] = SESSION_MAX_AGE
+    return ("Set-Cookie", cookie["session_id"].OutputString())
+
+
+def get_session_username(environ):
+    """Extract username from session cookie"""
+    cookie_header = environ.get("HTTP_COOKIE", "")
+    if cookie_header:
+        cookie = SimpleCookie(cookie_header)
+        if "session_id" in cookie:
+            session_id = cookie["session_id"].value
+            return session_username(session_id)
+    return None
+
+
+def accepted_encodings(environ):
+    """Return the content codings allowed by the Accept-Encoding header"""
+    accepted = set()
+    for part in environ.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        coding, _, params = part.partition(";")
+        name, _, value = params.strip().partition("=")
+        try:
+            quality = float(value) if name.strip() == "q" else 1.0
+        except ValueError:
+            quality = 0.0
+        if coding.strip() and quality > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def choose_encoding(environ, available=COMPRESSIONS):
+    """Return the first of available the client accepts, or None"""
+    accepted = accepted_encodings(environ)
+    for coding in available:
+        if coding in accepted or "*" in accepted:
+            return coding
+    return None
+
+
+def compress_chunks(chunks, coding, best=False):
+    """Yield chunks compressed with coding ("br" or "gzip") as one stream.
+
+    best trades speed for size, for content that is compressed once and
+    served many times.
+    """
+    if coding == "br":
+        compressor = brotli.Compressor(quality=11 if best else 4)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        # wbits 31 selects the gzip container
+        compressor = zlib.compressobj(9 if best else 6, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+    try:
+        for chunk in chunks:
+            compressed = compress(chunk)
+            if compressed:
+                yield compressed
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_responses(app):
+    """WSGI middleware compressing JSON responses as Accept-Encoding allows.
+
+    Only responses of at least COMPRESS_MIN_BYTES, or of unknown length, are
+    compressed; responses that already have a Content-Encoding pass through.
+    The wrapped app must call start_response before returning its body.
+    """
+
+    @functools.wraps(app)
+    def compressing_app(environ, start_response):
+        coding = choose_encoding(environ)
+        if coding is None:
+            return app(environ, start_response)
+        started = []
+        body = app(environ, lambda *args: started.extend(args))
+        status, headers = started[0], started[1]
+        fields = {name.lower(): value for name, value in headers}
+        length = int(fields.get("content-length", COMPRESS_MIN_BYTES))
+        if (
+            "json" not in fields.get("content-type", "")
+            or "content-encoding" in fields
+            or "no-transform" in fields.get("cache-control", "")
+            or length < COMPRESS_MIN_BYTES
+        ):
+            start_response(*started)
+            return body
+        headers = [h for h in headers if h[0].lower() != "content-length"]
+        headers += [("Content-Encoding", coding), ("Vary", "Accept-Encoding")]
+        if isinstance(body, list):
+            body = [b"".join(compress_chunks(body, coding))]
+            headers.append(("Content-Length", str(len(body[0]))))
+        else:
+            body = compress_chunks(body, coding)
+        start_response(status, headers, *started[2:])
+        return body
+
+    return compressing_app
+
+
+class StaticFile:
+    """A file's contents, precompressed variants and cache validators"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            mtime = os.fstat(f.fileno()).st_mtime
+            body = f.read()
+        self.variants = {None: body}
+        for coding in COMPRESSIONS:
+            self.variants[coding] = b"".join(compress_chunks([body], coding, True))
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        self.mtime = int(mtime)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+
+    def etag(self, coding):
+        # Each variant is a different representation and needs its own tag
+        return f'"{self.digest}-{coding}"' if coding else f'"{self.digest}"'
+
+
+static_cache = FileCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES)
+
+
+def respond_static(environ, start_response, path, content_type):
+    """Serve a file from memory, re-read whenever it changes on disk"""
+    static = static_cache.load(path, lambda: StaticFile(path))
+    coding = choose_encoding(environ)
+    headers = [
+        ("ETag", static.etag(coding)),
+        ("Last-Modified", static.last_modified),
+        ("Cache-Control", "no-cache"),
+        ("Vary", "Accept-Encoding"),
+    ]
+    if is_not_modified(environ, static.etag(coding), static.mtime):
+        start_response("304 Not Modified", headers)
+        return [b""]
+    body = static.variants[coding]
+    headers += [("Content-type", content_type), ("Content-Length", str(len(body)))]
+    if coding:
+        headers.append(("Content-Encoding", coding))
+    start_response("200 OK", headers)
+    return [body]
+
+
+def respond_json(start_response, status, payload, extra_headers=None):
+    with metrics.phase("encode_response"):
+        body = encode_json(payload)
+    headers = [("Content-type", "application/json")]
+    if extra_headers:
+        headers.extend(extra_headers)
+    headers.append(("Content-Length", str(len(body))))
+    start_response(status, headers)
+    return [body]
+
+
+def iter_json_object(payload, streamed_keys, batch_size=STREAM_BATCH_RECORDS):
+    """Yield the JSON encoding of payload, a dict, in pieces.
+
+    The lists under streamed_keys are encoded batch_size records at a time,
+    so neither the whole document nor its bytes are ever held at once. The
+    output is the same as encode_json(payload).
+    """
+    yield b"{"
+    for n, (key, value) in enumerate(payload.items()):
+        prefix = (b"," if n else b"") + encode_json(key) + b":"
+        if key not in streamed_keys:
+            yield prefix + encode_json(value)
+            continue
+        yield prefix + b"["
+        for start in range(0, len(value), batch_size):
+            # Encoding a batch as a list and dropping the brackets is
+            # faster than joining the records' encodings
+            batch = encode_json(value[start : start + batch_size])[1:-1]
+            yield (b"," if start else b"") + batch
+        yield b"]"
+    yield b"}"
+
+
+def respond_json_records(
+    start_response, status, payload, streamed_keys, extra_headers=None
+):
+    """Respond with payload, streaming its record lists if they are large"""
+    if all(len(payload[k]) <= STREAM_BATCH_RECORDS for k in streamed_keys):
+        return respond_json(start_response, status, payload, extra_headers)
+    # Copy the lists now: the body is encoded after this returns, while
+    # other requests may be adding or removing records
+    payload = dict(payload)
+    for key in streamed_keys:
+        payload[key] = list(payload[key])
+    headers = [("Content-type", "application/json")]
+    if extra_headers:
+        headers.extend(extra_headers)
+    start_response(status, headers)
+    return iter_json_object(payload, streamed_keys)
+
+
+def dataset_etag(username, data):
+    """Return the ETag of a user's dataset.
+
+    Versions count up from 1 in every user's dataset, and again in one
+    recreated under the same name, so the tag also carries a hash of the
+    username and the dataset's random id. It is weak because the body may
+    be sent compressed.
+    """
+    identity = f"{username}\0{data.get('datasetId', '')}".encode("utf-8")
+    digest = hashlib.sha256(identity).hexdigest()[:16]
+    return f'W/"{digest}-{data.get("version", 0)}"'
+
+
+def etag_matches(environ, etag):
+    if_none_match = environ.get("HTTP_IF_NONE_MATCH", "")
+    # If-None-Match uses the weak comparison
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in tags or "*" in tags
+
+
+def is_not_modified(environ, etag, mtime):
+    """Whether the request's validators show the client's copy is current"""
+    if "HTTP_IF_NONE_MATCH" in environ:
+        return etag_matches(environ, etag)
+    try:
+        since = parsedate_to_datetime(environ["HTTP_IF_MODIFIED_SINCE"])
+        return mtime <= since.timestamp()
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def respond_not_modified(start_response, etag, extra_headers=None):
+    start_response("304 Not Modified", [("ETag", etag)] + (extra_headers or []))
+    return [b""]
+
+
+class HTTPError(Exception):
+    """Raised by request handling code to respond with an error status"""
+
+    def __init__(self, status, payload, headers=()):
+        super().__init__(status)
+        self.status = status
+        self.payload = payload
+        self.headers = list(headers)
+
+
+def handle_http_errors(app):
+    """WSGI middleware turning HTTPError into a JSON error response"""
+
+    @functools.wraps(app)
+    def error_handling_app(environ, start_response):
+        try:
+            return app(environ, start_response)
+        except HTTPError as e:
+            return respond_json(start_response, e.status, e.payload, e.headers)
+
+    return error_handling_app
+
+
+def instrument_requests(app):
+    """WSGI middleware recording each request's status, size and latency.
+
+    A request is timed until its body has been sent, so streamed responses
+    include the time spent encoding them. Requests taking SLOW_REQUEST_MS or
+    more are logged to stderr along with their phase timings.
+    """
+
+    @functools.wraps(app)
+    def instrumented_app(environ, start_response):
+        started = time.perf_counter()
+        phases = metrics.begin_request()
+        response = {"status": "500"}  # if app raises before starting one
+
+        def recording_start_response(status, headers, *exc_info):
+            response["status"] = status.split(" ", 1)[0]
+            return start_response(status, headers, *exc_info)
+
+        def finish(size):
+            record_request(environ, response["status"], size, started, phases)
+
+        try:
+            body = app(environ, recording_start_response)
+        except BaseException:
+            finish(0)
+            raise
+        finally:
+            metrics.end_request()
+        if isinstance(body, list):
+            finish(sum(map(len, body)))
+            return body
+        return iter_counted(body, finish)
+
+    return instrumented_app
+
+
+def iter_counted(body, finish):
+    """Yield body's chunks, then call finish(total bytes) once it is done"""
+    size = 0
+    try:
+        for chunk in body:
+            size += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+        finish(size)
+
+
+def record_request(environ, status, size, started, phases):
+    elapsed = time.perf_counter() - started
+    method = environ["REQUEST_METHOD"]
+    # Unmatched paths share one label so they cannot grow the series
+    labels = (("method", method), ("route", environ.get("gtd.route", "unmatched")))
+    content_length = environ.get("CONTENT_LENGTH") or ""
+    metrics.inc("gtd_http_requests_total", labels + (("status", status),))
+    metrics.observe("gtd_http_request_duration_seconds", labels, elapsed)
+    metrics.inc(
+        "gtd_http_request_bytes_total",
+        labels,
+        int(content_length) if content_length.isdigit() else 0,
+    )
+    metrics.inc("gtd_http_response_bytes_total", labels, size)
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        metrics.inc("gtd_slow_requests_total")
+        timings = ", ".join(f"{p} {s * 1000:.1f} ms" for p, s in sorted(phases.items()))
+        print(
+            f"Slow request: {method} {environ.get('PATH_INFO', '')} {status}"
+            f" in {elapsed * 1000:.1f} ms, {size} bytes"
+            + (f" ({timings})" if timings else ""),
+            file=sys.stderr,
+        )
+
+
+def respond_text(start_response, status, text):
+    headers = [("Content-type", "text/plain")]
+    start_response(status, headers)
+    return [text.encode("utf-8")]
+
+
+def read_json_body(environ):
+    content_length = int(environ.get("CONTENT_LENGTH") or 0)
+    if content_length > MAX_BODY_BYTES:
+        raise HTTPError("413 Payload Too Large", {"error": "Request body too large"})
+    body = environ["wsgi.input"].read(content_length)
+    if not body:
+        return {}
+    with metrics.phase("decode_request"):
+        return decode_json(body)
+
+
+class RequestBody(io.RawIOBase):
+    """The request body as a stream, stopping at CONTENT_LENGTH.
+
+    wsgi.input may block past the end of the body, so nothing beyond
+    CONTENT_LENGTH is ever read from it.
+    """
+
+    def __init__(self, environ):
+        self.input = environ["wsgi.input"]
+        self.remaining = int(environ.get("CONTENT_LENGTH") or 0)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        chunk = self.input.read(size)
+        buffer[: len(chunk)] = chunk
+        self.remaining = self.remaining - len(chunk) if chunk else 0
+        return len(chunk)
+
+
+def new_item(req_data):
+    return {
+        "title": req_data.get("title", ""),
+        "notes": req_data.get("notes"),
+        "status": req_data.get("status", "inbox"),
+        "projectId": req_data.get("projectId"),
+        "startTime": req_data.get("startTime"),
+        "dueDatetime": req_data.get("dueDatetime"),
+        "position": req_data.get("position", 0),
+        "id": None,  # assigned by storage
+        "createdAt": datetime.now().isoformat(),
+    }
+
+
+def new_project(req_data):
+    return {
+        "name": req_data.get("name", ""),
+        "outcome": req_data.get("outcome"),
+        "status": req_data.get("status", "active"),
+        "id": None,  # assigned by storage
+        "createdAt": datetime.now().isoformat(),
+    }
+
+
+class PasswordHasher:
+    """Runs password hashing on a bounded thread pool.
+
+    hashlib releases the GIL during PBKDF2, so the workers hash in parallel
+    while the requests that asked wait for them. Only workers + queue_limit
+    hashes are admitted at a time; run() refuses any more with a 503 at
+    once, so a burst of logins cannot tie up every request thread.
+    """
+
+    def __init__(self, workers=HASH_WORKERS, queue_limit=HASH_QUEUE_LIMIT):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="hash")
+        self.slots = threading.Semaphore(workers + queue_limit)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.hash_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def run(self, func, *args):
+        """Return func(*args) computed on the pool"""
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise HTTPError(
+                "503 Service Unavailable",
+                {"success": False, "message": "Server busy, please try again"},
+                [("Retry-After", "1")],
+            )
+        submitted = time.monotonic()
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            started, result = self.executor.submit(self._timed, func, args).result()
+        finally:
+            self.slots.release()
+            with self.lock:
+                self.in_flight -= 1
+        finished = time.monotonic()
+        metrics.observe_phase("password_hash_wait", started - submitted)
+        metrics.observe_phase("password_hash", finished - started)
+        with self.lock:
+            self.completed += 1
+            self.wait_seconds += started - submitted
+            self.hash_seconds += finished - started
+            self.max_seconds = max(self.max_seconds, finished - submitted)
+        return result
+
+    def _timed(self, func, args):
+        return time.monotonic(), func(*args)
+
+    def stats(self):
+        with self.lock:
+            completed = self.completed or 1
+            return {
+                "workers": self.workers,
+                "inFlight": self.in_flight,
+                "queued": max(0, self.in_flight - self.workers),
+                "peakInFlight": self.peak_in_flight,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avgWaitMs": round(self.wait_seconds / completed * 1000, 3),
+                "avgHashMs": round(self.hash_seconds / completed * 1000, 3),
+                "maxLatencyMs": round(self.max_seconds * 1000, 3),
+            }
+
+
+class LoginThrottle:
+    """Sliding-window limit on login attempts per username and per client IP.
+
+    Counts are kept per process, so with several server processes a client
+    gets up to that many times the limit.
+    """
+
+    def __init__(
+        self,
+        window=LOGIN_WINDOW_SECONDS,
+        user_limit=LOGIN_USER_LIMIT,
+        ip_limit=LOGIN_IP_LIMIT,
+    ):
+        self.window = window
+        self.limits = {"user": user_limit, "ip": ip_limit}
+        self.attempts = {}  # (kind, value) -> deque of attempt times
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def attempt(self, username, ip):
+        """Record a login attempt, raising a 429 HTTPError if over a limit"""
+        now = time.monotonic()
+        keys = [
+            key
+            for key in (("user", username), ("ip", ip))
+            if self.limits[key[0]] > 0
+        ]
+        with self.lock:
+            if len(self.attempts) > 10000:
+                self._expire(now)
+            retry_after = 0
+            for key in keys:
+                attempts = self.attempts.get(key, ())
+                while attempts and attempts[0] <= now - self.window:
+                    attempts.popleft()
+                if len(attempts) >= self.limits[key[0]]:
+                    retry_after = max(retry_after, attempts[0] + self.window - now)
+            if retry_after:
+                self.throttled += 1
+            else:
+                for key in keys:
+                    self.attempts.setdefault(key, deque()).append(now)
+        if retry_after:
+            raise HTTPError(
+                "429 Too Many Requests",
+                {"success": False, "message": "Too many login attempts, try later"},
+                [("Retry-After", str(int(retry_after) + 1))],
+            )
+
+    def _expire(self, now):
+        self.attempts = {
+            key: attempts
+            for key, attempts in self.attempts.items()
+            if attempts and attempts[-1] > now - self.window
+        }
+
+    def stats(self):
+        with self.lock:
+            return {"tracked": len(self.attempts), "throttled": self.throttled}
+
+
+password_hasher = PasswordHasher()
+login_throttle = LoginThrottle()
+
+
+def client_ip(environ):
+    """The client's IP, from CLIENT_IP_HEADER when a proxy sets it"""
+    if CLIENT_IP_HEADER:
+        name = "HTTP_" + CLIENT_IP_HEADER.upper().replace("-", "_")
+        addresses = [a.strip() for a in environ.get(name, "").split(",")]
+        # The proxy appends the address it saw; earlier ones are the client's
+        # word and could be forged
+        if addresses[-1]:
+            return addresses[-1]
+    return environ.get("REMOTE_ADDR", "")
+
+
+def require_auth(environ, start_response):
+    username = get_session_username(environ)
+    if not username:
+        return "", respond_json(
+            start_response, "401 Unauthorized", {"error": "Not authenticated"}
+        )
+    return username, None
+
+
+def require_admin(username, start_response):
+    users = load_users()
+    if not users.get(username, {}).get("isAdmin", False):
+        return {}, respond_json(
+            start_response, "403 Forbidden", {"error": "Admin access required"}
+        )
+    return users, None
+
+
+def require_admin_user(environ, start_response):
+    username, error_response = require_auth(environ, start_response)
+    if error_response:
+        return "", {}, error_response
+    users, error_response = require_admin(username, start_response)
+    if error_response:
+        return "", {}, error_response
+    return username, users, None
+
+
+class Request:
+    """A request as seen by route handlers"""
+
+    def __init__(self, environ, params):
+        self.environ = environ
+        self.params = params
+        self.username = None  # set by the user_required/admin_required hooks
+        self.users = None  # the user registry, set by admin_required
+
+    def json(self):
+        """Return the parsed JSON body; a malformed body is a 400"""
+        try:
+            return read_json_body(self.environ)
+        except ValueError:
+            raise HTTPError("400 Bad Request", {"error": "Invalid JSON body"})
+
+    def query(self, name):
+        """Return the first value of query parameter name, or None"""
+        values = parse_qs(self.environ.get("QUERY_STRING", "")).get(name)
+        return values[0] if values else None
+
+
+def user_required(request, start_response):
+    request.username, error_response = require_auth(request.environ, start_response)
+    return error_response
+
+
+def admin_required(request, start_response):
+    request.username, request.users, error_response = require_admin_user(
+        request.environ, start_response
+    )
+    return error_response
+
+
+class Route:
+    def __init__(self, method, pattern, handler, auth):
+        self.method = method
+        self.pattern = pattern
+        self.handler = handler
+        self.auth = auth
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+
+class Router:
+    """Dispatches requests to handlers registered per (method, path pattern).
+
+    Patterns may contain typed parameters like "/api/items/<int:item_id>",
+    passed to the handler as keyword arguments; a path whose parameter does
+    not convert does not match. Paths without parameters are found with one
+    dict lookup. Before a handler runs, the route's auth hook may answer the
+    request instead, and each route keeps timings of its handler calls.
+    """
+
+    CONVERTERS = {"int": (r"-?\d+", int), "str": (r"[^/]+", str)}
+
+    def __init__(self):
+        self.static = {}  # (method, path) -> Route
+        self.dynamic = {}  # method -> [(compiled pattern, converters, Route)]
+        self.routes = []
+        self.lock = threading.Lock()
+
+    def route(self, method, pattern, auth=None):
+        """Decorator registering a handler(request, start_response, **params)"""
+
+        def register(handler):
+            self.add(Route(method, pattern, handler, auth))
+            return handler
+
+        return register
+
+    def add(self, route):
+        self.routes.append(route)
+        if "<" not in route.pattern:
+            self.static[(route.method, route.pattern)] = route
+            return
+        regex, converters = "", {}
+        for part in re.split(r"(<[^>]+>)", route.pattern):
+            if part.startswith("<"):
+                kind, name = part[1:-1].split(":")
+                regex += f"(?P<{name}>{self.CONVERTERS[kind][0]})"
+                converters[name] = self.CONVERTERS[kind][1]
+            else:
+                regex += re.escape(part)
+        compiled = re.compile(regex + "$")
+        self.dynamic.setdefault(route.method, []).append((compiled, converters, route))
+
+    def match(self, method, path):
+        """Return (route, params) for a request, or (None, None)"""
+        route = self.static.get((method, path))
+        if route is not None:
+            return route, {}
+        for compiled, converters, route in self.dynamic.get(method, ()):
+            m = compiled.match(path)
+            if m:
+                params = {k: converters[k](v) for k, v in m.groupdict().items()}
+                return route, params
+        return None, None
+
+    def dispatch(self, environ, start_response):
+        route, params = self.match(environ["REQUEST_METHOD"], environ["PATH_INFO"])
+        if route is None:
+            return respond_text(start_response, "404 Not Found", "Not Found")
+        environ["gtd.route"] = route.pattern
+        request = Request(environ, params)
+        if route.auth is not None:
+            error_response = route.auth(request, start_response)
+            if error_response:
+                return error_response
+        started = time.perf_counter()
+        try:
+            return route.handler(request, start_response, **params)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                route.calls += 1
+                route.seconds += elapsed
+                route.max_seconds = max(route.max_seconds, elapsed)
+
+    def stats(self):
+        with self.lock:
+            return {
+                f"{r.method} {r.pattern}": {
+                    "calls": r.calls,
+                    "avgMs": round(r.seconds / (r.calls or 1) * 1000, 3),
+                    "maxMs": round(r.max_seconds * 1000, 3),
+                }
+                for r in self.routes
+                if r.calls
+            }
+
+
+router = Router()
+route = router.route
+
+
+def respond_no_content(start_response):
+    start_response("204 No Content", [])
+    return [b""]
+
+
+def respond_session(start_response, username, users):
+    """Start a session for username and respond with its cookie"""
+    session_id = create_session(username)
+
+    is_admin = users[username].get("isAdmin", False)
+
+    status = "200 OK"
+    headers = [
+        ("Content-type", "application/json"),
+        session_cookie_header(session_id),
+    ]
+    start_response(status, headers)
+    return [
+        json.dumps(
+            {"success": True, "username": username, "isAdmin": is_admin}
+        ).encode("utf-8")
+    ]
+
+
+def expect_list(value, what, entry_type=dict):
+    """Return value if it is a list of entry_type values, else raise a 400"""
+    if not isinstance(value, list) or not all(
+        isinstance(v, entry_type) and not isinstance(v, bool) for v in value
+    ):
+        raise HTTPError("400 Bad Request", {"error": f"Expected array of {what}"})
+    return value
+
+
+@route("GET", "/")
+def get_index(request, start_response):
+    return respond_static(
+        request.environ, start_response, "index.html", "text/html; charset=utf-8"
+    )
+
+
+@route("GET", "/api/check-session")
+def get_check_session(request, start_response):
+    username = get_session_username(request.environ)
+    if username:
+        users = load_users()
+        is_admin = users.get(username, {}).get("isAdmin", False)
+        response = {
+            "authenticated": True,
+            "username": username,
+            "isAdmin": is_admin,
+            # Whether the page should open GET /api/events
+            "liveUpdates": bool(
+                request.environ.get("gtd.asgi") or EVENTS_STREAM_SECONDS > 0
+            ),
+        }
+    else:
+        response = {"authenticated": False}
+
+    return respond_json(start_response, "200 OK", response)
+
+
+@route("GET", "/api/data", auth=user_required)
+def get_data(request, start_response):
+    schedule_archive(request.username)
+    data = load_data(request.username)
+    etag = dataset_etag(request.username, data)
+    # The same URL serves whoever is logged in
+    vary = [("Vary", "Cookie")]
+    if etag_matches(request.environ, etag):
+        return respond_not_modified(start_response, etag, vary)
+    data = {k: v for k, v in data.items() if k not in ("tombstones", "tombstonesFrom")}
+    headers = [("ETag", etag), ("Cache-Control", "no-cache")] + vary
+    return respond_json_records(
+        start_response, "200 OK", data, ("projects", "items"), headers
+    )
+
+
+def parse_item_query(request):
+    """Return the item query given by GET /api/items' query string"""
+
+    def bad_request(message):
+        return HTTPError("400 Bad Request", {"error": message})
+
+    query = {"sort": request.query("sort") or "position"}
+    if query["sort"] not in ITEM_SORT_KEYS:
+        raise bad_request("sort must be position or dueDatetime")
+    if request.query("status"):
+        query["status"] = request.query("status").split(",")
+    project_id = request.query("projectId")
+    if project_id == "none":
+        query["projectId"] = None
+    elif project_id is not None:
+        try:
+            query["projectId"] = int(project_id)
+        except ValueError:
+            raise bad_request("projectId must be a project id or none")
+    done = request.query("done")
+    if done is not None:
+        if done not in ("true", "false"):
+            raise bad_request("done must be true or false")
+        query["done"] = done == "true"
+    for name in ("dueFrom", "dueTo", "startFrom", "startTo"):
+        if request.query(name) is not None:
+            query[name] = request.query(name)
+    try:
+        query["limit"] = int(request.query("limit") or ITEM_PAGE_SIZE)
+    except ValueError:
+        raise bad_request("limit must be a number")
+    query["limit"] = max(1, min(query["limit"], ITEM_PAGE_MAX))
+    if request.query("cursor") is not None:
+        query["after"] = decode_item_cursor(request.query("cursor"), query["sort"])
+        if query["after"] is None:
+            raise bad_request("Invalid cursor")
+    return query
+
+
+def encode_item_cursor(sort, key):
+    return b64encode(encode_json({"sort": sort, "after": key}))
+
+
+def decode_item_cursor(cursor, sort):
+    """Return the sort key a cursor points after, or None if it is invalid"""
+    try:
+        decoded = decode_json(b64decode(cursor))
+        after = decoded["after"]
+        key_types = ITEM_SORT_KEYS[sort][1]
+        if decoded["sort"] != sort or len(after) != len(key_types):
+            return None
+    except (ValueError, TypeError, KeyError):
+        return None
+    for value, value_type in zip(after, key_types):
+        if isinstance(value, bool) or not isinstance(value, value_type):
+            return None
+    return after
+
+
+@route("GET", "/api/items", auth=user_required)
+def get_items(request, start_response):
+    query = parse_item_query(request)
+    page, next_key = storage.query_items(request.username, query)
+    next_cursor = None
+    if next_key is not None:
+        next_cursor = encode_item_cursor(query["sort"], next_key)
+    response = {"items": page, "nextCursor": next_cursor}
+    return respond_json_records(start_response, "200 OK", response, ("items",))
+
+
+archive_checks = {}  # username -> monotonic time of the last archive pass
+archive_checks_lock = threading.Lock()
+
+
+def schedule_archive(username):
+    """Archive username's old done items in the background, now and then"""
+    if not ARCHIVE_AFTER_DAYS:
+        return
+    now = time.monotonic()
+    with archive_checks_lock:
+        last = archive_checks.get(username)
+        if last is not None and now - last < ARCHIVE_INTERVAL_SECONDS:
+            return
+        archive_checks[username] = now
+    threading.Thread(
+        target=run_archive, args=(username,), name="archive", daemon=True
+    ).start()
+
+
+def run_archive(username):
+    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    try:
+        storage.archive_done_items(username, cutoff.isoformat())
+    except Exception as e:
+        print(f"Archiving done items of {username} failed: {e!r}", file=sys.stderr)
+
+
+def parse_archive_query(request):
+    """Return the query given by GET /api/archive's query string"""
+    query = {"q": request.query("q")}
+    for name in ("doneFrom", "doneTo"):
+        query[name] = request.query(name)
+    try:
+        query["limit"] = int(request.query("limit") or ITEM_PAGE_SIZE)
+    except ValueError:
+        raise HTTPError("400 Bad Request", {"error": "limit must be a number"})
+    query["limit"] = max(1, min(query["limit"], ITEM_PAGE_MAX))
+    if request.query("cursor") is not None:
+        query["before"] = decode_archive_cursor(request.query("cursor"))
+        if query["before"] is None:
+            raise HTTPError("400 Bad Request", {"error": "Invalid cursor"})
+    return query
+
+
+def decode_archive_cursor(cursor):
+    """Return the (doneAt, id) a cursor points before, or None if invalid"""
+    try:
+        done_at, item_id = decode_json(b64decode(cursor))["before"]
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(done_at, str) or type(item_id) is not int:
+        return None
+    return [done_at, item_id]
+
+
+@route("GET", "/api/archive", auth=user_required)
+def get_archive(request, start_response):
+    query = parse_archive_query(request)
+    page, next_key = storage.archived_items(request.username, query)
+    next_cursor = None
+    if next_key is not None:
+        next_cursor = b64encode(encode_json({"before": next_key}))
+    response = {"items": page, "nextCursor": next_cursor}
+    return respond_json_records(start_response, "200 OK", response, ("items",))
+
+
+@route("POST", "/api/archive/restore", auth=user_required)
+def post_archive_restore(request, start_response):
+    ids = expect_list(request.json(), "ids", int)
+    restored = storage.restore_items(request.username, ids)
+    return respond_json(start_response, "200 OK", {"items": restored})
+
+
+@route("GET", "/api/search", auth=user_required)
+def get_search(request, start_response):
+    try:
+        limit = max(1, min(int(request.query("limit") or 20), ITEM_PAGE_MAX))
+    except ValueError:
+        return respond_json(
+            start_response, "400 Bad Request", {"error": "limit must be a number"}
+        )
+    index = search_index(request.username)
+    with index.lock:
+        index.refresh(storage)
+        matches = index.search(request.query("q") or "", limit)
+    records = {}
+    for kind in ("item", "project"):
+        ids = [record_id for _, k, record_id in matches if k == kind]
+        if ids:
+            for record in storage.get_records(request.username, kind, ids):
+                records[(kind, record["id"])] = record
+    results = []
+    for score, kind, record_id in matches:
+        record = records.get((kind, record_id))
+        if record is not None:
+            result = {"type": kind, "id": record_id, "score": round(score, 4)}
+            results.append(dict(result, record=record))
+    return respond_json(start_response, "200 OK", {"results": results})
+
+
+@route("GET", "/api/changes", auth=user_required)
+def get_changes(request, start_response):
+    try:
+        since = int(request.query("since"))
+    except (TypeError, ValueError):
+        return respond_json(
+            start_response,
+            "400 Bad Request",
+            {"error": "since must be a dataset version"},
+        )
+    schedule_archive(request.username)
+    changes = storage.changes(request.username, since)
+    if changes.get("reset"):
+        return respond_json(start_response, "200 OK", changes)
+    return respond_json_records(
+        start_response, "200 OK", changes, ("projects", "items")
+    )
+
+
+EVENT_STREAM_HEADERS = [
+    ("Content-type", "text/event-stream"),
+    ("Cache-Control", "no-cache"),
+    ("X-Accel-Buffering", "no"),  # keep proxies from holding events back
+]
+# Sent first: how long browsers wait before reconnecting, in milliseconds
+EVENT_STREAM_RETRY = b"retry: 2000\n\n"
+EVENT_STREAM_HEARTBEAT = b": heartbeat\n\n"
+
+
+@route("GET", "/api/events", auth=user_required)
+def get_events(request, start_response):
+    if EVENTS_STREAM_SECONDS <= 0:
+        # Tells EventSource clients not to reconnect
+        return respond_no_content(start_response)
+    subscription = events.subscribe(
+        request.username, request.environ.get("HTTP_LAST_EVENT_ID")
+    )
+    start_response("200 OK", EVENT_STREAM_HEADERS)
+    return iter_event_stream(subscription)
+
+
+def iter_event_stream(subscription):
+    """Yield a subscription's events as a server-sent event stream.
+
+    Each stream holds a WSGI worker thread, so it ends after
+    EVENTS_STREAM_SECONDS; asgi_event_stream() serves streams without one.
+    """
+    deadline = time.monotonic() + EVENTS_STREAM_SECONDS
+    try:
+        yield EVENT_STREAM_RETRY
+        while True:
+            messages = subscription.take()
+            if messages:
+                yield b"".join(messages)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if not subscription.wait(min(remaining, EVENTS_HEARTBEAT_SECONDS)):
+                yield EVENT_STREAM_HEARTBEAT
+    finally:
+        subscription.close()
+
+
+@route("POST", "/api/login")
+def post_login(request, start_response):
+    req_data = request.json()
+    username = req_data.get("username", "").strip()
+    password = req_data.get("password", "")
+
+    if not username:
+        response = {"success": False, "message": "Username required"}
+    else:
+        login_throttle.attempt(username, client_ip(request.environ))
+        users = load_users()
+        if username in users:
+            # Check if user needs password reset
+            if users[username].get("needsPasswordReset", False):
+                # User needs to set password - allow login with empty password
+                if password == "":
+                    response = {
+                        "success": True,
+                        "needsPasswordSetup": True,
+                        "username": username,
+                    }
+                else:
+                    response = {
+                        "success": False,
+                        "message": "Please login with empty password to set your password",
+                    }
+            else:
+                # Normal login flow - password required
+                if not password:
+                    response = {
+                        "success": False,
+                        "message": "Password required",
+                    }
+                elif password_hasher.run(
+                    verify_password, password, users[username]["password"]
+                ):
+                    return respond_session(start_response, username, users)
+                else:
+                    response = {"success": False, "message": "Invalid password"}
+        else:
+            response = {"success": False, "message": "Account does not exist"}
+
+    return respond_json(start_response, "200 OK", response)
+
+
+@route("POST", "/api/logout")
+def post_logout(request, start_response):
+    cookie_header = request.environ.get("HTTP_COOKIE", "")
+    if cookie_header:
+        cookie = SimpleCookie(cookie_header)
+        if "session_id" in cookie:
+            session_id = cookie["session_id"].value
+            end_session(session_id)
+
+    return respond_json(start_response, "200 OK", {"success": True})
+
+
+@route("POST", "/api/data", auth=user_required)
+def post_data(request, start_response):
+    save_data(request.username, request.json())
+    return respond_json(start_response, "200 OK", {"success": True})
+
+
+@route("POST", "/api/admin/create-user", auth=admin_required)
+def admin_create_user(request, start_response):
+    new_username = request.json().get("username", "").strip()
+
+    with users_lock():
+        users = load_users()
+        if not new_username:
+            response = {"success": False, "message": "Username required"}
+        elif new_username in users:
+            response = {
+                "success": False,
+                "message": "Username already exists",
+            }
+        else:
+            users[new_username] = {
+                "password": None,
+                "isAdmin": False,
+                "needsPasswordReset": True,
+            }
+            save_users(users)
+            response = {
+                "success": True,
+                "message": f"User '{new_username}' created successfully",
+            }
+
+    return respond_json(start_response, "200 OK", response)
+
+
+@route("POST", "/api/admin/list-users", auth=admin_required)
+def admin_list_users(request, start_response):
+    user_list = [
+        {"username": u, "isAdmin": data.get("isAdmin", False)}
+        for u, data in request.users.items()
+    ]
+    return respond_json(start_response, "200 OK", {"users": user_list})
+
+
+@route("POST", "/api/admin/stats", auth=admin_required)
+def admin_stats(request, start_response):
+    stats = {
+        "cache": cache_stats(),
+        "storage": storage.stats(),
+        "locks": dict(lock_stats),
+        "passwordHashing": password_hasher.stats(),
+        "loginThrottle": login_throttle.stats(),
+        "events": events.stats(),
+        "routes": router.stats(),
+    }
+    return respond_json(start_response, "200 OK", stats)
+
+
+@route("GET", "/api/admin/metrics", auth=admin_required)
+def admin_metrics(request, start_response):
+    hashing = password_hasher.stats()
+    extra = [
+        ("gtd_password_hash_in_flight", "gauge", hashing["inFlight"]),
+        ("gtd_password_hash_queued", "gauge", hashing["queued"]),
+        ("gtd_password_hash_rejected_total", "counter", hashing["rejected"]),
+        ("gtd_login_throttled_total", "counter", login_throttle.stats()["throttled"]),
+        ("gtd_lock_wait_seconds_total", "counter", lock_stats["waitSeconds"]),
+    ]
+    for name, cache in cache_stats().items():
+        extra.append((f"gtd_{name}_cache_entries", "gauge", cache["entries"]))
+        extra.append((f"gtd_{name}_cache_bytes", "gauge", cache["bytes"]))
+    body = metrics.render(extra).encode("utf-8")
+    headers = [
+        ("Content-type", "text/plain; version=0.0.4; charset=utf-8"),
+        ("Content-Length", str(len(body))),
+    ]
+    start_response("200 OK", headers)
+    return [body]
+
+
+@route("GET", "/api/admin/export", auth=admin_required)
+def admin_export(request, start_response):
+    export_format = request.query("format") or "ndjson"
+    if export_format == "tar":
+        content_type, chunks = "application/x-tar", iter_export_tar()
+    elif export_format == "ndjson":
+        content_type, chunks = "application/x-ndjson", iter_export_ndjson()
+    else:
+        raise HTTPError("400 Bad Request", {"error": "format must be ndjson or tar"})
+    filename = f"gtd-export-{datetime.now():%Y%m%d-%H%M%S}.{export_format}"
+    headers = [
+        ("Content-type", content_type),
+        ("Content-Disposition", f'attachment; filename="{filename}"'),
+        ("Cache-Control", "no-store"),
+    ]
+    start_response("200 OK", headers)
+    return chunks
+
+
+@route("POST", "/api/admin/import", auth=admin_required)
+def admin_import(request, start_response):
+    import_format = request.query("format") or "ndjson"
+    if import_format not in ("ndjson", "tar"):
+        raise HTTPError("400 Bad Request", {"error": "format must be ndjson or tar"})
+    body = io.BufferedReader(RequestBody(request.environ))
+    records = iter_import_records(body, import_format)
+    importer = ExportImporter(storage)
+    # Check the header before committing to a 200
+    try:
+        importer.add(next(records))
+    except (StopIteration, ValueError, TypeError, tarfile.TarError):
+        raise HTTPError("400 Bad Request", {"error": "Not a GTD export"})
+    headers = [
+        ("Content-type", "application/x-ndjson"),
+        # Progress lines must not wait on the gzip buffer
+        ("Cache-Control", "no-store, no-transform"),
+    ]
+    start_response("200 OK", headers)
+    return iter_import_progress(importer, records)
+
+
+@route("POST", "/api/admin/delete-user", auth=admin_required)
+def admin_delete_user(request, start_response):
+    delete_username = request.json().get("username", "").strip()
+
+    with users_lock():
+        users = load_users()
+        if delete_username == "admin":
+            response = {
+                "success": False,
+                "message": "Cannot delete admin account",
+            }
+        elif delete_username not in users:
+            response = {"success": False, "message": "User not found"}
+        else:
+            users.pop(delete_username)
+            save_users(users)
+
+            # Delete user's data
+            storage.delete_data(delete_username)
+            delete_search_index(delete_username)
+            delete_archive(delete_username)
+            events.forget(delete_username)
+
+            response = {
+                "success": True,
+                "message": f"User '{delete_username}' deleted",
+            }
+
+    return respond_json(start_response, "200 OK", response)
+
+
+@route("POST", "/api/admin/reset-password", auth=admin_required)
+def admin_reset_password(request, start_response):
+    reset_username = request.json().get("username", "").strip()
+
+    with users_lock():
+        users = load_users()
+        if reset_username not in users:
+            response = {"success": False, "message": "User not found"}
+        else:
+            users[reset_username]["password"] = None
+            users[reset_username]["needsPasswordReset"] = True
+            save_users(users)
+            response = {
+                "success": True,
+                "message": f"Password reset for '{reset_username}'",
+            }
+
+    return respond_json(start_response, "200 OK", response)
+
+
+@route("POST", "/api/set-password")
+def post_set_password(request, start_response):
+    req_data = request.json()
+    set_username = req_data.get("username", "").strip()
+    new_password = req_data.get("password", "")
+
+    if not set_username or not new_password:
+        response = {
+            "success": False,
+            "message": "Username and password required",
+        }
+    else:
+        login_throttle.attempt(set_username, client_ip(request.environ))
+        password_hash = None
+        if load_users().get(set_username, {}).get("needsPasswordReset"):
+            # Hash before taking the lock; PBKDF2 is slow
+            password_hash = password_hasher.run(hash_password, new_password)
+
+        with users_lock():
+            users = load_users()
+            if set_username not in users:
+                response = {"success": False, "message": "User not found"}
+            elif not users[set_username].get("needsPasswordReset", False):
+                response = {
+                    "success": False,
+                    "message": "User does not need password reset",
+                }
+            else:
+                users[set_username]["password"] = password_hash or hash_password(
+                    new_password
+                )
+                users[set_username]["needsPasswordReset"] = False
+                save_users(users)
+                response = None
+
+        if response is None:
+            # Create session for the user
+            return respond_session(start_response, set_username, users)
+
+    return respond_json(start_response, "200 OK", response)
+
+
+@route("POST", "/api/items", auth=user_required)
+def post_item(request, start_response):
+    item = storage.add_item(request.username, new_item(request.json()))
+
+    return respond_json(start_response, "200 OK", item)
+
+
+@route("POST", "/api/projects", auth=user_required)
+def post_project(request, start_response):
+    project = storage.add_project(request.username, new_project(request.json()))
+
+    return respond_json(start_response, "200 OK", project)
+
+
+@route("POST", "/api/items/batch", auth=user_required)
+def post_items_batch(request, start_response):
+    req_data = expect_list(request.json(), "items")
+    items = storage.add_items(request.username, [new_item(r) for r in req_data])
+    return respond_json(start_response, "200 OK", items)
+
+
+@route("POST", "/api/projects/batch", auth=user_required)
+def post_projects_batch(request, start_response):
+    req_data = expect_list(request.json(), "projects")
+    projects = storage.add_projects(
+        request.username, [new_project(r) for r in req_data]
+    )
+    return respond_json(start_response, "200 OK", projects)
+
+
+# Batch update endpoint for multiple items
+@route("PUT", "/api/items/batch", auth=user_required)
+def put_items_batch(request, start_response):
+    updates = expect_list(request.json(), "updates")
+    updated_count = storage.update_items(request.username, updates)
+    return respond_json(start_response, "200 OK", {"updated": updated_count})
+
+
+# Batch update endpoint for multiple projects
+@route("PUT", "/api/projects/batch", auth=user_required)
+def put_projects_batch(request, start_response):
+    updates = expect_list(request.json(), "updates")
+    updated_count = storage.update_projects(request.username, updates)
+    return respond_json(start_response, "200 OK", {"updated": updated_count})
+
+
+@route("PUT", "/api/items/<int:item_id>", auth=user_required)
+def put_item(request, start_response, item_id):
+    item = storage.update_item(request.username, item_id, request.json())
+    if item is None:
+        return respond_text(start_response, "404 Not Found", "Not Found")
+    return respond_json(start_response, "200 OK", item)
+
+
+@route("PUT", "/api/projects/<int:project_id>", auth=user_required)
+def put_project(request, start_response, project_id):
+    project = storage.update_project(request.username, project_id, request.json())
+    if project is None:
+        return respond_text(start_response, "404 Not Found", "Not Found")
+    return respond_json(start_response, "200 OK", project)
+
+
+def parse_move(request):
+    """Return the (after, before) neighbour ids of a move request"""
+    body = request.json()
+    neighbours = ()
+    if isinstance(body, dict):
+        neighbours = (body.get("after"), body.get("before"))
+    if len(neighbours) != 2 or any(
+        i is not None and type(i) is not int for i in neighbours
+    ):
+        raise HTTPError(
+            "400 Bad Request", {"error": "after and before must be ids or null"}
+        )
+    return neighbours
+
+
+@route("PUT", "/api/items/<int:item_id>/move", auth=user_required)
+def move_item(request, start_response, item_id):
+    after, before = parse_move(request)
+    try:
+        item = storage.move_item(request.username, item_id, after, before)
+    except ValueError as e:
+        raise HTTPError("400 Bad Request", {"error": str(e)})
+    if item is None:
+        return respond_text(start_response, "404 Not Found", "Not Found")
+    return respond_json(start_response, "200 OK", item)
+
+
+@route("PUT", "/api/projects/<int:project_id>/move", auth=user_required)
+def move_project(request, start_response, project_id):
+    after, before = parse_move(request)
+    try:
+        project = storage.move_project(request.username, project_id, after, before)
+    except ValueError as e:
+        raise HTTPError("400 Bad Request", {"error": str(e)})
+    if project is None:
+        return respond_text(start_response, "404 Not Found", "Not Found")
+    return respond_json(start_response, "200 OK", project)
+
+
+# Delete all done items in one write
+@route("DELETE", "/api/items/done", auth=user_required)
+def delete_done_items(request, start_response):
+    deleted_count = storage.delete_done_items(request.username)
+    return respond_json(start_response, "200 OK", {"deleted": deleted_count})
+
+
+# Batch delete endpoints for multiple items or projects
+@route("DELETE", "/api/items/batch", auth=user_required)
+def delete_items_batch(request, start_response):
+    ids = expect_list(request.json(), "ids", int)
+    deleted_count = storage.delete_items(request.username, ids)
+    return respond_json(start_response, "200 OK", {"deleted": deleted_count})
+
+
+@route("DELETE", "/api/projects/batch", auth=user_required)
+def delete_projects_batch(request, start_response):
+    ids = expect_list(request.json(), "ids", int)
+    deleted_count = storage.delete_projects(request.username, ids)
+    return respond_json(start_response, "200 OK", {"deleted": deleted_count})
+
+
+@route("DELETE", "/api/items/<int:item_id>", auth=user_required)
+def delete_item(request, start_response, item_id):
+    storage.delete_item(request.username, item_id)
+    return respond_no_content(start_response)
+
+
+@route("DELETE", "/api/projects/<int:project_id>", auth=user_required)
+def delete_project(request, start_response, project_id):
+    storage.delete_project(request.username, project_id)
+    return respond_no_content(start_response)
+
+
+def application(environ, start_response):
+    """WSGI application entry point"""
+    return router.dispatch(environ, start_response)
+
+
+application = instrument_requests(compress_responses(handle_http_errors(application)))
+
+
+ASYNC_WORKERS = int(os.environ.get("GTD_ASYNC_WORKERS", "16"))
+asgi_executor = ThreadPoolExecutor(ASYNC_WORKERS, thread_name_prefix="asgi")
+
+
+def asgi_environ(scope, body=None):
+    """Return the WSGI environ equivalent of an ASGI HTTP scope.
+
+    Without a body, CONTENT_LENGTH is the request's own header and the
+    caller sets wsgi.input.
+    """
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": "",
+        # WSGI paths are bytes decoded as latin-1
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "gtd.asgi": True,
+    }
+    for name, value in scope.get("headers", ()):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        value = value.decode("latin-1")
+        if name in environ and name.startswith("HTTP_"):
+            value = environ[name] + "," + value
+        environ[name] = value
+    if body is not None:
+        environ["wsgi.input"] = io.BytesIO(body)
+        environ["CONTENT_LENGTH"] = str(len(body))
+    return environ
+
+
+class ASGIRequestBody(io.RawIOBase):
+    """An ASGI request body as wsgi.input, for reading on a worker thread.
+
+    Each message is awaited from receive() on the event loop only once the
+    previous one has been read, so memory use does not grow with the body.
+    """
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.pending = memoryview(b"")
+        self.more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending and self.more_body:
+            message = asyncio.run_coroutine_threadsafe(
+                self.receive(), self.loop
+            ).result()
+            if message["type"] == "http.disconnect":
+                self.more_body = False
+            else:
+                self.pending = memoryview(message.get("body", b""))
+                self.more_body = message.get("more_body", False)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+async def asgi_read_body(receive):
+    """Return the whole request body, or None if the client went away.
+
+    A body longer than MAX_BODY_BYTES is returned as soon as it exceeds it.
+    """
+    body = bytearray()
+    while len(body) <= MAX_BODY_BYTES:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return bytes(body)
+
+
+async def asgi_application(scope, receive, send):
+    """ASGI entry point serving the same API as application.
+
+    Requests are handled by the WSGI application on asgi_executor, and
+    streamed bodies are iterated there too, so file I/O and password
+    hashing never block the event loop. Event streams are served in the
+    event loop instead, so idle ones take no thread.
+    """
+    if scope["type"] == "lifespan":
+        return await asgi_lifespan(receive, send)
+    if scope["type"] != "http":
+        raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    loop = asyncio.get_running_loop()
+    environ = asgi_environ(scope)
+    if (
+        scope["method"] == "POST"
+        and scope["path"] == "/api/admin/import"
+        and environ.get("CONTENT_LENGTH", "").isdigit()
+    ):
+        # Imports may be any size, so they are read as they arrive
+        environ["wsgi.input"] = ASGIRequestBody(receive, loop)
+    else:
+        body = await asgi_read_body(receive)
+        if body is None:
+            return
+        if len(body) > MAX_BODY_BYTES:
+            return await asgi_respond_too_large(send)
+        environ = asgi_environ(scope, body)
+    if scope["method"] == "GET" and scope["path"] == "/api/events":
+        username = await loop.run_in_executor(
+            asgi_executor, get_session_username, environ
+        )
+        if username:
+            return await asgi_event_stream(environ, username, receive, send)
+        # Let the application refuse it as usual
+    chunks = await loop.run_in_executor(
+        asgi_executor, application, environ, start_response
+    )
+    status, headers = started
+    await send(
+        {
+            "type": "http.response.start",
+            "status": int(status.split()[0]),
+            "headers": [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ],
+        }
+    )
+    if isinstance(chunks, list):
+        await send({"type": "http.response.body", "body": b"".join(chunks)})
+        return
+    iterator = iter(chunks)
+    try:
+        while True:
+            chunk = await loop.run_in_executor(asgi_executor, next, iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def asgi_respond_too_large(send):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    body = json.dumps({"error": "Request body too large"}).encode("utf-8")
+    await send({"type": "http.response.body", "body": body})
+
+
+async def asgi_event_stream(environ, username, receive, send):
+    """Serve GET /api/events for username until the client goes away"""
+    started = time.perf_counter()
+    environ["gtd.route"] = "/api/events"
+    subscription = events.subscribe(
+        username, environ.get("HTTP_LAST_EVENT_ID"), asyncio.get_running_loop()
+    )
+    disconnected = asyncio.ensure_future(asgi_disconnect(receive))
+    size = 0
+    try:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in EVENT_STREAM_HEADERS
+                ],
+            }
+        )
+        chunk = EVENT_STREAM_RETRY
+        while not disconnected.done():
+            messages = subscription.take()
+            if messages:
+                chunk += b"".join(messages)
+            elif not chunk and not await subscription.wait_async(
+                EVENTS_HEARTBEAT_SECONDS, disconnected
+            ):
+                chunk = EVENT_STREAM_HEARTBEAT
+            if chunk and not disconnected.done():
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+                size += len(chunk)
+                chunk = b""
+    except OSError:  # the client went away mid-write
+        pass
+    finally:
+        disconnected.cancel()
+        subscription.close()
+        record_request(environ, "200", size, started, {})
+
+
+async def asgi_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def asgi_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if hasattr(storage, "flush"):
+                await asyncio.get_running_loop().run_in_executor(
+                    asgi_executor, storage.flush
+                )
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def serve_http_connection(app, reader, writer):
+    """Serve HTTP/1.1 requests from one connection to an ASGI app"""
+    peer = writer.get_extra_info("peername") or ("", 0)
+    sockname = writer.get_extra_info("sockname") or ("localhost", 0)
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            method, target, version = request_line.decode("latin-1").split()
+            headers = []
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers.append((name.strip().lower(), value.strip()))
+            fields = dict(headers)
+            if "transfer-encoding" in fields:
+                # Request bodies are only accepted with a Content-Length
+                writer.write(b"HTTP/1.1 411 Length Required\r\n")
+                writer.write(b"Connection: close\r\nContent-Length: 0\r\n\r\n")
+                break
+            content_length = int(fields.get("content-length", 0))
+            if content_length < 0:
+                break
+            keep_alive = (
+                version == "HTTP/1.1"
+                and fields.get("connection", "").lower() != "close"
+            )
+            path, _, query = target.partition("?")
+            scope = {
+                "type": "http",
+                "asgi": {"version": "3.0"},
+                "http_version": version[len("HTTP/") :],
+                "method": method,
+                "scheme": "http",
+                "path": unquote(path),
+                "raw_path": path.encode("latin-1"),
+                "query_string": query.encode("latin-1"),
+                "headers": [
+                    (name.encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers
+                ],
+                "client": peer[:2],
+                "server": sockname[:2],
+            }
+            response = HTTPResponseWriter(writer, keep_alive)
+            request = HTTPRequestReader(reader, content_length, response)
+            try:
+                await app(scope, request.receive, response.send)
+            except Exception as e:
+                print(f"Error handling {method} {path}: {e!r}", file=sys.stderr)
+                if response.started:
+                    break
+                await response.send({"type": "http.response.start", "status": 500})
+                await response.send({"type": "http.response.body", "body": b""})
+            # The next request cannot be found past a body left unread
+            if not response.keep_alive or request.remaining:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+class HTTPRequestReader:
+    """Reads a Content-Length request body from a connection for ASGI.
+
+    The body is read in chunks as the app calls receive(), rather than
+    before the request is handled, so its size does not bound memory use.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, reader, content_length, response):
+        self.reader = reader
+        self.remaining = content_length
+        self.response = response
+        self.more_body = True
+
+    async def receive(self):
+        if not self.more_body:
+            await self.response.closed.wait()
+            return {"type": "http.disconnect"}
+        chunk = b""
+        if self.remaining:
+            chunk = await self.reader.read(min(self.remaining, self.chunk_size))
+            if not chunk:
+                self.more_body = False
+                return {"type": "http.disconnect"}
+            self.remaining -= len(chunk)
+        self.more_body = self.remaining > 0
+        return {"type": "http.request", "body": chunk, "more_body": self.more_body}
+
+
+class HTTPResponseWriter:
+    """Writes ASGI response messages to a connection as HTTP/1.1.
+
+    Responses without a Content-Length are sent chunked, or on HTTP/1.0
+    by closing the connection afterwards.
+    """
+
+    def __init__(self, writer, keep_alive):
+        self.writer = writer
+        self.keep_alive = keep_alive
+        self.started = False
+        self.chunked = False
+        self.closed = asyncio.Event()
+
+    async def send(self, message):
+        try:
+            if message["type"] == "http.response.start":
+                self.start(message)
+            elif message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                more_body = message.get("more_body", False)
+                if self.chunked:
+                    if body:
+                        self.writer.write(b"%x\r\n%s\r\n" % (len(body), body))
+                    if not more_body:
+                        self.writer.write(b"0\r\n\r\n")
+                else:
+                    self.writer.write(body)
+                await self.writer.drain()
+                if not more_body:
+                    self.closed.set()
+        except ConnectionError:
+            self.closed.set()
+            raise
+
+    def start(self, message):
+        self.started = True
+        status = message["status"]
+        headers = list(message.get("headers", ()))
+        names = {name.lower() for name, _ in headers}
+        if b"content-length" not in names and status not in (204, 304):
+            if self.keep_alive:
+                self.chunked = True
+                headers.append((b"transfer-encoding", b"chunked"))
+            else:
+                self.keep_alive = False
+        if not self.keep_alive:
+            headers.append((b"connection", b"close"))
+        lines = [b"HTTP/1.1 %d %s" % (status, HTTPStatus(status).phrase.encode())]
+        lines += [name + b": " + value for name, value in headers]
+        self.writer.write(b"\r\n".join(lines) + b"\r\n\r\n")
+
+
+async def serve_asgi(app, host="localhost", port=8000):
+    """Serve an ASGI app over HTTP/1.1 with nothing but asyncio"""
+    server = await asyncio.start_server(
+        lambda reader, writer: serve_http_connection(app, reader, writer),
+        host,
+        port,
+    )
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import WSGIServer, make_server
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        """Serves each connection on a thread, so event streams can stay open"""
+
+        daemon_threads = True
+
+    if sys.argv[1:2] == ["migrate-sqlite"]:
+        db_path = sys.argv[2] if len(sys.argv) > 2 else SQLITE_FILE
+        migrated = migrate_json_to_sqlite(db_path)
+        print(f"Migrated {len(migrated)} user dataset(s) to {db_path}")
+        print("Start the server with GTD_STORAGE=sqlite to use it")
+        sys.exit(0)
+
+    if sys.argv[1:2] == ["export"]:
+        # NDJSON unless the path ends in .tar; - writes to stdout
+        export_to_file(sys.argv[2] if len(sys.argv) > 2 else "-")
+        sys.exit(0)
+
+    if sys.argv[1:2] == ["import"]:
+        if len(sys.argv) != 3:
+            sys.exit("usage: python wsgi.py import <export.ndjson|export.tar>")
+        sys.exit(0 if import_from_file(sys.argv[2]) else 1)
+
+    port = 8000
+    if sys.argv[1:2] == ["serve-async"]:
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else port
+        print(f"\n✅ GTD Task Manager running at http://localhost:{port} (asyncio)")
+        print("📁 User data saved to: data_<username>.json")
+        print("\nPress Ctrl+C to stop\n")
+        try:
+            asyncio.run(serve_asgi(asgi_application, "localhost", port))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    httpd = make_server(
+        "localhost", port, application, server_class=ThreadingWSGIServer
+    )
     print(f"\n✅ GTD Task Manager running at http://localhost:{port}")
     print("📁 User data saved to: data_<username>.json")
     print("\nPress Ctrl+C to stop\n")